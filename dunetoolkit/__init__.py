@@ -1,3 +1,5 @@
-from .python_mongo_toolkit import create_query_object, search, search_by_id, update, add_to_query, insert, convert_str_to_date, convert_date_to_str
-from .query_class import Query
-from .validate import DuneValidator, validate_meas_remove_indices, validate_query_terms
+from .python_mongo_toolkit import create_query_object, ensure_indexes, search, iter_search, search_page, search_by_id, count, facet_counts, search_results_table, update, add_to_query, insert, insert_many, backfill_search_fields, backfill_si_values, convert_str_to_date, convert_date_to_str
+from .query_class import Query, query_complexity, query_plan_cache_info, clear_query_plan_cache
+from .result_cache import LocalResultCache, set_result_cache, result_cache_info, clear_result_cache
+from .reference_data import get_synonyms, get_isotopes, get_units, get_unit_conversions, get_specific_activities, reload_reference_data
+from .validate import DuneValidator, get_validator, validate_meas_remove_indices, validate_query_terms
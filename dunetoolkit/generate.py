@@ -0,0 +1,222 @@
+"""
+.. module:: generate
+   :synopsis: Generates synthetic assay records that are shaped like real ones, for load testing and benchmarking. The same seed always produces the same records, so a corpus of any size can be reproduced without copying real data.
+
+.. moduleauthor:: Elise Saxon
+"""
+
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+from dunetoolkit.reference_data import get_isotopes, get_units
+from dunetoolkit.python_mongo_toolkit import _assemble_doc, _create_db_obj, insert_many
+
+# the isotopes and units that most radiopurity assays report, mapped to their relative weights. The other isotopes in isotopes.csv and units in units.csv are chosen for the remaining fraction of measurement results (see RARE_CHOICE_FRACTION).
+COMMON_ISOTOPES = {"U-238":10, "Th-232":10, "K-40":8, "U-235":2, "Ra-226":3, "Th-228":2, "Ra-228":2, "Pb-210":2, "Co-60":3, "Cs-137":3, "Rn-222":1}
+COMMON_UNITS = {"ppb":6, "ppt":3, "ppm":4, "pct":1, "mBq/kg":8, "Bq/kg":3, "uBq/kg":3, "mBq":1, "mBq/m2":1}
+RARE_CHOICE_FRACTION = 0.05
+
+# the relative weights of the measurement result types
+MEAS_TYPES = {"measurement":6, "limit":3, "range":1}
+CONFIDENCE_LEVELS = [68, 90, 95]
+
+GROUPINGS = ["DUNE", "ILIAS UKDM", "LZ", "EXO-200", "nEXO", "SNO+", "MAJORANA", "SuperCDMS", "XENON1T", "DEAP-3600", ""]
+MATERIALS = ["Copper", "Stainless steel", "Titanium", "PTFE", "Acrylic", "Kapton cable", "Resin", "Solder", "Silicon", "Salt", "Rock", "Lead", "Glass fibre", "Epoxy", "Polyethylene"]
+MATERIAL_DETAILS = ["OFHC", "electroformed", "sheet", "rod", "tubing", "powder", "granules", "machined", "cleaned", "as received"]
+SUPPLIERS = ["Aurubis", "Goodfellow", "Sigma-Aldrich", "McMaster-Carr", "Timet", "DuPont", "Supplier's data", ""]
+TECHNIQUES = ["HPGe", "ICP-MS", "NAA", "GD-MS", "AA", "Rn emanation", "alpha counting"]
+INSTITUTIONS = ["PNNL", "SDSMT", "Boulby", "LNGS", "SNOLAB", "University College London", "SURF", ""]
+PEOPLE = ["Ben Wise", "James Loach", "Juergen Reichenbacher", "Dave Waters", "Isaac Arnquist", "Eric Hoppe", ""]
+REFERENCES = ["ILIAS Database http://radiopurity.in2p3.fr/", "DUNE radiopurity campaign", "Internal assay report", "arXiv preprint", ""]
+
+# the generated dates are between these dates
+FIRST_DATE = datetime(2005, 1, 1)
+NUM_DAYS = 6500
+
+
+def _weighted_choice(rng, weights):
+    """Chooses one of the keys of weights, with probability proportional to its weight.
+    """
+    return rng.choices(list(weights.keys()), weights=list(weights.values()))[0]
+
+def _choose_isotope(rng, isotopes):
+    if rng.random() < RARE_CHOICE_FRACTION:
+        return rng.choice(isotopes)
+    return _weighted_choice(rng, COMMON_ISOTOPES)
+
+def _choose_unit(rng, units):
+    if rng.random() < RARE_CHOICE_FRACTION:
+        return rng.choice(units)
+    return _weighted_choice(rng, COMMON_UNITS)
+
+def _generate_value(rng, meas_type):
+    """Generates the value list of a measurement result of the given type: a central value with symmetric (or, sometimes, asymmetric) errors, the bounds and confidence level of a range, or the bound and confidence level of a limit.
+    """
+    central_value = round(10 ** rng.uniform(-3, 3), 4)
+    if meas_type == "measurement":
+        value = [central_value, round(central_value * rng.uniform(0.01, 0.5), 4)]
+        if rng.random() < 0.2:
+            value.append(round(central_value * rng.uniform(0.01, 0.5), 4))
+        return value
+    elif meas_type == "range":
+        return [central_value, round(central_value * rng.uniform(1.1, 10), 4), rng.choice(CONFIDENCE_LEVELS)]
+    return [central_value, rng.choice(CONFIDENCE_LEVELS)]
+
+def _generate_date_str(rng):
+    return (FIRST_DATE + timedelta(days=rng.randrange(NUM_DAYS))).strftime('%Y-%m-%d')
+
+def _generate_record(rng, isotopes, units, record_idx):
+    """Generates the arguments of one insert call (the record format of insert_many and the insert_bulk command).
+
+    args:
+        * rng (random.Random): The random number generator to draw from.
+        * isotopes (list of str): All of the valid isotopes.
+        * units (list of str): All of the valid units.
+        * record_idx (int): The index of the record in the corpus, which is used in its sample ID.
+
+    returns:
+        * dict. The record.
+    """
+    material = rng.choice(MATERIALS)
+    detail = rng.choice(MATERIAL_DETAILS)
+    grouping = rng.choice(GROUPINGS)
+
+    meas_results = []
+    for i in range(rng.randint(1, 8)):
+        meas_type = _weighted_choice(rng, MEAS_TYPES)
+        meas_results.append({"isotope":_choose_isotope(rng, isotopes), "type":meas_type, "unit":_choose_unit(rng, units), "value":_generate_value(rng, meas_type)})
+
+    measurement_date = sorted([ _generate_date_str(rng) for i in range(rng.choice([0, 1, 1, 2])) ])
+    practitioner = rng.choice(PEOPLE)
+    return {
+        "sample_name": material+', '+detail,
+        "sample_description": material+' '+detail+(' from '+rng.choice(SUPPLIERS) if rng.random() < 0.5 else ''),
+        "sample_source": rng.choice(SUPPLIERS),
+        "sample_id": (grouping+' ' if grouping != '' else '')+'#'+str(record_idx),
+        "sample_owner_name": rng.choice(PEOPLE),
+        "data_reference": rng.choice(REFERENCES),
+        "data_input_name": rng.choice(PEOPLE),
+        "data_input_contact": rng.choice(['', 'radiopurity@example.com']),
+        "data_input_date": [_generate_date_str(rng)],
+        "data_input_notes": rng.choice(['', '', 'values converted from the original report', 'copper and steel samples were assayed together']),
+        "grouping": grouping,
+        "measurement_results": meas_results,
+        "measurement_practitioner_name": practitioner,
+        "measurement_technique": rng.choice(TECHNIQUES),
+        "measurement_institution": rng.choice(INSTITUTIONS),
+        "measurement_date": measurement_date,
+        "measurement_description": rng.choice(['', '', 'counted for '+str(rng.randint(1, 60))+' days'])
+    }
+
+def generate_records(num_records, seed=0):
+    """Generates synthetic assay records one at a time, so that corpora of any size can be streamed without holding them in memory. Each record has the keys of the arguments of the insert function, like the records passed to insert_many. Most of the measurement results are for the isotopes and in the units that real assays usually report (see COMMON_ISOTOPES and COMMON_UNITS), with a mix of measurement, limit, and range results.
+
+    args:
+        * num_records (int): The number of records to generate.
+        * seed (int) (optional): The random seed. The same seed always generates the same records, and the first n records of a larger corpus are the same as a corpus of n records.
+
+    yields:
+        * dict. Each record.
+    """
+    rng = random.Random(seed)
+    isotopes = sorted(get_isotopes())
+    units = sorted(get_units())
+    for record_idx in range(num_records):
+        yield _generate_record(rng, isotopes, units, record_idx)
+
+def generate_docs(num_records, seed=0):
+    """Generates synthetic assay documents, in the format they are stored in the database (without the "_search" sub-document and SI values that are added when they are inserted). Every document is valid according to the "whole_record" DuneValidator.
+
+    args:
+        * num_records (int): The number of documents to generate.
+        * seed (int) (optional): The random seed. The documents are assembled from the records that generate_records returns for the same seed.
+
+    yields:
+        * dict. Each document.
+    """
+    for record in generate_records(num_records, seed):
+        doc, error_msg = _assemble_doc(**record)
+        yield doc
+
+def write_records_jsonl(file_path, num_records, seed=0):
+    """Writes synthetic assay records to a JSON Lines file, one record per line, in the format read by the insert_bulk command.
+
+    args:
+        * file_path (str): The path of the file to write.
+        * num_records (int): The number of records to write.
+        * seed (int) (optional): The random seed.
+
+    returns:
+        * int. The number of records that were written.
+    """
+    num_written = 0
+    with open(file_path, 'w') as records_file:
+        for record in generate_records(num_records, seed):
+            records_file.write(json.dumps(record)+'\n')
+            num_written += 1
+    return num_written
+
+def load_records(num_records, seed=0, db_obj=None, coll_type='', batch_size=1000):
+    """Inserts synthetic assay records into the specified collection with insert_many, so they are validated and stored exactly like real inserts. Records are generated and inserted one batch at a time, so the memory used does not grow with the size of the corpus.
+
+    args:
+        * num_records (int): The number of records to insert.
+        * seed (int) (optional): The random seed.
+        * db_obj (pymongo.database.Database) (optional): A pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): The type of the collection to insert into. If no value is specified, the records are inserted into the main assay collection.
+        * batch_size (int) (optional): The number of records to generate and insert at a time.
+
+    returns:
+        * int. The number of records that were inserted.
+        * dict. The error messages for the records that were not inserted, keyed by the index of the record in the corpus.
+    """
+    if db_obj is None:
+        db_obj = _create_db_obj()
+
+    num_inserted = 0
+    errors = {}
+    batch = []
+    batch_start = 0
+    for record_idx, record in enumerate(generate_records(num_records, seed)):
+        batch.append(record)
+        if len(batch) >= batch_size or record_idx == num_records-1:
+            new_ids, batch_errors = insert_many(batch, db_obj=db_obj, batch_size=batch_size, coll_type=coll_type)
+            num_inserted += len(batch) - len(batch_errors)
+            for i, error_msg in batch_errors.items():
+                errors[batch_start+i] = error_msg
+            batch_start += len(batch)
+            batch = []
+    return num_inserted, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates synthetic assay records for load testing the radiopurity database.')
+    subparsers = parser.add_subparsers(help='where to send the records', dest='subparser_name')
+
+    jsonl_parser = subparsers.add_parser('jsonl', help='writes the records to a JSON Lines file that can be loaded with the insert_bulk command')
+    jsonl_parser.add_argument('--file', type=str, required=True, help='the path of the JSON Lines file to write')
+    jsonl_parser.add_argument('--num_records', type=int, required=True, help='the number of records to generate')
+    jsonl_parser.add_argument('--seed', type=int, default=0, help='the random seed')
+
+    load_parser = subparsers.add_parser('load', help='inserts the records into the database')
+    load_parser.add_argument('--num_records', type=int, required=True, help='the number of records to generate')
+    load_parser.add_argument('--seed', type=int, default=0, help='the random seed')
+    load_parser.add_argument('--coll_type', type=str, default='', help='the type of the collection to insert into (by default, the main assay collection)')
+    load_parser.add_argument('--batch_size', type=int, default=1000, help='the number of records to insert at a time')
+
+    args = vars(parser.parse_args())
+
+    if args['subparser_name'] == 'jsonl':
+        num_written = write_records_jsonl(args['file'], args['num_records'], seed=args['seed'])
+        result = 'WROTE '+str(num_written)+' RECORDS'
+    elif args['subparser_name'] == 'load':
+        num_inserted, errors = load_records(args['num_records'], seed=args['seed'], coll_type=args['coll_type'], batch_size=args['batch_size'])
+        for record_idx in sorted(errors.keys()):
+            print('RECORD '+str(record_idx)+': '+errors[record_idx])
+        result = 'INSERTED '+str(num_inserted)+' OF '+str(args['num_records'])+' RECORDS'
+    else:
+        print('You must enter where to send the records: jsonl or load')
+        result = None
+
+    print(result)
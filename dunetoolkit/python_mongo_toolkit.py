@@ -9,53 +9,216 @@ import os
 import argparse
 import json
 import re
+import threading
+import weakref
 from datetime import datetime
 from pymongo import MongoClient
+from pymongo import InsertOne, DeleteOne, UpdateOne, ASCENDING, TEXT
+from pymongo.errors import BulkWriteError, ConfigurationError, OperationFailure
 from bson.objectid import ObjectId
 from copy import deepcopy
-from dunetoolkit.validate import DuneValidator, validate_meas_remove_indices
-from dunetoolkit.query_class import Query
+from dunetoolkit.validate import get_validator, validate_meas_remove_indices
+from dunetoolkit.query_class import Query, QUERY_COLLATION, query_complexity
+from dunetoolkit.search_fields import SEARCH_FIELD, NORMALIZED_FIELDS, build_search_fields
+from dunetoolkit.unit_conversion import add_si_values
+from dunetoolkit.result_cache import get_result_cache, result_cache_key, get_cached_result, cache_result, bump_collection_generation
 
 ##########################################
 # IN ORDER TO CONNECT TO DB:
 # ssh -L 27017:localhost:27017 bgtest01
 ##########################################
 
+# named projection profiles that can be passed as the "projection" argument of the search functions
+PROJECTIONS = {
+    # just enough of each document to render one row of the search page's result list
+    "summary": {
+        "grouping": 1,
+        "sample.name": 1,
+        "measurement.results.isotope": 1,
+        "measurement.results.type": 1,
+        "measurement.results.unit": 1,
+        "measurement.results.value": 1
+    },
+    # only the measurement results, for flattening into a table of results (see search_results_table)
+    "results": {
+        "measurement.results.isotope": 1,
+        "measurement.results.type": 1,
+        "measurement.results.unit": 1,
+        "measurement.results.value": 1
+    }
+}
+
+# the columns of the table made by search_results_table. Each measurement value list has at most three values (the central value and up to two uncertainties or bounds), so each one gets its own column.
+RESULTS_TABLE_COLUMNS = ["doc_id", "isotope", "type", "unit", "value_0", "value_1", "value_2"]
+
+
+# the collection types (besides the main assays collection, type "") that _get_specified_collection resolves. Each is stored in the collection named "assays_" followed by the type.
+COLLECTION_TYPES = ['old_versions', 'assay_requests', 'assay_requests_old_versions']
+
+# the fields that facet_counts() counts the matching documents by, by default
+FACET_FIELDS = ["grouping", "measurement.results.isotope", "measurement.institution", "measurement.technique"]
+
+# optional keys of the toolkit config JSON file that are passed through to pymongo.MongoClient
+CLIENT_OPTION_NAMES = {
+    "max_pool_size": "maxPoolSize",
+    "min_pool_size": "minPoolSize",
+    "max_idle_time_ms": "maxIdleTimeMS",
+    "wait_queue_timeout_ms": "waitQueueTimeoutMS",
+    "connect_timeout_ms": "connectTimeoutMS",
+    "server_selection_timeout_ms": "serverSelectionTimeoutMS",
+    "socket_timeout_ms": "socketTimeoutMS"
+}
+
+# the indexes that the searches rely on, which are created on the assay collections by ensure_indexes(). Each one is a dict with the index name, its keys (as a list of (field, direction) pairs, like pymongo's create_index takes), and any extra index options. Searches are run with QUERY_COLLATION, and MongoDB can only use an index for string comparisons if the index has the same collation, so every index except the text index (which does not support collations) is created with it.
+ASSAY_INDEXES = [
+    # used by the "all" field, which does a $text search over every string field of the documents
+    {
+        "name": "all_text",
+        "keys": [("$**", TEXT)],
+        "options": {}
+    },
+    # used by measurement results terms, which match all three of these fields of one element of measurement.results with $elemMatch. Only the first element of the value is indexed, since it is the one that most terms compare against, and indexing the whole value array as well would make this an index over nested arrays.
+    {
+        "name": "measurement_results",
+        "keys": [("measurement.results.isotope", ASCENDING), ("measurement.results.type", ASCENDING), ("measurement.results.value.0", ASCENDING)],
+        "options": {"collation": QUERY_COLLATION}
+    },
+    # used by measurement results terms that specify a unit when queries are compiled against the SI values of the measurement results (see the unit_conversion module)
+    {
+        "name": "measurement_results_si",
+        "keys": [("measurement.results.isotope", ASCENDING), ("measurement.results.unit_si", ASCENDING), ("measurement.results.type", ASCENDING), ("measurement.results.value_si.0", ASCENDING)],
+        "options": {"collation": QUERY_COLLATION}
+    },
+    # used by "equals" terms on the fields that are most often searched for by exact name
+    {
+        "name": "grouping",
+        "keys": [("grouping", ASCENDING)],
+        "options": {"collation": QUERY_COLLATION}
+    },
+    {
+        "name": "sample_name",
+        "keys": [("sample.name", ASCENDING)],
+        "options": {"collation": QUERY_COLLATION}
+    },
+    # used by string terms when queries are compiled against the normalized "_search" sub-documents (see the search_fields module). A wildcard index covers the normalized copies of every field with one index.
+    {
+        "name": "search_fields",
+        "keys": [(SEARCH_FIELD+".$**", ASCENDING)],
+        "options": {"collation": QUERY_COLLATION}
+    },
+    # used by measurement date and data input date terms, which compare against the first date in the list
+    {
+        "name": "measurement_date",
+        "keys": [("measurement.date.0", ASCENDING)],
+        "options": {"collation": QUERY_COLLATION}
+    },
+    {
+        "name": "data_source_input_date",
+        "keys": [("data_source.input.date.0", ASCENDING)],
+        "options": {"collation": QUERY_COLLATION}
+    }
+]
 
-def _configure():
-    """Reads the contents of the config JSON file at the path specified in the environment variable named `TOOLKIT_CONFIG_NAME`, then parses out the information and returns it. If no path is specified with the environment variable `TOOLKIT_CONFIG_NAME`, then this defaults to a file named toolkit_config.json in the dunetoolkit directory.
+# parsed config files, keyed by absolute path, so that the config is only re-read when the file changes
+_config_cache = {}
+
+# database objects backed by one MongoClient each, keyed by (host, port, database name, client options). They are shared by every toolkit call in the process that does not pass in its own db_obj.
+_db_obj_registry = {}
+_db_obj_registry_lock = threading.Lock()
+_db_obj_registry_pid = os.getpid()
+
+# MongoClients that have been found to not support transactions (e.g. because they are connected to a standalone server instead of a replica set), so that updates do not keep trying to start transactions with them
+_clients_without_transactions = weakref.WeakKeyDictionary()
+
+# the error message returned when a document is changed by someone else while it is being updated
+CONCURRENT_UPDATE_MSG = 'the document was changed by someone else while it was being updated. Please reload it and try again'
+
+
+def _load_config():
+    """Reads and parses the config JSON file at the path specified in the environment variable named `TOOLKIT_CONFIG_NAME`. If no path is specified with the environment variable `TOOLKIT_CONFIG_NAME`, then this defaults to a file named toolkit_config.json in the dunetoolkit directory. The parsed file is cached, and is only read again if the file's modification time changes.
 
     returns:
-        * str. The hostname of the machine where MongoDB is running.
-        * str. The port number that can be used to connect to MongoDB on the host.
-        * str. The name of the MongoDB database to use for queries.
+        * dict. The contents of the config file.
     """
     config_name = os.getenv('TOOLKIT_CONFIG_NAME')
     if config_name is None:
         config_name = os.path.dirname(os.path.abspath(__file__)) + '/toolkit_config.json'
-    config_dict = None
+    config_path = os.path.abspath(config_name)
 
-    with open(config_name, 'r') as config:
+    mtime = os.path.getmtime(config_path)
+    cached = _config_cache.get(config_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(config_path, 'r') as config:
         config_dict = json.load(config)
+    _config_cache[config_path] = (mtime, config_dict)
+    return config_dict
+
+def _configure():
+    """Reads the contents of the config JSON file at the path specified in the environment variable named `TOOLKIT_CONFIG_NAME`, then parses out the information and returns it. If no path is specified with the environment variable `TOOLKIT_CONFIG_NAME`, then this defaults to a file named toolkit_config.json in the dunetoolkit directory.
 
+    returns:
+        * str. The hostname of the machine where MongoDB is running.
+        * str. The port number that can be used to connect to MongoDB on the host.
+        * str. The name of the MongoDB database to use for queries.
+    """
+    config_dict = _load_config()
     return config_dict['mongodb_host'], config_dict['mongodb_port'], config_dict['database']
 
+def _get_client_options():
+    """Parses the optional connection pool and timeout settings out of the config JSON file. The supported keys are the keys of CLIENT_OPTION_NAMES (e.g. "max_pool_size" or "server_selection_timeout_ms"); any that are not present in the config file are left at pymongo's defaults.
+
+    returns:
+        * dict. The keyword arguments to pass to pymongo.MongoClient.
+    """
+    config_dict = _load_config()
+    client_options = {}
+    for config_key, client_key in CLIENT_OPTION_NAMES.items():
+        if config_dict.get(config_key) is not None:
+            client_options[client_key] = config_dict[config_key]
+    return client_options
+
+def _reset_db_obj_registry():
+    """Forgets all of the cached database objects, so that new MongoClients are created the next time they are needed. This is called in a child process after a fork (e.g. in gunicorn workers), because a MongoClient's connections and monitor threads cannot be shared with the parent process.
+    """
+    global _db_obj_registry_lock, _db_obj_registry_pid
+    _db_obj_registry.clear()
+    _db_obj_registry_lock = threading.Lock()
+    _db_obj_registry_pid = os.getpid()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_db_obj_registry)
+
 def _create_db_obj():
-    """This function is useful when the python toolkit is being used directly by the user, instead of in conjunction with the UI. The UI is responsible for creating a persisting, shared database connection and passing it to functions as needed. When the search, insert, and update python functions are being called directly, no existing database connection is required, so this function gets called to set one up.
+    """This function is useful when the python toolkit is being used directly by the user, instead of in conjunction with the UI. The UI is responsible for creating a persisting, shared database connection and passing it to functions as needed. When the search, insert, and update python functions are being called directly, no existing database connection is required, so this function gets called to get one.
+
+    The database object (and the MongoClient behind it, with its connection pool) is only created the first time it is needed for a given host, port, database, and set of client options. After that, the same object is returned by every call in the process, so repeated toolkit calls do not need to reconnect to MongoDB.
 
     returns:
         pymongo.database.Database. A pymongo database object that, once a collection has been selected, can be used to query.
     """
-    # TODO: use a config object, access it with an environment variable (just like with the UI). If scripting, create a configure() function
     mongo_host, mongo_port, db_name = _configure()
+    client_options = _get_client_options()
+    registry_key = (mongo_host, mongo_port, db_name, tuple(sorted(client_options.items())))
+
+    # register_at_fork is not available on every platform, so also check for a fork here
+    if _db_obj_registry_pid != os.getpid():
+        _reset_db_obj_registry()
 
-    client = MongoClient(mongo_host, mongo_port)
-    db_obj = client[db_name]
+    db_obj = _db_obj_registry.get(registry_key)
+    if db_obj is None:
+        with _db_obj_registry_lock:
+            db_obj = _db_obj_registry.get(registry_key)
+            if db_obj is None:
+                client = MongoClient(mongo_host, mongo_port, **client_options)
+                db_obj = client[db_name]
+                _db_obj_registry[registry_key] = db_obj
     return db_obj
 
 
 def _get_specified_collection(collection_name, db_obj):
-    """Selects the proper MongoDB collection object based on the collection type specified by the user (collection_name is not the full collection name, just the suffix. E.g. if the actual collection name is "dune_data", then passing "assay_requests" as the collection_name would cause this function to return the collection object with name "dune_data_assay_requests")
+    """Selects the proper MongoDB collection object based on the collection type specified by the user (collection_name is not the full collection name, just the suffix. E.g. if the actual collection name is "dune_data", then passing "assay_requests" as the collection_name would cause this function to return the collection object with name "dune_data_assay_requests"). Collection types that are not in COLLECTION_TYPES resolve to the main assays collection.
 
     args:
         * collection_name (str): The type of the database collection to use.
@@ -64,12 +227,95 @@ def _get_specified_collection(collection_name, db_obj):
     returns:
         * pymongo.collection.Collection. The MongoDB collection specified by the user.
     """
-    if collection_name == 'old_versions':
-        collection = db_obj.assays_old_versions
+    if collection_name in COLLECTION_TYPES:
+        collection = db_obj['assays_'+collection_name]
     else:
         collection = db_obj.assays
     return collection
 
+def _find_matching_index(index_spec, index_info):
+    """Looks for an existing index on a collection that matches one of the specs in ASSAY_INDEXES. Regular indexes match if they have the same keys in the same order and the same collation locale and strength. Since a collection can only have one text index, any existing text index matches a text index spec, whatever its name or fields are.
+
+    args:
+        * index_spec (dict): One of the elements of ASSAY_INDEXES.
+        * index_info (dict): The existing indexes of the collection, as returned by pymongo.collection.Collection.index_information().
+
+    returns:
+        * str. The name of the matching index, or None if there is no matching index.
+    """
+    is_text_spec = any([ direction == TEXT for field, direction in index_spec['keys'] ])
+    spec_collation = index_spec['options'].get('collation', {})
+    for index_name, index_details in index_info.items():
+        index_keys = [ (field, direction) for field, direction in index_details['key'] ]
+        if is_text_spec and ('_fts', 'text') in index_keys:
+            return index_name
+        if index_keys != [ (field, direction) for field, direction in index_spec['keys'] ]:
+            continue
+        # the server fills in every collation option that was not given, so only compare the ones in the spec
+        index_collation = index_details.get('collation', {})
+        if all([ index_collation.get(option) == option_value for option, option_value in spec_collation.items() ]):
+            return index_name
+    return None
+
+def _find_unused_indexes(collection):
+    """Uses the $indexStats aggregation stage to find the indexes of a collection that have not been used by any query since the MongoDB server last started. The default "_id_" index is never reported.
+
+    args:
+        * collection (pymongo.collection.Collection): The collection to check.
+
+    returns:
+        * list of str. The names of the unused indexes, or None if the index usage could not be read (e.g. if the database user is not allowed to run $indexStats).
+    """
+    try:
+        index_stats = list(collection.aggregate([{"$indexStats":{}}]))
+    except Exception as e:
+        print('WARNING: could not read index usage: '+str(e))
+        return None
+    unused_indexes = []
+    for index_stat in index_stats:
+        if index_stat.get('name') != '_id_' and index_stat.get('accesses', {}).get('ops', 0) == 0:
+            unused_indexes.append(index_stat['name'])
+    return sorted(unused_indexes)
+
+def ensure_indexes(db_obj=None, coll_type='', create=True):
+    """Makes sure that a collection of assays has all of the indexes in ASSAY_INDEXES, which the searches rely on to avoid scanning the whole collection (and which the "all" field needs in order to work at all). Indexes that already exist are left as they are, so this function is safe to run every time the database is deployed or the toolkit is updated. It also reports which indexes are not being used by any queries, so that they can be considered for removal.
+
+    args:
+        * db_obj (pymongo.database.Database) (optional): The database object to use. If not present, one is created from the toolkit config file.
+        * coll_type (str) (optional): The type of collection to index (e.g. "old_versions"). If not present, the main assays collection is used.
+        * create (bool) (optional): If False, no indexes are created, and the indexes that would have been created are reported as missing. Defaults to True.
+
+    returns:
+        * dict. A report with the following keys:
+            * "created" (list of str): The names of the indexes that were created.
+            * "existing" (list of str): The names of the indexes in ASSAY_INDEXES that already existed.
+            * "missing" (list of str): The names of the indexes in ASSAY_INDEXES that do not exist (because create was False or because they could not be created).
+            * "errors" (dict): The error message for each index that could not be created, keyed by index name.
+            * "unused" (list of str): The names of all indexes on the collection that have not been used since the MongoDB server last started, or None if this could not be determined.
+    """
+    if db_obj is None:
+        db_obj = _create_db_obj()
+    collection = _get_specified_collection(coll_type, db_obj)
+
+    report = {"created":[], "existing":[], "missing":[], "errors":{}, "unused":None}
+    index_info = collection.index_information()
+    for index_spec in ASSAY_INDEXES:
+        existing_name = _find_matching_index(index_spec, index_info)
+        if existing_name is not None:
+            report['existing'].append(index_spec['name'])
+        elif not create:
+            report['missing'].append(index_spec['name'])
+        else:
+            try:
+                collection.create_index(index_spec['keys'], name=index_spec['name'], **index_spec['options'])
+                report['created'].append(index_spec['name'])
+            except OperationFailure as e:
+                report['missing'].append(index_spec['name'])
+                report['errors'][index_spec['name']] = str(e)
+
+    report['unused'] = _find_unused_indexes(collection)
+    return report
+
 
 def create_query_object(query_string=None):
     """Creates a Query object that is used to parse queries, add to queries, and translate between human-readable and pymongo-syntax queries.
@@ -83,45 +329,234 @@ def create_query_object(query_string=None):
     return Query(query_string)
 
 
-def search(query, db_obj=None, coll_type=""):
-    """Queries the specified MongoDB collection in order to find the documents that fit the given query
+def _to_query_dict(query):
+    """Converts the query argument of the search functions into a pymongo query dict. The user can enter a string or dict query; if it is a string, it is parsed into a dict with the Query class.
 
     args:
         * query (str or dict): If "query" is a string, it is translated into a pymongo query dict. Otherwise, it is assumed to be a pymongo query dict that can be used as-is to query the collection.
-        * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
-        * coll_type (str) (optional): Dictates which database collection will queried. If no value is provided, this function queries the main assay collection by default (as opposed to old_versions).
 
     returns:
-        * list of dict. The documents found in the MongoDB collection using the provided query.
+        * dict. The query in pymongo query language.
     """
-    # user can enter a string or dict query. If string, we parse it into a dict.
     if type(query) is str:
         q_obj = Query(query)
         query = q_obj.to_query_language()
-    '''
-    if type(query) is not dict:
-        print("Error: the query argument must be a dictionary.")
+    return query
+
+
+def _resolve_projection(projection):
+    """Converts the projection argument of the search functions into a pymongo projection dict.
+
+    args:
+        * projection (str or dict or None): If "projection" is a string, it must be the name of one of the profiles in PROJECTIONS (e.g. "summary"). If it is a dict, it is assumed to be a pymongo projection dict that can be used as-is. If it is None, the full documents are returned.
+
+    returns:
+        * dict. The projection in pymongo syntax (a copy of the profile, for a profile name), or None if the full documents should be returned.
+    """
+    # profiles are copied, since some drivers (e.g. mongomock) add "_id" to the projection they are given, which would change the profile and the result cache keys made from it
+    if type(projection) is str:
+        projection = dict(PROJECTIONS[projection])
+    return projection
+
+
+def _add_resume_token(query, after_id):
+    """Adds a keyset pagination constraint to a pymongo query so that only documents whose ID comes after the given resume token are matched. Since MongoDB ObjectIds are always indexed, this lets a page be found with an index seek rather than by skipping over all the documents of the earlier pages.
+
+    args:
+        * query (dict): The query in pymongo query language.
+        * after_id (str or bson.objectid.ObjectId): The database ID of the last document of the previous page.
+
+    returns:
+        * dict. The query with the resume token constraint added. If the resume token is not a valid MongoDB ObjectId, this returns None.
+    """
+    try:
+        after_id = ObjectId(after_id)
+    except:
+        print("Error: you did not enter a valid MongoDB ObjectId string for the resume token.")
         return None
-    '''
+    id_term = {'_id':{'$gt':after_id}}
+    if query == {}:
+        return id_term
+    return {'$and':[query, id_term]}
+
+
+def iter_search(query, db_obj=None, coll_type="", after_id=None, limit=0, batch_size=None, projection=None):
+    """Queries the specified MongoDB collection in order to find the documents that fit the given query and yields them one at a time as they are read from the database cursor. Unlike search, this never holds the entire result set in memory, so it should be used for broad queries (e.g. "all contains steel") over a large collection. If a resume token (after_id) or a limit is given, the documents are yielded in order of their database ID so that the results can be paged through with keyset pagination (see search_page).
+
+    args:
+        * query (str or dict): If "query" is a string, it is translated into a pymongo query dict. Otherwise, it is assumed to be a pymongo query dict that can be used as-is to query the collection.
+        * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): Dictates which database collection will queried. If no value is provided, this function queries the main assay collection by default (as opposed to old_versions).
+        * after_id (str) (optional): The database ID of the last document that the caller has already seen. If provided, only documents with a larger ID are yielded.
+        * limit (int) (optional): The maximum number of documents to yield. If 0 (the default), all matching documents are yielded.
+        * batch_size (int) (optional): The number of documents the MongoDB cursor fetches per round trip. If not provided, the pymongo default is used.
+        * projection (str or dict) (optional): The fields of each document to return. This can be the name of one of the profiles in PROJECTIONS (e.g. "summary") or a pymongo projection dict. If not provided, the full documents are returned.
+
+    yields:
+        * dict. Each document found in the MongoDB collection using the provided query, with its "_id" converted into a string.
+    """
+    query = _to_query_dict(query)
+    if after_id is not None:
+        query = _add_resume_token(query, after_id)
+        if query is None:
+            return
+
     if db_obj is None:
         db_obj = _create_db_obj()
     collection = _get_specified_collection(coll_type, db_obj)
-    
-    resp = collection.find(query)
-    resp = list(resp)
-    for i, ele in enumerate(resp):
-        ele['_id'] = str(ele['_id'])
-        resp[i] = ele
-    return resp
+
+    cursor = collection.find(query, _resolve_projection(projection), collation=QUERY_COLLATION)
+    if after_id is not None or limit > 0:
+        cursor = cursor.sort('_id', 1)
+    if limit > 0:
+        cursor = cursor.limit(limit)
+    if batch_size is not None:
+        cursor = cursor.batch_size(batch_size)
+
+    for doc in cursor:
+        doc['_id'] = str(doc['_id'])
+        yield doc
+
+
+def search_page(query, db_obj=None, coll_type="", page_size=50, after_id=None, projection=None, use_cache=True):
+    """Queries the specified MongoDB collection for one page of the documents that fit the given query. Pages are ordered by database ID and are found with keyset pagination: the ID of the last document in a page is returned as the resume token, and passing it back as "after_id" returns the following page. This keeps the memory used per call bounded by the page size no matter how many documents match the query.
+
+    args:
+        * query (str or dict): If "query" is a string, it is translated into a pymongo query dict. Otherwise, it is assumed to be a pymongo query dict that can be used as-is to query the collection.
+        * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): Dictates which database collection will queried. If no value is provided, this function queries the main assay collection by default (as opposed to old_versions).
+        * page_size (int) (optional): The maximum number of documents to return in the page.
+        * after_id (str) (optional): The resume token returned with the previous page. If not provided, the first page is returned.
+        * projection (str or dict) (optional): The fields of each document to return. This can be the name of one of the profiles in PROJECTIONS (e.g. "summary") or a pymongo projection dict. If not provided, the full documents are returned.
+        * use_cache (bool) (optional): If True (the default) and result caching is on (see the result_cache module), a page that was found recently by the same query is returned without querying the database. If False, the database is always queried.
+
+    returns:
+        * list of dict. The documents in this page of results.
+        * str. The resume token to pass as "after_id" to get the next page. If there are no more pages, this is None.
+    """
+    cache = get_result_cache() if use_cache else None
+    if cache is not None:
+        query = _to_query_dict(query)
+        if db_obj is None:
+            db_obj = _create_db_obj()
+        cache_key = result_cache_key(cache, _get_specified_collection(coll_type, db_obj), ('search_page', query, _resolve_projection(projection), page_size, after_id))
+        page = get_cached_result(cache, cache_key)
+        if page is not None:
+            return page
+
+    # fetch one extra document to find out whether there is another page without a second query
+    docs = list(iter_search(query, db_obj, coll_type, after_id=after_id, limit=page_size+1, projection=projection))
+    next_after_id = None
+    if len(docs) > page_size:
+        docs = docs[:page_size]
+        next_after_id = docs[-1]['_id']
+
+    if cache is not None:
+        cache_result(cache, cache_key, (docs, next_after_id))
+    return docs, next_after_id
+
+
+def _find_plan_stages(plan, stages=None):
+    """Collects every stage of a MongoDB query plan (as found in the output of the explain command), depth first.
+
+    args:
+        * plan (dict): The query plan, or one of its stages.
+        * stages (list of dict) (optional): The stages collected so far.
+
+    returns:
+        * list of dict. The stages.
+    """
+    if stages is None:
+        stages = []
+    stages.append(plan)
+    if 'inputStage' in plan:
+        _find_plan_stages(plan['inputStage'], stages)
+    for input_stage in plan.get('inputStages', []):
+        _find_plan_stages(input_stage, stages)
+    return stages
+
+def _summarize_explain(explain_doc, query):
+    """Picks the parts of the output of the MongoDB explain command that show why a search is fast or slow.
+
+    args:
+        * explain_doc (dict): The output of the explain command, run with the "executionStats" (or "allPlansExecution") verbosity.
+        * query (dict): The pymongo query that was explained.
+
+    returns:
+        * dict. The query ("filter"), the winning plan ("winning_plan"), the stages of the winning plan in order from the first stage that reads documents or index keys to the last ("stages"), the names of the indexes the winning plan uses ("indexes_used", which is empty for a collection scan), the number of plans that were rejected ("rejected_plans"), the numbers of index keys examined ("keys_examined"), documents examined ("docs_examined"), and documents returned ("docs_returned"), the server's execution time in milliseconds ("execution_time_ms"), and the complexity of the query ("complexity"; see query_class.query_complexity).
+    """
+    query_planner = explain_doc.get('queryPlanner', {})
+    winning_plan = query_planner.get('winningPlan', {})
+    # the slot-based execution engine nests the classic plan under "queryPlan"
+    winning_plan = winning_plan.get('queryPlan', winning_plan)
+    stages = _find_plan_stages(winning_plan)
+    execution_stats = explain_doc.get('executionStats', {})
+
+    indexes_used = []
+    for stage in stages:
+        if 'indexName' in stage and stage['indexName'] not in indexes_used:
+            indexes_used.append(stage['indexName'])
+
+    return {
+        "filter": query,
+        "winning_plan": winning_plan,
+        "stages": [ stage.get('stage') for stage in reversed(stages) ],
+        "indexes_used": indexes_used,
+        "rejected_plans": len(query_planner.get('rejectedPlans', [])),
+        "keys_examined": execution_stats.get('totalKeysExamined'),
+        "docs_examined": execution_stats.get('totalDocsExamined'),
+        "docs_returned": execution_stats.get('nReturned'),
+        "execution_time_ms": execution_stats.get('executionTimeMillis'),
+        "complexity": query_complexity(query)
+    }
+
+
+def search(query, db_obj=None, coll_type="", projection=None, use_cache=True, explain=False):
+    """Queries the specified MongoDB collection in order to find the documents that fit the given query
+
+    args:
+        * query (str or dict): If "query" is a string, it is translated into a pymongo query dict. Otherwise, it is assumed to be a pymongo query dict that can be used as-is to query the collection.
+        * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): Dictates which database collection will queried. If no value is provided, this function queries the main assay collection by default (as opposed to old_versions).
+        * projection (str or dict) (optional): The fields of each document to return. This can be the name of one of the profiles in PROJECTIONS (e.g. "summary") or a pymongo projection dict. If not provided, the full documents are returned.
+        * use_cache (bool) (optional): If True (the default) and result caching is on (see the result_cache module), the documents found recently by the same query are returned without querying the database. If False, the database is always queried.
+        * explain (bool) (optional): If True, the search is run with the MongoDB explain command, and a summary of how the database ran it (see _summarize_explain) is returned instead of the documents. This is never cached.
+
+    returns:
+        * list of dict. The documents found in the MongoDB collection using the provided query. If explain is True, this is a dict with the summary of the query plan and execution statistics instead.
+    """
+    if explain:
+        query = _to_query_dict(query)
+        if db_obj is None:
+            db_obj = _create_db_obj()
+        collection = _get_specified_collection(coll_type, db_obj)
+        explain_doc = collection.find(query, _resolve_projection(projection), collation=QUERY_COLLATION).explain()
+        return _summarize_explain(explain_doc, query)
+
+    cache = get_result_cache() if use_cache else None
+    if cache is None:
+        return list(iter_search(query, db_obj, coll_type, projection=projection))
+
+    # the key is made before querying, so that if the collection is written to during the query, the result is stored under the old generation and never used
+    query = _to_query_dict(query)
+    if db_obj is None:
+        db_obj = _create_db_obj()
+    cache_key = result_cache_key(cache, _get_specified_collection(coll_type, db_obj), ('search', query, _resolve_projection(projection)))
+    docs = get_cached_result(cache, cache_key)
+    if docs is None:
+        docs = list(iter_search(query, db_obj, coll_type, projection=projection))
+        cache_result(cache, cache_key, docs)
+    return docs
 
 
-def search_by_id(doc_id, db_obj=None, coll_type=""):
+def search_by_id(doc_id, db_obj=None, coll_type="", projection=None):
     """Queries the specified MongoDB collection in order to find the document with the specified doc_id.
     
     args:
         * doc_id (str): The string representation of the MongoDB document ID for the document the user wishes to find.
         * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
         * coll_type (str) (optional): Dictates which database collection will queried. If no value is provided, this function queries the main assay collection by default (as opposed to old_versions).
+        * projection (str or dict) (optional): The fields of the document to return. This can be the name of one of the profiles in PROJECTIONS (e.g. "summary") or a pymongo projection dict. If not provided, the full document is returned.
 
     returns:
         * dict. The document found by in the MongoDB collection with the given document ID. If no document is found with a matching ID, then None is returned.
@@ -136,7 +571,7 @@ def search_by_id(doc_id, db_obj=None, coll_type=""):
     if db_obj is None:
         db_obj = _create_db_obj()
     collection = _get_specified_collection(coll_type, db_obj)
-    resp = collection.find(q)
+    resp = collection.find(q, _resolve_projection(projection))
     resp = list(resp)
 
     if len(resp) > 1:
@@ -148,6 +583,148 @@ def search_by_id(doc_id, db_obj=None, coll_type=""):
 
     return ret_doc
 
+
+def count(query, db_obj=None, coll_type=""):
+    """Counts the documents in the specified MongoDB collection that fit the given query, without transferring any of them from the database.
+
+    args:
+        * query (str or dict): If "query" is a string, it is translated into a pymongo query dict. Otherwise, it is assumed to be a pymongo query dict that can be used as-is to query the collection.
+        * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): Dictates which database collection will queried. If no value is provided, this function queries the main assay collection by default (as opposed to old_versions).
+
+    returns:
+        * int. The number of documents that fit the query.
+    """
+    query = _to_query_dict(query)
+    if db_obj is None:
+        db_obj = _create_db_obj()
+    collection = _get_specified_collection(coll_type, db_obj)
+    return collection.count_documents(query, collation=QUERY_COLLATION)
+
+
+def _facet_pipeline(field, limit):
+    """Creates the aggregation pipeline that counts the documents by the values of one field, for one of the sub-pipelines of the $facet stage in facet_counts. For fields inside the measurement results list, each document is only counted once for each distinct value it has (e.g. a document with two "K-40" results counts once towards "K-40").
+
+    args:
+        * field (str): The field to count the documents by.
+        * limit (int): The maximum number of values to count. The most common values are kept.
+
+    returns:
+        * list of dict. The aggregation pipeline.
+    """
+    if field.startswith('measurement.results.'):
+        pipeline = [
+            {'$project':{'value':{'$setUnion':[{'$ifNull':['$'+field, []]}, []]}}},
+            {'$unwind':'$value'}
+        ]
+    else:
+        pipeline = [{'$project':{'value':'$'+field}}]
+    pipeline += [
+        {'$group':{'_id':'$value', 'count':{'$sum':1}}},
+        {'$sort':{'count':-1, '_id':1}},
+        {'$limit':limit}
+    ]
+    return pipeline
+
+
+def facet_counts(query, db_obj=None, coll_type="", facet_fields=None, limit=20):
+    """Counts the documents in the specified MongoDB collection that fit the given query, in total and by the values of each of the facet fields, with one aggregation (a $facet stage) instead of by fetching the documents. This lets the search page show how the results break down before the user refines their query.
+
+    args:
+        * query (str or dict): If "query" is a string, it is translated into a pymongo query dict. Otherwise, it is assumed to be a pymongo query dict that can be used as-is to query the collection.
+        * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): Dictates which database collection will queried. If no value is provided, this function queries the main assay collection by default (as opposed to old_versions).
+        * facet_fields (list of str) (optional): The fields to count the documents by. If not provided, FACET_FIELDS is used.
+        * limit (int) (optional): The maximum number of values to return for each facet field. The most common values are kept.
+
+    returns:
+        * dict. A dict with the keys "total" (int, the number of documents that fit the query) and "facets" (dict, with a list for each facet field of {"value":<field value>, "count":<number of documents>} dicts, most common value first).
+    """
+    if facet_fields is None:
+        facet_fields = FACET_FIELDS
+    query = _to_query_dict(query)
+    if db_obj is None:
+        db_obj = _create_db_obj()
+    collection = _get_specified_collection(coll_type, db_obj)
+
+    # the output fields of a $facet stage cannot contain "."
+    facet_names = { field:'facet_'+str(i) for i, field in enumerate(facet_fields) }
+    facet_stage = { facet_names[field]:_facet_pipeline(field, limit) for field in facet_fields }
+    facet_stage['total'] = [{'$count':'count'}]
+    pipeline = [{'$match':query}, {'$facet':facet_stage}]
+
+    facet_results = list(collection.aggregate(pipeline, collation=QUERY_COLLATION))[0]
+    total = facet_results['total'][0]['count'] if len(facet_results['total']) > 0 else 0
+    facets = {}
+    for field in facet_fields:
+        facets[field] = [ {'value':ele['_id'], 'count':ele['count']} for ele in facet_results[facet_names[field]] ]
+    return {'total':total, 'facets':facets}
+
+def _import_optional(module_name, output):
+    """Imports one of the optional packages that search_results_table needs for some of its output formats. These packages are not requirements of the toolkit, so they are only imported when that output format is asked for.
+
+    args:
+        * module_name (str): The name of the package to import (e.g. "numpy").
+        * output (str): The output format that needs the package, which is used in the error message.
+
+    returns:
+        * module. The imported package, or None if it is not installed.
+    """
+    try:
+        return __import__(module_name)
+    except ImportError:
+        print('Error: the "'+output+'" output format requires the '+module_name+' package, which is not installed.')
+        return None
+
+
+def search_results_table(query, db_obj=None, coll_type="", output="dict"):
+    """Queries the specified MongoDB collection for the documents that fit the given query and flattens their measurement results into a table with one row per result and the columns in RESULTS_TABLE_COLUMNS. The table is built in one pass over the database cursor, and only the measurement results are transferred from the database, so calculations over thousands of assays (e.g. background budgets) can be done with array operations instead of by walking through each document's results.
+
+    args:
+        * query (str or dict): If "query" is a string, it is translated into a pymongo query dict. Otherwise, it is assumed to be a pymongo query dict that can be used as-is to query the collection.
+        * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): Dictates which database collection will queried. If no value is provided, this function queries the main assay collection by default (as opposed to old_versions).
+        * output (str) (optional): The format of the table. Must be one of:
+            * "dict" (the default): a dict of lists, keyed by column name. Values that a result does not have are None.
+            * "numpy": a dict of numpy arrays, keyed by column name. The value columns are float arrays, with NaN for values that a result does not have. Requires numpy.
+            * "pandas": a pandas DataFrame, with NaN for values that a result does not have. Requires pandas.
+            * "arrow": a pyarrow Table, with nulls for values that a result does not have. Requires pyarrow.
+
+    returns:
+        * dict or pandas.DataFrame or pyarrow.Table. The table of measurement results, in the requested format. If the output format is not valid or the package it needs is not installed, None is returned.
+    """
+    if output not in ["dict", "numpy", "pandas", "arrow"]:
+        print('Error: the output format must be one of "dict", "numpy", "pandas", or "arrow".')
+        return None
+    table_module = None
+    if output != "dict":
+        table_module = _import_optional({"numpy":"numpy", "pandas":"pandas", "arrow":"pyarrow"}[output], output)
+        if table_module is None:
+            return None
+
+    doc_ids, isotopes, meas_types, units = [], [], [], []
+    values = [[], [], []]
+    for doc in iter_search(query, db_obj, coll_type, projection="results"):
+        for result in doc.get('measurement', {}).get('results', []):
+            doc_ids.append(doc['_id'])
+            isotopes.append(result.get('isotope'))
+            meas_types.append(result.get('type'))
+            units.append(result.get('unit'))
+            result_values = result.get('value', [])
+            for i, value_column in enumerate(values):
+                value_column.append(result_values[i] if i < len(result_values) else None)
+
+    columns = dict(zip(RESULTS_TABLE_COLUMNS, [doc_ids, isotopes, meas_types, units] + values))
+    if output == "numpy":
+        columns = { name:table_module.array(column, dtype=float if name.startswith('value_') else object) for name, column in columns.items() }
+    elif output == "pandas":
+        columns = table_module.DataFrame(columns, columns=RESULTS_TABLE_COLUMNS)
+        for name in RESULTS_TABLE_COLUMNS[4:]:
+            columns[name] = columns[name].astype(float)
+    elif output == "arrow":
+        columns = table_module.table({ name:table_module.array(column, type=table_module.float64() if name.startswith('value_') else table_module.string()) for name, column in columns.items() })
+    return columns
+
 #'''
 def _get_existing_doc(doc_id, db_obj, update_from_coll_name):
     """This is a helper function for updating documents in the collection. It queries the database in order to find the document with the specified doc_id.
@@ -160,11 +737,12 @@ def _get_existing_doc(doc_id, db_obj, update_from_coll_name):
     returns:
         * dict. The document found by in the MongoDB collection with the given document ID. If no document is found with a matching ID, then None is returned.
     """
-    #TODO couldn't we just use "search_by_id" for this?
-    parent_q = {'_id':ObjectId(doc_id)}
+    try:
+        parent_q = {'_id':ObjectId(doc_id)}
+    except:
+        return None
     collection = _get_specified_collection(update_from_coll_name, db_obj)
-    parent_resp = collection.find(parent_q)
-    parent_doc = list(parent_resp)[0]
+    parent_doc = collection.find_one(parent_q)
     return parent_doc
 
 def _remove_meas_objects(new_doc, meas_remove_indices):
@@ -197,15 +775,12 @@ def _validate_new_meas_objects(new_meas_objects):
         * bool. Whether all of the dicts in new_meas_objects are valid or not.
         * str. The error message that arose while trying to update new_doc. This would happen if any of the given new_meas_objects are not valid according to this project's specified schema.
     """
-    meas_validator = DuneValidator("measurement_result")
-    is_valid = True
-    error_message = ''
-    for new_meas_obj in new_meas_objects:
-        is_valid, error_message = meas_validator.validate(new_meas_obj)
+    validation_results = get_validator("measurement_result").validate_many(new_meas_objects)
+    for is_valid, error_message in validation_results:
         if not is_valid:
             print(error_message)
             return False, error_message
-    return is_valid, error_message
+    return True, ''
 
 def _add_new_meas_objects(new_doc, new_meas_objects):
     """This is a helper function for updating documents in the collection. Each document in the database has a list of dictionaries under the top-level field "measurements" and the sub-field "results" where each dict in the list represents the measurement result for a given isotope. One of the updates a user can make to a given document is to add new measurement result objects to the existing list of measurement results. This function performs the actual addition of measurement result objects to the document.
@@ -309,17 +884,132 @@ def _update_new_doc(new_doc, meas_remove_indices, new_meas_objects, update_pairs
         return None, error_msg
 
     # validate new doc
-    validator = DuneValidator("whole_record")
+    validator = get_validator("whole_record")
     is_valid, error_message = validator.validate(new_doc)
     if not is_valid:
         print(error_message)
-        return None, error_msg
+        return None, error_message
+
+    # the normalized copies of the string fields and the SI values of the measurement results must match the updated fields
+    new_doc[SEARCH_FIELD] = build_search_fields(new_doc)
+    new_doc['measurement']['results'] = add_si_values(new_doc['measurement']['results'])
 
     return new_doc, ''
 
+class _ConcurrentUpdateError(Exception):
+    """Raised inside an update transaction when the original document is no longer in its collection (with the same version) by the time it is being replaced, which means that it was updated or removed by someone else in the meantime.
+    """
+    pass
+
+def _transactions_unsupported(error):
+    """Checks whether an error that was raised while running a transaction means that the database does not support transactions at all (as opposed to the transaction itself failing).
+
+    args:
+        * error (Exception): The error that was raised.
+
+    returns:
+        * bool. Whether the error means that transactions are not supported.
+    """
+    if isinstance(error, (NotImplementedError, ConfigurationError)):
+        return True
+    if isinstance(error, OperationFailure):
+        # IllegalOperation: "Transaction numbers are only allowed on a replica set member or mongos"
+        return error.code == 20 or 'Transaction numbers are only allowed' in str(error)
+    return False
+
+def _update_databases_in_transaction(new_doc, parent_doc, do_remove_doc, collection, old_versions_collection, original_collection, db_obj):
+    """This is a helper function for _update_databases. It moves the original document to the old versions collection and inserts the new document in one MongoDB transaction, so either all of the changes happen or none of them do. The original document is only removed if it still has the version it had when it was read, so an update that races with another update of the same document fails instead of overwriting it.
+
+    args:
+        * new_doc (dict): The fully updated version of the document, with its new _id already set. This is ignored if do_remove_doc is True.
+        * parent_doc (dict): The "original" version of the document that does not have the specified updates applied.
+        * do_remove_doc (bool): Whether the document is being removed instead of updated.
+        * collection (pymongo.collection.Collection): The collection to insert the new document into.
+        * old_versions_collection (pymongo.collection.Collection): The collection to move the original document to.
+        * original_collection (pymongo.collection.Collection): The collection that the original document is in.
+        * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
+    """
+    parent_q = {'_id':parent_doc['_id'], '_version':parent_doc['_version']}
+
+    def _do_update(session):
+        removeold_resp = original_collection.delete_one(parent_q, session=session)
+        if removeold_resp.deleted_count != 1:
+            raise _ConcurrentUpdateError()
+        old_versions_collection.insert_one(parent_doc, session=session)
+        if not do_remove_doc:
+            collection.insert_one(new_doc, session=session)
+
+    with db_obj.client.start_session() as session:
+        session.with_transaction(_do_update)
+
+def _update_databases_without_transaction(new_doc, parent_doc, do_remove_doc, collection, old_versions_collection, original_collection):
+    """This is a helper function for _update_databases, used when the database does not support transactions (e.g. a standalone MongoDB server). The original document is first copied to the old versions collection; then the new document is inserted and the original document is removed with one ordered bulk write (when they are in the same collection). If any step fails, the steps that already happened are undone.
+
+    args:
+        * new_doc (dict): The fully updated version of the document, with its new _id already set. This is ignored if do_remove_doc is True.
+        * parent_doc (dict): The "original" version of the document that does not have the specified updates applied.
+        * do_remove_doc (bool): Whether the document is being removed instead of updated.
+        * collection (pymongo.collection.Collection): The collection to insert the new document into.
+        * old_versions_collection (pymongo.collection.Collection): The collection to move the original document to.
+        * original_collection (pymongo.collection.Collection): The collection that the original document is in.
+
+    returns:
+        * str. The error message that arose while trying to update the database (empty string if no errors happened).
+    """
+    parent_q = {'_id':parent_doc['_id'], '_version':parent_doc['_version']}
+
+    # archive the original doc first. If someone else already moved it to the old versions collection, this fails with a duplicate key error
+    try:
+        old_versions_collection.insert_one(parent_doc)
+    except OperationFailure as e:
+        if e.code == 11000:
+            return CONCURRENT_UPDATE_MSG
+        return 'unsuccessful update in mongodb'
+    except:
+        return 'unsuccessful update in mongodb'
+
+    if do_remove_doc:
+        ops = [ (original_collection, DeleteOne(parent_q)) ]
+    elif collection == original_collection:
+        ops = [ (collection, [InsertOne(new_doc), DeleteOne(parent_q)]) ]
+    else:
+        ops = [ (collection, InsertOne(new_doc)), (original_collection, DeleteOne(parent_q)) ]
+
+    inserted_new_doc = False
+    deleted_count = 0
+    error_msg = ''
+    for op_collection, op_requests in ops:
+        if type(op_requests) is not list:
+            op_requests = [op_requests]
+        try:
+            bulk_resp = op_collection.bulk_write(op_requests, ordered=True)
+            inserted_new_doc = inserted_new_doc or bulk_resp.inserted_count > 0
+            deleted_count += bulk_resp.deleted_count
+        except BulkWriteError as e:
+            inserted_new_doc = inserted_new_doc or e.details.get('nInserted', 0) > 0
+            error_msg = 'unsuccessful update in mongodb'
+            break
+        except:
+            error_msg = 'unsuccessful update in mongodb'
+            break
+
+    if error_msg == '' and deleted_count != 1:
+        # the original doc was changed or removed by someone else after it was read
+        error_msg = CONCURRENT_UPDATE_MSG
+
+    # clean up database if there was an issue
+    if error_msg != '':
+        if inserted_new_doc:
+            collection.delete_one({'_id':new_doc['_id']})
+        if deleted_count == 0:
+            old_versions_collection.delete_one({'_id':parent_doc['_id'], '_version':parent_doc['_version']})
+    return error_msg
+
 def _update_databases(new_doc, parent_doc, do_remove_doc, db_obj, update_from_coll_name, old_versions_coll_name, move_to_coll_name):
     """This is a helper function for updating documents in the collection. It performs the insertion of the new (updated) doc into the main collection that holds the most current versions of the docs. This function also moves the original version of the doc to the "old-versions" collection for archival purposes. This function is used for any type of update a user might make to the radiopurity database: updating a normal assay doc, updating an assay request doc, or validating an assay request doc. Below in the arg definitions are examples of how each type of update might be specified.
 
+    All of the changes are made in one MongoDB transaction when the database supports transactions (see _update_databases_in_transaction), so the document is never in both or neither of the collections. Otherwise, they are made with as few writes as possible and undone if any of them fail (see _update_databases_without_transaction). In both cases, the update fails if the original document was updated or removed by someone else after it was read. The update also fails, without writing anything, if the old versions collection is the collection the original document is in. Afterwards, any cached search results for the three collections are invalidated (see the result_cache module).
+
     args: 
         * new_doc (dict): The fully updated version of the document. This dict will become the new "current" version of the doc in the main collection.
         * parent_doc (dict): The "original" version of the document that does not have the specified updates applied.
@@ -330,40 +1020,65 @@ def _update_databases(new_doc, parent_doc, do_remove_doc, db_obj, update_from_co
         * move_to_coll_name (str): This arg helps orchestrate what kind of update is happening. It dictates what collection the fully updated document will be added to. If it is a normal update, this would be the main collection. If it is an assay request update, this would be the assay requests database. If it is an assay request validation, this would be the main database (as a validated assay request is ready to be inserted as a normal assay).
 
     returns:
-        * bson.objectid.ObjectId. The MongoDB document ID of the new, fully-updated document that was added into the specified collection.
+        * bson.objectid.ObjectId. The MongoDB document ID of the new, fully-updated document that was added into the specified collection. This is None if the document was removed or if the update failed.
+        * str. The error message that arose while trying to update the database (empty string if no errors happened).
     """
-    new_doc_id = None
-    update_ok = True
-
     collection = _get_specified_collection(move_to_coll_name, db_obj)
     old_versions_collection = _get_specified_collection(old_versions_coll_name, db_obj)
     original_collection = _get_specified_collection(update_from_coll_name, db_obj)
 
-    # if the action is not to remove the entire doc, try to insert it into current versions collection
+    # create the new doc's ID up front so that it is known without another round trip
+    new_doc_id = None
     if not do_remove_doc:
-        try:
-            new_doc_id = collection.insert_one(new_doc).inserted_id
-            update_ok = True
-        except:
-            update_ok = False
+        new_doc_id = ObjectId()
+        new_doc['_id'] = new_doc_id
 
-    # clean up database if there is an issue inserting the new doc
-    if not update_ok:
-        collection.delete_one(new_doc)
-    else:
-        try:
-            # add old doc to old versions collection (unless it's an update of an assay request, in which we don't add the old doc to anything, we just get rid of it)
-            old_versions_collection.insert_one(parent_doc)
-            update_ok = True
-        except:
-            update_ok = False
+    # archiving the original document in the collection it is already in would fail with a duplicate key error (or, in a transaction, put the old version back as a current document)
+    if old_versions_collection.full_name == original_collection.full_name:
+        return None, 'the old versions collection ('+old_versions_collection.full_name+') is the same as the collection the document is updated from'
+
+    try:
+        return _write_update(new_doc, parent_doc, do_remove_doc, db_obj, new_doc_id, collection, old_versions_collection, original_collection)
+    finally:
+        # cached search results for all three collections are invalidated even if the update failed, since a failed update may have been partly written before it was undone
+        for coll in (collection, old_versions_collection, original_collection):
+            bump_collection_generation(coll)
+
+def _write_update(new_doc, parent_doc, do_remove_doc, db_obj, new_doc_id, collection, old_versions_collection, original_collection):
+    """This is a helper function for _update_databases that makes the changes to the collections, in a transaction if the database supports transactions.
 
-        if update_ok:
-            # remove old doc from current versions collection
-            parent_q = {'_id':parent_doc['_id']}
-            removeold_resp = original_collection.delete_one(parent_q)
+    args:
+        * new_doc (dict): The fully updated version of the document, with its new "_id" (unless the doc is being removed).
+        * parent_doc (dict): The "original" version of the document that does not have the specified updates applied.
+        * do_remove_doc (bool): If True, the original document is moved to the old versions collection without inserting a new document.
+        * db_obj (pymongo.database.Database): A pymongo database object whose client is used to start the transaction.
+        * new_doc_id (bson.objectid.ObjectId): The MongoDB document ID of the new document, or None if the doc is being removed.
+        * collection (pymongo.collection.Collection): The collection to insert the new document into.
+        * old_versions_collection (pymongo.collection.Collection): The collection to insert the original document into.
+        * original_collection (pymongo.collection.Collection): The collection to remove the original document from.
 
-    return new_doc_id
+    returns:
+        * bson.objectid.ObjectId. The MongoDB document ID of the new document. This is None if the document was removed or if the update failed.
+        * str. The error message that arose while trying to update the database (empty string if no errors happened).
+    """
+    client = db_obj.client
+    if client not in _clients_without_transactions:
+        try:
+            _update_databases_in_transaction(new_doc, parent_doc, do_remove_doc, collection, old_versions_collection, original_collection, db_obj)
+            return new_doc_id, ''
+        except _ConcurrentUpdateError:
+            return None, CONCURRENT_UPDATE_MSG
+        except Exception as e:
+            if not _transactions_unsupported(e):
+                if isinstance(e, OperationFailure) and e.code == 11000:
+                    return None, CONCURRENT_UPDATE_MSG
+                return None, 'unsuccessful update in mongodb'
+            _clients_without_transactions[client] = True
+
+    error_msg = _update_databases_without_transaction(new_doc, parent_doc, do_remove_doc, collection, old_versions_collection, original_collection)
+    if error_msg != '':
+        return None, error_msg
+    return new_doc_id, ''
 #'''
 
 def update(doc_id, db_obj=None, remove_doc=False, update_pairs={}, new_meas_objects=[], meas_remove_indices=[], is_assay_request_update=False, is_assay_request_verify=False):
@@ -405,6 +1120,8 @@ def update(doc_id, db_obj=None, remove_doc=False, update_pairs={}, new_meas_obje
 
     # find existing doc to update
     parent_doc = _get_existing_doc(doc_id, db_obj, update_from_coll_name)
+    if parent_doc is None:
+        return None, 'no document was found with the ID '+str(doc_id)
 
     # create child (new record) based off of parent doc
     new_doc = deepcopy(parent_doc)
@@ -418,13 +1135,13 @@ def update(doc_id, db_obj=None, remove_doc=False, update_pairs={}, new_meas_obje
         return None, error_msg
 
     # do update in database, move old version, etc.
-    new_doc_id = _update_databases(new_doc, parent_doc, remove_doc, db_obj, update_from_coll_name, old_versions_coll_name, update_to_coll_name)
+    new_doc_id, error_msg = _update_databases(new_doc, parent_doc, remove_doc, db_obj, update_from_coll_name, old_versions_coll_name, update_to_coll_name)
 
-    return new_doc_id, ''
+    return new_doc_id, error_msg
 
 
-def add_to_query(field, comparison, value, query_object=None, query_string="", append_mode="", include_synonyms=True):
-    """This function intakes the elements of a new query term (field, comparison, value, and append_mode) and either creates a new query containing that term, or adds the new term to an existing query using the existing query object argument or the existing query string argument.
+def add_to_query(field, comparison, value, query_object=None, query_string="", append_mode="", include_synonyms=True, synonym_mode="exact", query_state=""):
+    """This function intakes the elements of a new query term (field, comparison, value, and append_mode) and either creates a new query containing that term, or adds the new term to an existing query using the existing query object argument, the existing query state argument, or the existing query string argument (in that order of preference). Restoring a query from its state is cheaper than parsing its string, since the terms do not have to be parsed, validated against each other, and have their synonyms looked up again.
 
     args:
         * field (str): The field name whose value is to be compared.
@@ -434,54 +1151,33 @@ def add_to_query(field, comparison, value, query_object=None, query_string="", a
         * query_string (str) (optional): A pre-existing human-readable query string that can be loaded into a new Query object. This string MUST be in the format given by the UI's search page. That is, "<field1> <comparison1> <value1>\\n<append_mode>\\n<field2> <comparison2> <value2>\\n<append_mode>\\n..."
         * append_mode (str) (optional): How this new term should be added to an existing query (can be "AND" or "OR" or "", in which case this is the only term in the query).
         * include_synonyms (bool) (optional): Specifies whether or not to search for all synonyms of the specified value, in addition to that value, as opposed to searching only for the specified value.
+        * synonym_mode (str) (optional): How the value is matched against the words in the synonyms lists. Must be one of "exact" (the default; whole words, ignoring case), "prefix", or "regex".
+        * query_state (str) (optional): A pre-existing query state, as made by the Query class's to_state() method, that can be restored into a new Query object. If the state is not valid, query_string is used instead.
 
     returns:
         * str. The human-readable version of the query that can be displayed to the user with the UI.
         * dict. The query dictionary in pymongo syntax. This dictionary can be directly used as a query for the database.
     """
+    if query_object is None and query_state != "":
+        query_object = Query.from_state(query_state)
     if query_object is None:
         query_object = Query(query_string)
-    query_object.add_query_term(field, comparison, value, append_mode, include_synonyms)
+    query_object.add_query_term(field, comparison, value, append_mode, include_synonyms, synonym_mode)
     query_string = query_object.to_string()
     query_dict = query_object.to_query_language()
     return query_string, query_dict
 
 
-def insert(sample_name, sample_description, data_reference, data_input_name, data_input_contact, data_input_date, db_obj=None, \
+def _assemble_doc(sample_name, sample_description, data_reference, data_input_name, data_input_contact, data_input_date, \
     grouping="", sample_source="", sample_id="", sample_owner_name="", sample_owner_contact="", \
     measurement_results=[], measurement_practitioner_name="", measurement_practitioner_contact="", \
     measurement_technique="", measurement_institution="", measurement_date=[], measurement_description="", \
-    measurement_requestor_name="", measurement_requestor_contact="", data_input_notes="", coll_type=''):
-    """This function intakes all the individual fields that make up an assay document in the database, combines them into a dictionary document, validates that dict, and inserts it into the specified collection.
-
-    args:
-        * sample_name (str): A concise description of the sample.
-        * sample_description (str): A detailed description of the sample.
-        * data_reference (str): Reference for where the data came from.
-        * data_input_name (str): Name of the person/people who performed data input.
-        * data_input_contact (str): Email of the person who performed the data input (must be a valid email address).
-        * data_input_date (list of str): A list of strings that can be converted into datetime objects. This represents the date or date range when the data was input.
-        * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
-        * grouping (str) (optional): Experiment name.
-        * sample_source (str) (optional): Where the sample came from.
-        * sample_id (str) (optional): Sample identification number or string.
-        * sample_owner_name (str) (optional): Name of the person/people who own(s) the sample.
-        * sample_owner_contact (str) (optional): Email of the person who owns the sample (must be a valid email address).
-        * measurement_results (list of dict) (optional): List of measurement dictionaries that MUST contain the following fields: isotope, unit, type, value. The isotope field must be a (str) valid isotope name (e.g. K or Th). The unit must be a (str) valid unit type (e.g. ppm or g). The type must be a (str) representing the type of measurement, which must be one of: "measurement", "range", or "limit". The value must be a (list of str, int, or float) list of values that can ve converted into a float, which represent the values of the measurement. For a measurement of type "measurement" there should be two or three values: [central value, symmetric error] or [central value, positive asymmetric error, negative asymmetric error]. For a measurement of type "range" there should be tow or three values: [lower limit, upper limit] or [lower limit, upper limit, confidence level]. For a measurement of type "limit" there should be one to two values: [upper limit] or [upper limit, confidence level].
-        * measurement_practitioner_name (str) (optional): Name of the person/people who performed the measurement.
-        * measurement_practitioner_contact (str) (optional): Email of the person who performed the measurement (must be a valid email address).
-        * measurement_technique (str) (optional): Measurement technique.
-        * measurement_institution (str) (optional): Institution name.
-        * measurement_date (list of str) (optional): A list of strings that can be converted into datetime objects. This represents the date or date range when the measurements happened.
-        * measurement_description (str) (optional): Detailed measurement description.
-        * measurement_requestor_name (str) (optional): Name of the person/people who coordinated the measurement.
-        * measurement_requestor_contact (str) (optional): Email of the person who coordinated the measurement (must be a valid email).
-        * data_input_notes (str) (optional): Data input notes (simplifications, assumptions).
-        * coll_type (str) (optional): The type of the collection where the new doc should be inserted. If no value is specified, it is inserted into the main assay collection. If this argument is "assay_requests" then this doc is inserted as an assay request into the assay requests collection.
+    measurement_requestor_name="", measurement_requestor_contact="", data_input_notes=""):
+    """This is a helper function for inserting documents into the collection. It combines all the individual fields that make up an assay document into a dictionary document in the format used in the database. For a description of each of the args, see the documentation for the insert function. The document is not validated here.
 
     returns:
-        * bson.objectid.ObjectId. The MongoDB ID of the new document that was added into the database. If the insertion was unsuccessful, this value is None.
-        * str. The error message that arose while trying to update new_doc. This would happen if the document created with all the insert args is in valid or if the insertion of the new document resulted in an error.
+        * dict. The assembled document. If any of the date strings could not be converted into datetime objects, this value is None.
+        * str. The error message that arose while trying to assemble the document (empty string if no errors happened).
     """
     # convert date string lists to date object lists
     data_input_date = convert_str_list_to_date(data_input_date)
@@ -529,14 +1225,62 @@ def insert(sample_name, sample_description, data_reference, data_input_name, dat
         },
         "_version":1
     }
+    return doc, ''
+
+
+def insert(sample_name, sample_description, data_reference, data_input_name, data_input_contact, data_input_date, db_obj=None, \
+    grouping="", sample_source="", sample_id="", sample_owner_name="", sample_owner_contact="", \
+    measurement_results=[], measurement_practitioner_name="", measurement_practitioner_contact="", \
+    measurement_technique="", measurement_institution="", measurement_date=[], measurement_description="", \
+    measurement_requestor_name="", measurement_requestor_contact="", data_input_notes="", coll_type=''):
+    """This function intakes all the individual fields that make up an assay document in the database, combines them into a dictionary document, validates that dict, and inserts it into the specified collection.
+
+    args:
+        * sample_name (str): A concise description of the sample.
+        * sample_description (str): A detailed description of the sample.
+        * data_reference (str): Reference for where the data came from.
+        * data_input_name (str): Name of the person/people who performed data input.
+        * data_input_contact (str): Email of the person who performed the data input (must be a valid email address).
+        * data_input_date (list of str): A list of strings that can be converted into datetime objects. This represents the date or date range when the data was input.
+        * db_obj (pymongo.database.Database): A pymongo database object that, once a collection has been selected, can be used to query.
+        * grouping (str) (optional): Experiment name.
+        * sample_source (str) (optional): Where the sample came from.
+        * sample_id (str) (optional): Sample identification number or string.
+        * sample_owner_name (str) (optional): Name of the person/people who own(s) the sample.
+        * sample_owner_contact (str) (optional): Email of the person who owns the sample (must be a valid email address).
+        * measurement_results (list of dict) (optional): List of measurement dictionaries that MUST contain the following fields: isotope, unit, type, value. The isotope field must be a (str) valid isotope name (e.g. K or Th). The unit must be a (str) valid unit type (e.g. ppm or g). The type must be a (str) representing the type of measurement, which must be one of: "measurement", "range", or "limit". The value must be a (list of str, int, or float) list of values that can ve converted into a float, which represent the values of the measurement. For a measurement of type "measurement" there should be two or three values: [central value, symmetric error] or [central value, positive asymmetric error, negative asymmetric error]. For a measurement of type "range" there should be tow or three values: [lower limit, upper limit] or [lower limit, upper limit, confidence level]. For a measurement of type "limit" there should be one to two values: [upper limit] or [upper limit, confidence level].
+        * measurement_practitioner_name (str) (optional): Name of the person/people who performed the measurement.
+        * measurement_practitioner_contact (str) (optional): Email of the person who performed the measurement (must be a valid email address).
+        * measurement_technique (str) (optional): Measurement technique.
+        * measurement_institution (str) (optional): Institution name.
+        * measurement_date (list of str) (optional): A list of strings that can be converted into datetime objects. This represents the date or date range when the measurements happened.
+        * measurement_description (str) (optional): Detailed measurement description.
+        * measurement_requestor_name (str) (optional): Name of the person/people who coordinated the measurement.
+        * measurement_requestor_contact (str) (optional): Email of the person who coordinated the measurement (must be a valid email).
+        * data_input_notes (str) (optional): Data input notes (simplifications, assumptions).
+        * coll_type (str) (optional): The type of the collection where the new doc should be inserted. If no value is specified, it is inserted into the main assay collection. If this argument is "assay_requests" then this doc is inserted as an assay request into the assay requests collection.
+
+    returns:
+        * bson.objectid.ObjectId. The MongoDB ID of the new document that was added into the database. If the insertion was unsuccessful, this value is None.
+        * str. The error message that arose while trying to update new_doc. This would happen if the document created with all the insert args is in valid or if the insertion of the new document resulted in an error.
+    """
+    doc, error_message = _assemble_doc(sample_name, sample_description, data_reference, data_input_name, data_input_contact, data_input_date, \
+        grouping=grouping, sample_source=sample_source, sample_id=sample_id, sample_owner_name=sample_owner_name, sample_owner_contact=sample_owner_contact, \
+        measurement_results=measurement_results, measurement_practitioner_name=measurement_practitioner_name, measurement_practitioner_contact=measurement_practitioner_contact, \
+        measurement_technique=measurement_technique, measurement_institution=measurement_institution, measurement_date=measurement_date, measurement_description=measurement_description, \
+        measurement_requestor_name=measurement_requestor_name, measurement_requestor_contact=measurement_requestor_contact, data_input_notes=data_input_notes)
+    if doc is None:
+        return None, error_message
     #print('DOC TO INSERT:',doc)
 
     # validate doc
     # TODO: verify that sample.owner.contact, measurement.requestor.contact, measurement.practitioner.contact, and data_source.input.contact are valid emails
-    validator = DuneValidator("whole_record")
+    validator = get_validator("whole_record")
     is_valid, error_message = validator.validate(doc) 
     if not is_valid:
         return None, error_message
+    doc[SEARCH_FIELD] = build_search_fields(doc)
+    doc['measurement']['results'] = add_si_values(doc['measurement']['results'])
 
     # perform doc insert
     if db_obj is None:
@@ -551,10 +1295,173 @@ def insert(sample_name, sample_description, data_reference, data_input_name, dat
         #print("Error inserting doc")
         mongo_id = None
         msg = 'unsuccessful insert into mongodb'
+    bump_collection_generation(collection)
 
     return mongo_id, msg
 
 
+def insert_many(records, db_obj=None, ordered=False, batch_size=500, coll_type=''):
+    """This function inserts many new assay documents at once. Each record is assembled into a dictionary document the same way the insert function does it, all of the documents are validated with one validator, and the valid documents are written to the specified collection with one insert_many call per batch (instead of one round trip per document).
+
+    args:
+        * records (list of dict): The documents to insert. Each record is a dict whose keys are the names of the arguments of the insert function (e.g. "sample_name", "data_input_date", "measurement_results"), except for db_obj and coll_type.
+        * db_obj (pymongo.database.Database) (optional): A pymongo database object that, once a collection has been selected, can be used to query.
+        * ordered (bool) (optional): If True, the records are inserted in order and nothing after the first record that fails (either validation or the database insert) is inserted. If False (the default), every valid record is inserted, regardless of the other records.
+        * batch_size (int) (optional): The maximum number of documents to send to the database in one insert_many call.
+        * coll_type (str) (optional): The type of the collection where the new docs should be inserted. If no value is specified, they are inserted into the main assay collection.
+
+    returns:
+        * list of bson.objectid.ObjectId. The MongoDB IDs of the new documents, in the same order as the records. The ID of any record that was not inserted is None.
+        * dict. The error messages for the records that were not inserted, keyed by the index of the record in records.
+    """
+    new_ids = [ None for record in records ]
+    errors = {}
+
+    # assemble docs
+    docs = []
+    doc_indices = []
+    for i, record in enumerate(records):
+        try:
+            doc, error_message = _assemble_doc(**record)
+        except TypeError as e:
+            doc, error_message = None, 'invalid insert arguments: '+str(e)
+        if doc is None:
+            errors[i] = error_message
+        else:
+            docs.append(doc)
+            doc_indices.append(i)
+
+    # validate docs
+    valid_docs = []
+    valid_doc_indices = []
+    validation_results = get_validator("whole_record").validate_many(docs)
+    for doc, i, (is_valid, error_message) in zip(docs, doc_indices, validation_results):
+        if is_valid:
+            doc[SEARCH_FIELD] = build_search_fields(doc)
+            doc['measurement']['results'] = add_si_values(doc['measurement']['results'])
+            valid_docs.append(doc)
+            valid_doc_indices.append(i)
+        else:
+            errors[i] = error_message
+
+    def _skip_after(first_failed_idx, indices):
+        for i in indices:
+            if i > first_failed_idx and i not in errors:
+                errors[i] = 'not inserted because record '+str(first_failed_idx)+' could not be inserted'
+
+    if ordered and len(errors) > 0:
+        first_failed_idx = min(errors.keys())
+        _skip_after(first_failed_idx, valid_doc_indices)
+        valid_doc_indices = [ i for i in valid_doc_indices if i < first_failed_idx ]
+        valid_docs = valid_docs[:len(valid_doc_indices)]
+
+    if len(valid_docs) == 0:
+        return new_ids, errors
+
+    # perform doc inserts
+    if db_obj is None:
+        db_obj = _create_db_obj()
+    collection = _get_specified_collection(coll_type, db_obj)
+
+    for batch_start in range(0, len(valid_docs), batch_size):
+        batch_docs = valid_docs[batch_start:batch_start+batch_size]
+        batch_indices = valid_doc_indices[batch_start:batch_start+batch_size]
+
+        batch_errors = {}
+        try:
+            collection.insert_many(batch_docs, ordered=ordered)
+        except BulkWriteError as e:
+            for write_error in e.details.get('writeErrors', []):
+                batch_errors[write_error['index']] = 'unsuccessful insert into mongodb: '+str(write_error.get('errmsg', ''))
+            if ordered and len(batch_errors) > 0:
+                # an ordered insert_many stops at the first error
+                first_failed_batch_idx = min(batch_errors.keys())
+                for j in range(first_failed_batch_idx+1, len(batch_docs)):
+                    batch_errors[j] = 'not inserted because record '+str(batch_indices[first_failed_batch_idx])+' could not be inserted'
+        except Exception:
+            for j in range(len(batch_docs)):
+                batch_errors[j] = 'unsuccessful insert into mongodb'
+
+        for j, (doc, i) in enumerate(zip(batch_docs, batch_indices)):
+            if j in batch_errors:
+                errors[i] = batch_errors[j]
+            else:
+                # insert_many adds the new _id to each doc before sending it
+                new_ids[i] = doc['_id']
+
+        if ordered and len(batch_errors) > 0:
+            _skip_after(min([ batch_indices[j] for j in batch_errors.keys() ]), valid_doc_indices)
+            break
+    bump_collection_generation(collection)
+
+    return new_ids, errors
+
+
+def backfill_search_fields(db_obj=None, coll_type='', only_missing=True, batch_size=500):
+    """This function adds the normalized "_search" sub-document (see the search_fields module) to documents that were inserted before it existed, so that queries compiled against the normalized fields can find them. Documents that are inserted or updated with the toolkit always get an up-to-date "_search" sub-document, so this only needs to be run once for an existing database (and again, with only_missing set to False, if search_fields.NORMALIZED_FIELDS changes). Only the string fields are read from the database, and the updates are sent with one bulk write per batch of documents.
+
+    args:
+        * db_obj (pymongo.database.Database) (optional): A pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): The type of the collection to backfill. If no value is specified, the main assay collection is backfilled.
+        * only_missing (bool) (optional): If True (the default), only documents without a "_search" sub-document are updated. If False, the sub-document is rebuilt for every document.
+        * batch_size (int) (optional): The maximum number of updates to send to the database in one bulk write.
+
+    returns:
+        * int. The number of documents that were updated.
+    """
+    if db_obj is None:
+        db_obj = _create_db_obj()
+    collection = _get_specified_collection(coll_type, db_obj)
+
+    query = {SEARCH_FIELD:{'$exists':False}} if only_missing else {}
+    projection = { field:1 for field in NORMALIZED_FIELDS }
+
+    num_updated = 0
+    requests = []
+    for doc in collection.find(query, projection):
+        requests.append(UpdateOne({'_id':doc['_id']}, {'$set':{SEARCH_FIELD:build_search_fields(doc)}}))
+        if len(requests) >= batch_size:
+            num_updated += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if len(requests) > 0:
+        num_updated += collection.bulk_write(requests, ordered=False).modified_count
+    bump_collection_generation(collection)
+    return num_updated
+
+
+def backfill_si_values(db_obj=None, coll_type='', only_missing=True, batch_size=500):
+    """This function adds the "value_si" and "unit_si" fields (see the unit_conversion module) to the measurement results of documents that were inserted before they existed, so that queries compiled against the SI values can find them. Documents that are inserted or updated with the toolkit always have up-to-date SI values, so this only needs to be run once for an existing database (and again, with only_missing set to False, if unit_conversions.csv or specific_activities.csv changes). Only the measurement results are read from the database, and the updates are sent with one bulk write per batch of documents. Each update only applies if the document's measurement results have not changed since they were read.
+
+    args:
+        * db_obj (pymongo.database.Database) (optional): A pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): The type of the collection to backfill. If no value is specified, the main assay collection is backfilled.
+        * only_missing (bool) (optional): If True (the default), only documents with a measurement result that has no SI values are updated. If False, the SI values are rebuilt for every document.
+        * batch_size (int) (optional): The maximum number of updates to send to the database in one bulk write.
+
+    returns:
+        * int. The number of documents that were updated.
+    """
+    if db_obj is None:
+        db_obj = _create_db_obj()
+    collection = _get_specified_collection(coll_type, db_obj)
+
+    query = {'measurement.results':{'$elemMatch':{'unit_si':{'$exists':False}}}} if only_missing else {'measurement.results':{'$exists':True}}
+
+    num_updated = 0
+    requests = []
+    for doc in collection.find(query, {'measurement.results':1}):
+        meas_results = doc['measurement']['results']
+        new_meas_results = add_si_values(meas_results)
+        requests.append(UpdateOne({'_id':doc['_id'], 'measurement.results':meas_results}, {'$set':{'measurement.results':new_meas_results}}))
+        if len(requests) >= batch_size:
+            num_updated += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if len(requests) > 0:
+        num_updated += collection.bulk_write(requests, ordered=False).modified_count
+    bump_collection_generation(collection)
+    return num_updated
+
+
 def convert_str_to_date(date_str):
     """This function intakes a string, tries to convert it into a datetime object, and returns that datetime object.
 
@@ -622,6 +1529,8 @@ if __name__ == '__main__':
 
     search_parser = subparsers.add_parser('search', help='search for an assay in the database')
     search_parser.add_argument('--q', required=True, help='query to execute. *must be surrounded with single quotes, and use double quotes within dict*')
+    search_parser.add_argument('--page_size', type=int, default=0, help='optional number of documents per page. If not present, all matching documents are returned')
+    search_parser.add_argument('--after_id', type=str, default=None, help='optional resume token (the last document ID of the previous page) to get the next page of results')
 
     query_append_parser = subparsers.add_parser('add_query_term', help='adds a new query term to an existing query')
     query_append_parser.add_argument('--field', type=str, required=True, choices=valid_fields, help='the field to compare the value of')
@@ -655,6 +1564,25 @@ if __name__ == '__main__':
     insert_parser.add_argument('--measurement_requestor_name', type=str, default='', help='name of who coordinated the measurement')
     insert_parser.add_argument('--measurement_requestor_contact', type=str, default='', help='email of who coordinated the measurement')
 
+    insert_bulk_parser = subparsers.add_parser('insert_bulk', help='inserts many new assays into the database from a JSON Lines file')
+    insert_bulk_parser.add_argument('--file', type=str, required=True, help='path to a JSON Lines file with one assay per line. The keys of each assay are the names of the insert arguments (e.g. "sample_name", "measurement_results")')
+    insert_bulk_parser.add_argument('--ordered', action='store_true', default=False, help='if present, insert the assays in order and stop at the first one that cannot be inserted')
+    insert_bulk_parser.add_argument('--batch_size', type=int, default=500, help='maximum number of assays to send to the database at once')
+
+    ensure_indexes_parser = subparsers.add_parser('ensure_indexes', help='creates the indexes that searches rely on, and reports missing and unused indexes')
+    ensure_indexes_parser.add_argument('--check_only', action='store_true', default=False, help='if present, only report which indexes are missing instead of creating them')
+    ensure_indexes_parser.add_argument('--coll_type', type=str, choices=['', 'old_versions'], default='', help='optional type of collection to index. If not present, the main assays collection is used')
+
+    backfill_parser = subparsers.add_parser('backfill_search_fields', help='adds the normalized search fields to assays that were inserted before they existed')
+    backfill_parser.add_argument('--rebuild', action='store_true', default=False, help='if present, rebuild the normalized search fields of every assay instead of only the ones that do not have them')
+    backfill_parser.add_argument('--coll_type', type=str, choices=['', 'old_versions'], default='', help='optional type of collection to backfill. If not present, the main assays collection is used')
+    backfill_parser.add_argument('--batch_size', type=int, default=500, help='maximum number of assays to update at once')
+
+    backfill_si_parser = subparsers.add_parser('backfill_si_values', help='adds the SI values to the measurement results of assays that were inserted before they existed')
+    backfill_si_parser.add_argument('--rebuild', action='store_true', default=False, help='if present, rebuild the SI values of every assay instead of only the ones that do not have them')
+    backfill_si_parser.add_argument('--coll_type', type=str, choices=['', 'old_versions'], default='', help='optional type of collection to backfill. If not present, the main assays collection is used')
+    backfill_si_parser.add_argument('--batch_size', type=int, default=500, help='maximum number of assays to update at once')
+
     update_parser = subparsers.add_parser('update', help='updates an existing assay in the database')
     update_parser.add_argument('--doc_id', type=str, required=True, help='the MongoDB id of the document in the database to update')
     update_parser.add_argument('--remove_doc', action='store_true', default=False, help='if present, remove the entire document from the database')
@@ -665,7 +1593,11 @@ if __name__ == '__main__':
     args = vars(parser.parse_args())
 
     if args['subparser_name'] == 'search':
-        result = search(args['q'])
+        if args['page_size'] > 0:
+            docs, next_after_id = search_page(args['q'], page_size=args['page_size'], after_id=args['after_id'])
+            result = str(docs)+"\nNEXT PAGE AFTER ID: "+str(next_after_id)
+        else:
+            result = search(args['q'])
     elif args['subparser_name'] == 'add_query_term':
         #TODO: add "include_synonyms" field
         q_str, q_dict = add_to_query(args['field'], args['compare'], args['val'], query_string=args['q'], append_mode=args['mode'])
@@ -700,6 +1632,32 @@ if __name__ == '__main__':
         if error_msg != '':
             print(error_msg)
         result = 'NEW DOC ID: '+str(result)
+    elif args['subparser_name'] == 'insert_bulk':
+        records = []
+        line_numbers = []
+        with open(args['file'], 'r') as records_file:
+            for line_number, line in enumerate(records_file, start=1):
+                if line.strip() != '':
+                    records.append(json.loads(line))
+                    line_numbers.append(line_number)
+        new_ids, errors = insert_many(records, ordered=args['ordered'], batch_size=args['batch_size'])
+        for record_idx in sorted(errors.keys()):
+            print('LINE '+str(line_numbers[record_idx])+': '+errors[record_idx])
+        result = 'INSERTED '+str(len(records)-len(errors))+' OF '+str(len(records))+' DOCS'
+    elif args['subparser_name'] == 'ensure_indexes':
+        report = ensure_indexes(coll_type=args['coll_type'], create=not args['check_only'])
+        for index_name, error_msg in report['errors'].items():
+            print('ERROR CREATING '+index_name+': '+error_msg)
+        result = 'CREATED: '+', '.join(report['created']) \
+            +'\nEXISTING: '+', '.join(report['existing']) \
+            +'\nMISSING: '+', '.join(report['missing']) \
+            +'\nUNUSED: '+(', '.join(report['unused']) if report['unused'] is not None else 'unknown')
+    elif args['subparser_name'] == 'backfill_search_fields':
+        num_updated = backfill_search_fields(coll_type=args['coll_type'], only_missing=not args['rebuild'], batch_size=args['batch_size'])
+        result = 'UPDATED '+str(num_updated)+' DOCS'
+    elif args['subparser_name'] == 'backfill_si_values':
+        num_updated = backfill_si_values(coll_type=args['coll_type'], only_missing=not args['rebuild'], batch_size=args['batch_size'])
+        result = 'UPDATED '+str(num_updated)+' DOCS'
     elif args['subparser_name'] == 'update':
         '''
         update_keyval_pairs = {}
@@ -722,7 +1680,7 @@ if __name__ == '__main__':
         else:
             result = error_msg
     else:
-        print('You must enter an action to perform: search, insert, update, or add_query_term')
+        print('You must enter an action to perform: search, insert, insert_bulk, update, or add_query_term')
         result = None
 
     print(result)
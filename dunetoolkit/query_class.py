@@ -5,25 +5,105 @@
 .. moduleauthor:: Elise Saxon
 """
 
-import os
 import re
 import json
 import datetime
+import bisect
+import threading
 from copy import deepcopy
+from collections import OrderedDict
+from dunetoolkit.reference_data import get_synonyms, get_specific_activities
+from dunetoolkit import search_fields, unit_conversion
+from dunetoolkit.search_fields import NORMALIZED_FIELDS, normalize_str, tokenize_str, normalized_field_path
+from dunetoolkit.unit_conversion import get_si_conversion
+
+# the maximum number of compiled pymongo queries to keep in the query plan cache
+QUERY_PLAN_CACHE_SIZE = 512
+
+# compiled pymongo queries, keyed by the human-readable query string, with the least recently used query first
+_query_plan_cache = OrderedDict()
+_query_plan_cache_lock = threading.Lock()
+_query_plan_cache_stats = {"hits":0, "misses":0}
+
+# the version of the format of the serialized query state made by Query.to_state(). It is stored in the state, so that a state made by an older version of the toolkit can be recognized (and rejected) instead of being misread.
+QUERY_STATE_VERSION = 1
+
+# how the value of a query term is matched against the words in synonyms.txt. "exact" (the default) matches whole words, ignoring case. "prefix" matches words that start with the value, and "regex" treats the value as a regular expression that must match the start of a word.
+SYNONYM_MODES = ["exact", "prefix", "regex"]
+
+# the collation that compiled queries must be run with. String "equals" terms are compiled into plain equality matches instead of case-insensitive regexes, and this collation (strength 2 compares letters without regard to case) is what makes them case-insensitive, while still letting MongoDB answer them with a seek on an index that has the same collation.
+QUERY_COLLATION = {"locale": "en", "strength": 2}
+
+
+def query_plan_cache_info():
+    """Reports how well the query plan cache used by Query.to_query_language is working.
+
+    returns:
+        * dict. The number of cache hits ("hits") and misses ("misses") so far, the number of queries currently in the cache ("size"), and the maximum number of queries the cache will hold ("max_size").
+    """
+    with _query_plan_cache_lock:
+        info = {
+            "hits": _query_plan_cache_stats["hits"],
+            "misses": _query_plan_cache_stats["misses"],
+            "size": len(_query_plan_cache),
+            "max_size": QUERY_PLAN_CACHE_SIZE
+        }
+    return info
+
+def clear_query_plan_cache():
+    """Removes all compiled queries from the query plan cache and resets its hit and miss counters.
+    """
+    with _query_plan_cache_lock:
+        _query_plan_cache.clear()
+        _query_plan_cache_stats["hits"] = 0
+        _query_plan_cache_stats["misses"] = 0
+
+def query_complexity(query):
+    """Measures how complex a compiled pymongo query is, for comparing how different ways of writing (or compiling) a query will plan. Every "$or" branch can need its own index scan, so queries with fewer "$or" branches and fewer predicates are usually cheaper to run.
+
+    args:
+        * query (dict): A pymongo query, e.g. the output of Query.to_query_language.
+
+    returns:
+        * dict. The number of field predicates in the query, including those inside an "$elemMatch" ("terms"), the number of branches of all of its "$or" operators ("or_branches"), the number of "$elemMatch" operators ("elem_matches"), and the deepest nesting of "$and", "$or", "$nor", and "$elemMatch" operators ("depth").
+    """
+    complexity = {"terms":0, "or_branches":0, "elem_matches":0, "depth":0}
+
+    def _walk(term, depth):
+        complexity["depth"] = max(complexity["depth"], depth)
+        for key, value in term.items():
+            if key in ['$and', '$or', '$nor']:
+                if key == '$or':
+                    complexity["or_branches"] += len(value)
+                for sub_term in value:
+                    _walk(sub_term, depth+1)
+            elif type(value) is dict and '$elemMatch' in value:
+                complexity["elem_matches"] += 1
+                _walk(value['$elemMatch'], depth+1)
+            else:
+                complexity["terms"] += 1
+
+    _walk(query, 0)
+    return complexity
+
 
 class Query():
     """This class enables the database toolkit to form complicated queries that will return expectable results.
     """
-    def __init__(self, query_str=None):
+    def __init__(self, query_str=None, use_normalized_fields=None, use_si_values=None):
         """The Query class can be instantiated from scratch with no existing query, or it can be instantiated with existing query text, where that query text will be loaded up and stored in this class so future query terms will be added to it.
 
         args:
             * query_str (str) (optional): If provided, this string will be parsed and loaded into the Query class's "terms" and "appends" lists so that future query terms can be added to it. This string MUST be in the format given by the UI's search page. That is, "<field1> <comparison1> <value1>\\n<append_mode>\\n<field2> <comparison2> <value2>\\n<append_mode>\\n..."
+            * use_normalized_fields (bool) (optional): If True, string terms are compiled into matches against the normalized copies of the fields in the documents' "_search" sub-documents (see _assemble_qterm_normalized). If not provided, this defaults to search_fields.USE_NORMALIZED_FIELDS, which is set with the environment variable TOOLKIT_USE_NORMALIZED_FIELDS.
+            * use_si_values (bool) (optional): If True, measurement results terms that compare values in a given unit are compiled into comparisons against the SI values of the measurement results (see _get_si_value_terms), so that results recorded in other units are found too. If not provided, this defaults to unit_conversion.USE_SI_VALUES, which is set with the environment variable TOOLKIT_USE_SI_VALUES.
 
         :ivar terms (list of dict): The current set of query terms that this the Query object is keeping track of. As terms get added to this Query object, the field, comparison, and value get added to this list. Each dictionary element of this list should have the following structure: {"field":str, "comparison":str, "value":int/str/float/list}. 
         :ivar appends (list of str): The current set of append modes ("AND" or "OR") that combine query terms from the terms field. As query terms get added to the Query object, the append mode that adds a new term to the existing list gets added to this list. For the append mode in this list at index i, that append mode will combine the query term in the terms list at index i and the term in the terms list at index i+1. There should always be len(terms)-1 in the appends list.
         :ivar all_fields (list of str): A list of all the fields that are being compared in the terms list. This list helps keep track of which fields already exist in the query so that the terms can be combined if applicable. For example, two terms like "all contains testing" and "all contains example" can be combined into something like "all contains ['testing', 'example'].
-        :ivar synonyms (list of list of str): Stores the contents of synonyms.txt as a lookup table.
+        :ivar synonyms (tuple of tuple of str): Stores the contents of synonyms.txt. Each element is one group of words that are all synonyms of each other.
+        :ivar synonym_index (mappingproxy): Maps each case-folded word in synonyms.txt to the index of its group in the synonyms tuple.
+        :ivar synonym_words (tuple of str): The keys of synonym_index in sorted order, for looking up words by prefix.
         :ivar valid_append_modes (list of str): List of the valid values for append_mode variables. Valid values are "AND" and "OR".
         :ivar valid_field_names (list of str): A list of all the valid values for query fields. These are essentially all the valid fields in an assay document.
         :ivar str_fields (list of str): A list of all the field names whose values should always be of type string. This list is used in order to assemble query terms where strings are being compared.
@@ -32,13 +112,15 @@ class Query():
         :ivar str_comparisons (list of str): A list of all the valid comparison operators that can be used to compare strings in a query.
         :ivar num_comparisons (list of str): A list of all the valid comparison operators that can be used to compare numbers in a query.
         :ivar date_comparisons (list of str): A list of all the valid comparison operators that can be used to compare dates in a query.
+        :ivar use_normalized_fields (bool): Whether string terms are compiled into matches against the documents' normalized "_search" sub-documents.
+        :ivar use_si_values (bool): Whether measurement results terms that compare values in a given unit are compiled into comparisons against the SI values of the measurement results.
         """
         self.terms = []
         self.appends = []
         self.all_fields = []
 
-        synonyms_filepath = os.path.dirname(os.path.abspath(__file__)) + '/synonyms.txt'
-        self.synonyms = self._load_synonyms(synonyms_filepath)
+        # synonyms.txt is only read once per process; every Query object shares the same read-only tables
+        self.synonyms, self.synonym_index, self.synonym_words = get_synonyms()
 
         self.valid_append_modes = ['AND', 'OR']
         self.valid_field_names = ["all", "grouping", "sample.name", "sample.description", "sample.source", "sample.id", "sample.owner.name", "sample.owner.contact", "measurement.results.isotope", "measurement.results.type", "measurement.results.unit", "measurement.results.value", "measurement.practitioner.name", "measurement.practitioner.contact", "measurement.technique","measurement.institution", "measurement.date", "measurement.description", "measurement.requestor.name", "measurement.requestor.contact", "data_source.reference", "data_source.input.name", "data_source.input.contact", "data_source.input.date", "data_source.input.notes"]
@@ -48,26 +130,12 @@ class Query():
         self.str_comparisons = ["eq", "contains", "notcontains"]
         self.num_comparisons = ["eq", "lt", "lte", "gt", "gte"]
         self.date_comparisons = ["eq", "lt", "lte", "gt", "gte"]
+        self.use_normalized_fields = search_fields.USE_NORMALIZED_FIELDS if use_normalized_fields is None else use_normalized_fields
+        self.use_si_values = unit_conversion.USE_SI_VALUES if use_si_values is None else use_si_values
 
         if query_str is not None and query_str != '':
             self._load_from_str(query_str)
 
-    def _load_synonyms(self, filepath):
-        """This function reads in the path to a text file where synonyms are stored and returns a list of lists of strings, which will be set to the "synonyms" class variable.
-
-        args:
-            * filepath (str): The absolute path to the file where the synonyms lists are stored. The file should be a text file where each line is a comma-separated list of strings where each string is a synonym for the others in the line.
-
-        returns:
-            * list of list of str. The list of the lists of synonyms for each word on record.
-        """
-        synonyms_list = []
-        with open(filepath, 'r') as read_file:
-            for line in read_file:
-                line_elements = line.strip().split(',')
-                synonyms_list.append(line_elements)
-        return synonyms_list
-
     def _get_field_from_str(self, line):
         """This function identifies the first space in the input string that represents a human-readable query string (this space should separate the field from the comparison) and pulls all the characters from the start of the string until that first space, setting those characters to be the field in the string.
 
@@ -172,21 +240,41 @@ class Query():
         #TODO: remove this return statement and its documentation.
         return True, ''
 
-    def _find_synonyms(self, value):
-        """This function iterates through the list of synonyms, searching for the specified value. If the value is found in any of the lists, the entire list in which the value was found contains all the synonyms for that value.
+    def _find_synonyms(self, value, synonym_mode='exact'):
+        """This function looks up the list of synonyms that contains the specified value. In "exact" mode, this is a single dictionary lookup of the case-folded value. In "prefix" mode, the sorted list of words is binary searched for words that start with the value. In "regex" mode, the value is compiled into a regular expression and matched against the start of each word in turn. In the "prefix" and "regex" modes, if more than one list matches, the list that comes first in synonyms.txt is used.
 
         args:
             * value (str): The string to find synonyms for.
+            * synonym_mode (str): How to match the value against the words in the synonyms lists. Must be one of "exact", "prefix", or "regex".
 
         returns:
             * list of str. The list of synonyms that was found for the given value. If no synonyms were found, this function returns None.
         """
-        for word_list in self.synonyms:
-            for word in word_list:
-                if re.match(value, word, re.IGNORECASE):
-                    return word_list
-        return None
-
+        group_idx = None
+        if synonym_mode == 'exact':
+            group_idx = self.synonym_index.get(value.strip().casefold())
+        elif synonym_mode == 'prefix':
+            prefix = value.strip().casefold()
+            word_idx = bisect.bisect_left(self.synonym_words, prefix)
+            while word_idx < len(self.synonym_words) and self.synonym_words[word_idx].startswith(prefix):
+                word_group_idx = self.synonym_index[self.synonym_words[word_idx]]
+                if group_idx is None or word_group_idx < group_idx:
+                    group_idx = word_group_idx
+                word_idx += 1
+        else:
+            try:
+                value_regex = re.compile(value, re.IGNORECASE)
+            except re.error:
+                return None
+            for i, word_list in enumerate(self.synonyms):
+                if any([ value_regex.match(word) for word in word_list ]):
+                    group_idx = i
+                    break
+
+        if group_idx is None:
+            return None
+        # return a copy so that the shared synonyms lists never end up in (and get modified through) a query term
+        return list(self.synonyms[group_idx])
     def _add_query_term_all(self, value, append_type):
         """This function adds a query term whose field is "all" to the Query object's lists of terms and appends. The "all" query term must be handled differently from other terms due to the nature of MongoDB (the "all" search is enabled by the use of $text indices in the MongoDB collections, so any questions can be answered by looking at the MongoDB $text index documentation). There can only be one "all" comparison in an entire query, so if the user tries to enter multiple terms whose field is "all", the values for each of those terms will be combined into one list and be searched for in one term. The comparison for the "all" field is always "contains" (again, due to the nature of the MongoDB $text index). Since there can only be one "all" term in a given query, the append mode that is used on the general "all" term in the final query is the append mode that was passed for the first "all" term.
 
@@ -220,7 +308,7 @@ class Query():
         if append_type != '':
             self.appends.append(append_type)
         self.all_fields.append(field)
-    def add_query_term(self, field, comparison, value, append_type='', include_synonyms=True):
+    def add_query_term(self, field, comparison, value, append_type='', include_synonyms=True, synonym_mode='exact'):
         """This is the main function that orchestrates adding a query term to the Query object's lists of terms and appends. This function first validates the arguments, then gathers the specified value's synonyms if include_synonyms is True, then adds the new query term and append mode to the terms and appends lists based on whether the field is "all" or not. The _add_query_term_all function documentation describes more on why the "all" terms must be handled separately.
 
         args:
@@ -229,11 +317,15 @@ class Query():
             * value (str or int or float): The value to compare against.
             * append_type (str): The append mode to use for this query term. Must be one of "AND" or "OR" or "". If append_type is an empty string, this is the first/only term in the Query object.
             * include_synonyms (bool): Whether or not to include the value's synonyms in the query term or to only search for the value itself.
+            * synonym_mode (str): How the value is matched against the words in the synonyms lists when include_synonyms is True. Must be one of "exact" (whole words, ignoring case), "prefix" (words that start with the value), or "regex" (the value is a regular expression that must match the start of a word).
         """
         is_valid, error_msg = self._validate_term(field, comparison, value, append_type) #this validates the field, comparison, value, and append_type
+        if is_valid and synonym_mode not in SYNONYM_MODES:
+            is_valid = False
+            error_msg = 'Error: synonym mode '+str(synonym_mode)+' not one of: '+str(SYNONYM_MODES)
         if is_valid:
             if include_synonyms and value != '' and type(value) is str:
-                synonyms_list = self._find_synonyms(value)
+                synonyms_list = self._find_synonyms(value, synonym_mode)
                 if synonyms_list is not None:
                     value = synonyms_list
             if field == 'all':
@@ -320,7 +412,7 @@ class Query():
         term = {field:{comparison:search_val}}
         return term
     def _assemble_qterm_str(self, field, comparison, value):
-        """This function creates a pymongo query language dictionary out of a given field, comparison, and value where the field is one of the string fields, meaning that term does a string comparison. To do string comparisons, the Query class uses pre-compiled regex statements. The comparison operator dictates how the regex statement is formed. For example, if the comparison is "contains", then the regex pattern would have the value surrounded by ".*" to indicate that any characters can come before or after the value, so long as the value is in there.
+        """This function creates a pymongo query language dictionary out of a given field, comparison, and value where the field is one of the string fields, meaning that term does a string comparison. The comparison operator dictates how the term is formed. For "equals", the term is a plain equality match (or an $in match, for a list of synonyms), which is case-insensitive because searches are run with QUERY_COLLATION, and which MongoDB can answer with an index seek. For "contains", the term is an unanchored, case-insensitive regex, so that the value can appear anywhere in the field. For "notcontains", the term is a negated, case-insensitive regex that matches the whole field. Any characters in the value that have a special meaning in regexes are escaped, so the value is always matched literally.
 
         args:
             * field (str): The field to query for
@@ -331,18 +423,16 @@ class Query():
             * dict. The query term in pymongo query language.
         """
         def _create_contains_regex(token):
-            return re.compile('^.*'+token+'.*$', re.IGNORECASE)
+            return re.compile(re.escape(token), re.IGNORECASE)
         def _create_equals_regex(token):
-            return re.compile('^'+token+'$', re.IGNORECASE)
-        def _create_regex(token, comparison):
+            return re.compile('^'+re.escape(token)+'$', re.IGNORECASE)
+        def _create_search_val(token, comparison):
             if comparison == 'contains':
-                #search_val  = _create_contains_regex(token)
                 search_val = {"$regex":_create_contains_regex(token)}
             elif comparison == 'notcontains':
                 search_val = {'$not':_create_equals_regex(token)}
             else: #equals
-                #search_val = _create_equals_regex(token)
-                search_val = {"$regex":_create_equals_regex(token)}
+                search_val = token
             return search_val
         def _assemble_list_search_term(field, comparison, value): # this is only for synonyms
             # looking for a field that does not equal/contain any of (A, B, C) --> "not A and not B and not C"
@@ -354,19 +444,52 @@ class Query():
 
             term = {append_mode:[]}
             for word in value:
-                search_val = _create_regex(word, comparison)
+                search_val = _create_search_val(word, comparison)
                 search_term = {field:search_val}
                 term[append_mode].append(search_term)
             return term
 
-        # we need to assemble a sub-term of "OR" tokens for all synonyms
-        if type(value) is list:
+        # we need to assemble a sub-term of "OR" tokens for all synonyms, except for "equals", where one $in term matches any of them
+        if type(value) is list and comparison in ['contains', 'notcontains']:
             term = _assemble_list_search_term(field, comparison, value)
+        elif type(value) is list:
+            term = {field:{'$in':value}}
         else:
-            search_val = _create_regex(value, comparison)
+            search_val = _create_search_val(value, comparison)
             term = {field:search_val} 
 
         return term
+    def _assemble_qterm_normalized(self, field, comparison, value):
+        """This function creates a pymongo query language dictionary for a string comparison that is done against the normalized copy of the field in the document's "_search" sub-document (see the search_fields module), instead of against the field itself. The value is normalized the same way the documents are (case-folded, with accents stripped), so every comparison is a plain equality match that MongoDB can answer with an index. For "equals" and "notcontains", the whole normalized value is compared against the normalized field. For "contains", each word of the value is compared against the normalized words of the field, so unlike _assemble_qterm_str, "contains" matches whole words rather than any part of the field. If the value has no words at all (e.g. it is only punctuation), this falls back to _assemble_qterm_str.
+
+        args:
+            * field (str): The field to query for. Must be one of search_fields.NORMALIZED_FIELDS.
+            * comparison (str): The comparison operator to use to compare the field's value against the specified value.
+            * value (str or list): The value(s) to compare against.
+
+        returns:
+            * dict. The query term in pymongo query language.
+        """
+        values = value if type(value) is list else [value]
+
+        if comparison == 'contains':
+            tokens_path = normalized_field_path(field, 'tokens')
+            value_tokens = [ tokenize_str(val) for val in values ]
+            if any([ len(tokens) == 0 for tokens in value_tokens ]):
+                return self._assemble_qterm_str(field, comparison, value)
+            if all([ len(tokens) == 1 for tokens in value_tokens ]):
+                words = [ tokens[0] for tokens in value_tokens ]
+                return {tokens_path:words[0]} if len(words) == 1 else {tokens_path:{'$in':words}}
+            # a value with more than one word matches documents that have all of its words
+            terms = [ {tokens_path:{'$all':tokens}} if len(tokens) > 1 else {tokens_path:tokens[0]} for tokens in value_tokens ]
+            return terms[0] if len(terms) == 1 else {'$or':terms}
+
+        exact_path = normalized_field_path(field, 'exact')
+        normalized_values = [ normalize_str(val) for val in values ]
+        if comparison == 'notcontains':
+            return {exact_path:{'$nin':normalized_values}} if type(value) is list else {exact_path:{'$ne':normalized_values[0]}}
+        return {exact_path:{'$in':normalized_values}} if type(value) is list else {exact_path:normalized_values[0]}
+
     def _assemble_qterm_num(self, field, comparison, value):
         """This function assembles a pymongo query language dictionary out of a given field, comparison, and value where the field is a numeric field, meaning that term does a number comparison.
 
@@ -478,12 +601,13 @@ class Query():
 
         return valid_meas_types
 
-    def _get_meas_value_variations(self, valid_meas_types, val_terms):
+    def _get_meas_value_variations(self, valid_meas_types, val_terms, value_field='value'):
         """The type of value (e.g. central value, upper limit, confidence, etc.) in the measurement value list for each measurement results object for a document in the database depends on the measurement type ("measurement", "limit", "range") for the corresponding measurement results object ("measurement", "limit", "range"). For example, if one of the measurement results objects for a document has a "value" of [1, 2], then 1 is the upper limit and 2 is the confidence if the "type" of the measurement results object is "limit". But if the "type" is "measurement", then 1 is the central value and 2 is the symmetric error. Thus, we must assemble sub-terms for the query where the measurement type is specified along with the corresponding value comparison. This function facilitates the assembly of sub-terms for each measurement type, and the corresponding value comparisons for each of those measurement type terms.
 
         args:
             * valid_meas_types (list of str): The list of measurement types that were determined to be applicable to this query, given the measurement value comparisons and whether the user specified one measurement type.
             * val_terms (list of dict): A list of individual terms that each query for a measurement result object's value.
+            * value_field (str) (optional): The field of the measurement result objects that holds the values to compare against. This is "value" (the default), or "value_si" if the values are compared in SI units.
 
         returns:
             * list of dict. One pymongo query for each of the valid measurement types. Each query queries for the value and the measurement type.
@@ -504,35 +628,35 @@ class Query():
 
             # the "measurement" type is the only one with a single value that we can compare "eq" against
             if comparison == 'eq' and 'measurement' in valid_meas_types:
-                meas_obj['measurement'].append({'value.0':{'$eq':value}})
+                meas_obj['measurement'].append({value_field+'.0':{'$eq':value}})
 
             # the "lt"/"lte" comparison can be done with any of the three measurement types
             elif comparison == 'lt':
                 if 'measurement' in valid_meas_types:
-                    meas_obj['measurement'].append({'value.0':{'$lt':value}}) # value 0 is the central value
+                    meas_obj['measurement'].append({value_field+'.0':{'$lt':value}}) # value 0 is the central value
                 if 'range' in valid_meas_types:
-                    meas_obj['range'].append({'value.1':{'$lt':value}}) # value 1 is the upper bound
+                    meas_obj['range'].append({value_field+'.1':{'$lt':value}}) # value 1 is the upper bound
                 if 'limit' in valid_meas_types:
-                    meas_obj['limit'].append({'value.0':{'$lt':value}}) # value 0 is the upper bound
+                    meas_obj['limit'].append({value_field+'.0':{'$lt':value}}) # value 0 is the upper bound
             elif comparison == 'lte':
                 if 'measurement' in valid_meas_types:
-                    meas_obj['measurement'].append({'value.0':{'$lte':value}})
+                    meas_obj['measurement'].append({value_field+'.0':{'$lte':value}})
                 if 'range' in valid_meas_types:
-                    meas_obj['range'].append({'value.1':{'$lte':value}})
+                    meas_obj['range'].append({value_field+'.1':{'$lte':value}})
                 if 'limit' in valid_meas_types:
-                    meas_obj['limit'].append({'value.0':{'$lte':value}})
+                    meas_obj['limit'].append({value_field+'.0':{'$lte':value}})
 
             # the "limit" type only has an upper bound, so we have to exclude it from queries that include a "eq"/"gt"/"gte" comparison
             elif comparison == 'gt':
                 if 'measurement' in valid_meas_types:
-                    meas_obj['measurement'].append({'value.0':{'$gt':value}})
+                    meas_obj['measurement'].append({value_field+'.0':{'$gt':value}})
                 if 'range' in valid_meas_types:
-                    meas_obj['range'].append({'value.0':{'$gt':value}}) # value 0 is the lower bound
+                    meas_obj['range'].append({value_field+'.0':{'$gt':value}}) # value 0 is the lower bound
             elif comparison == 'gte':
                 if 'measurement' in valid_meas_types:
-                    meas_obj['measurement'].append({'value.0':{'$gte':value}})
+                    meas_obj['measurement'].append({value_field+'.0':{'$gte':value}})
                 if 'range' in valid_meas_types:
-                    meas_obj['range'].append({'value.0':{'$gte':value}})
+                    meas_obj['range'].append({value_field+'.0':{'$gte':value}})
 
             return meas_obj
 
@@ -551,7 +675,7 @@ class Query():
                 term = self._assemble_qterm_str('type', 'equals', meas_type) # this func will return a dictionary we can add fields and their comparisons/values to
 
                 for val_ele in meas_obj[meas_type]:
-                    val_field = list(val_ele.keys())[0] # we expect field to be one of: "value.0" or "value.1"
+                    val_field = list(val_ele.keys())[0] # we expect field to be one of: "value.0" or "value.1" (or "value_si.0" or "value_si.1")
                     val_comp = list(val_ele[val_field].keys())[0] # we expect the first sub-field to be the comparison operator
                     val_val = val_ele[val_field][val_comp] # we expect the sub-sub field to be the number to compare against
 
@@ -575,38 +699,73 @@ class Query():
         aggregated_terms = _aggregate_value_variations(meas_obj)
         return aggregated_terms
 
-    def _assemble_meas_result_terms(self, val_terms, isotope_terms, unit_term):
-        """This function combines all the separately assembled sub-terms for this measurement result query term. Each sub-term is a valid pymongo query dictionary on its own, so all the dictionaries are combined together to be used in the final query.
+    def _merge_synonym_terms(self, term):
+        """Rewrites a string term that _assemble_qterm_str made for a list of synonyms, so that it compares one field instead of joining one term per synonym with "$or" or "$and". This lets the term be combined with the other sub-terms of a measurement results term inside one "$elemMatch". "Contains" terms ({'$or':[{field:{'$regex':<regex>}}, ...]}) become {field:{'$in':[<regex>, ...]}}, and "notcontains" terms ({'$and':[{field:{'$not':<regex>}}, ...]}) become {field:{'$nin':[<regex>, ...]}}, which match the same documents. Any other term is returned as is.
+
+        args:
+            * term (dict): A valid pymongo query for one string field.
+
+        returns:
+            * dict. The equivalent pymongo query, which compares one field.
+        """
+        term_keys = list(term.keys())
+        if len(term_keys) != 1 or term_keys[0] not in ['$or', '$and']:
+            return term
+        list_operator, sub_operator = ('$in', '$regex') if term_keys[0] == '$or' else ('$nin', '$not')
+        sub_terms = term[term_keys[0]]
+        fields = set([ field for sub_term in sub_terms for field in sub_term.keys() ])
+        if len(fields) != 1 or not all([ type(sub_term[field]) is dict and list(sub_term[field].keys()) == [sub_operator] for sub_term in sub_terms for field in sub_term.keys() ]):
+            return term
+        field = fields.pop()
+        return {field:{list_operator:[ sub_term[field][sub_operator] for sub_term in sub_terms ]}}
+
+    def _assemble_meas_result_terms(self, val_terms, isotope_term, unit_term):
+        """This function combines all the separately assembled sub-terms for this measurement result query term into one "$elemMatch" on the measurement results. The isotope and unit sub-terms each compare one field (a list of synonyms is compared with "$in" rather than an "$or" of terms), so they are added to the element match as they are. If there is more than one value sub-term (one for each of the valid measurement types), they are joined with an "$or" inside the element match, rather than making one whole "$elemMatch" term for every combination of value sub-term and isotope synonym, so MongoDB can answer the query with one scan of the measurement results index.
 
         args:
             * val_terms (list of dict): A list of valid pymongo queries for the value and the measurement type.
-            * isotope_terms (dict): A valid pymongo query that queries for the measurement isotope.
+            * isotope_term (dict): A valid pymongo query that queries for the measurement isotope.
             * unit_term (dict): A valid pymongo query that queries for the measurement unit.
 
         returns:
-            * dict or list of dict. A valid pymongo query which is the result of combining the sub-terms which specify the isotope, unit, and values to search for.
-        """
-        combined_terms = []
-        if len(val_terms) > 0 and len(isotope_terms) > 0:
-            for val_term in val_terms:
-                for isotope_term in isotope_terms:
-                    combined_terms.append({**val_term, **isotope_term, **unit_term})
-        elif len(isotope_terms) > 0:
-            for isotope_term in isotope_terms:
-                combined_terms.append({**isotope_term, **unit_term})
-        elif len(val_terms) > 0:
-            for val_term in val_terms:
-                combined_terms.append({**val_term, **unit_term})
-        else:
-            combined_terms = [unit_term]
-        
-        combined_terms = [{"measurement.results":{"$elemMatch":term}} for term in combined_terms]
+            * dict. A valid pymongo query which is the result of combining the sub-terms which specify the isotope, unit, and values to search for.
+        """
+        elem_match = {**self._merge_synonym_terms(isotope_term), **self._merge_synonym_terms(unit_term)}
+        if len(val_terms) == 1:
+            elem_match.update(val_terms[0])
+        elif len(val_terms) > 1:
+            elem_match['$or'] = val_terms
+        return {"measurement.results":{"$elemMatch":elem_match}}
 
-        if len(combined_terms) > 1:
-            combined_terms = {'$or':combined_terms}
-        else:
-            combined_terms = combined_terms[0]
-        return combined_terms
+    def _get_si_value_terms(self, val_terms, isotope_term, unit_term):
+        """Converts the value terms of one consolidated group of measurement results terms into SI units (see the unit_conversion module), so that they can be compared against the "value_si" fields of the measurement results, which hold every result's values in the same unit regardless of the unit it was recorded in. Masses are converted into activities for isotopes with a known specific activity, so the isotope the group queries for is needed to convert a mass unit. The values can only be converted if the group has a unit term that is an "equals" comparison against one unit and, for mass units, an isotope term that is an "equals" comparison.
+
+        args:
+            * val_terms (list of dict): The terms in the group where the field is "value".
+            * isotope_term (dict): The term in the group where the field is "isotope", or None if there is not one.
+            * unit_term (dict): The term in the group where the field is "unit", or None if there is not one.
+
+        returns:
+            * list of dict. Copies of the value terms, with their values converted into the SI unit.
+            * dict. The pymongo query that replaces the unit term, which compares the "unit_si" field against the SI unit.
+            If the values cannot be converted, None is returned instead of the two values.
+        """
+        if unit_term is None or unit_term['comparison'] != 'eq' or type(unit_term['value']) is list:
+            return None
+
+        isotope = None
+        if isotope_term is not None and isotope_term['comparison'] == 'eq':
+            # with synonyms, the value is a list of names for the isotope, and only the one in specific_activities.csv can be used to convert masses
+            isotope_names = isotope_term['value'] if type(isotope_term['value']) is list else [isotope_term['value']]
+            specific_activities = { name.casefold():name for name in get_specific_activities().keys() }
+            isotope = next(( specific_activities[name.casefold()] for name in isotope_names if name.casefold() in specific_activities ), isotope_names[0])
+
+        conversion = get_si_conversion(unit_term['value'], isotope)
+        if conversion is None:
+            return None
+        si_unit, factor = conversion
+        si_val_terms = [ {**term, 'value':term['value']*factor} for term in val_terms ]
+        return si_val_terms, {'unit_si':si_unit}
 
     def _assemble_qterm_meas_results(self, terms):
         """This function orchestrates the conversion of one consolidated group of measurement results query terms into a valid pymongo query. It iterates over the each term in the consolidated group and consolidates them based on the field they compare. This is because, in MongoDB, if multiple query terms compare the same field, they can be consolidated into one sub-term within the $elemMatch operator. This function assumes a user may specify multiple terms comparing a measurement result object's value. It also assumes that only one measurement type, isotope, and unit is specified. 
@@ -620,8 +779,10 @@ This function assumes a user may specify multiple terms comparing a measurement
             * dict. The fully-consolidated query term in MongoDB query format.
         """
         val_terms_raw = []
-        isotope_terms = []
+        isotope_term = {}
         unit_term = {}
+        raw_isotope_term = None
+        raw_unit_term = None
         specified_measurement_type = None
 
         # the terms object is the list of all consolidated meas results terms in an "and"ed list of terms
@@ -640,30 +801,63 @@ This function assumes a user may specify multiple terms comparing a measurement
             elif field == 'isotope':
                 # we expect at most one term specifying an isotope symbol
                 # "value" should be an isotope symbol, e.g. "K-40"
-                isotope_terms = self._assemble_qterm_str(field, comparison, value)
-                term_keys = list(isotope_terms.keys())
-                if len(term_keys) == 1 and term_keys[0] in ['$and', '$or']:
-                    # term would start with "$and" or "$or" if the value is a list of terms (e.g. synonyms: ['K-40', "potassium'])
-                    # we want the list of terms that are being "and"ed or "or"ed together, e.g. {'$or': [{'isotope':{'$eq':'K-40'}}, {'isotope':{'$eq':'potassium'}}]}
-                    isotope_terms = isotope_terms.pop(term_keys[0])
-                else:
-                    # in _assemble_meas_result_terms, the isotope_terms field is expected to be a list, so we convert this into a one-element list, e.g. {'isotope':{'$eq':'K-40'}} ==> [{'isotope':{'$eq':'K-40'}}]
-                    isotope_terms = [isotope_terms]
+                raw_isotope_term = raw_term
+                isotope_term = self._assemble_qterm_str(field, comparison, value)
             elif field == 'unit':
                 # we expect at most one term specifying a measurement unit
                 # "value" should be a measurement unit, e.g. "g" or "ppm"
+                raw_unit_term = raw_term
                 unit_term = self._assemble_qterm_str(field, comparison, value)
             else:
                 print("field wasn't in [value, type, isotope, unit]")
                 terms = None
 
+        value_field = 'value'
+        if self.use_si_values and len(val_terms_raw) > 0:
+            si_terms = self._get_si_value_terms(val_terms_raw, raw_isotope_term, raw_unit_term)
+            if si_terms is not None:
+                val_terms_raw, unit_term = si_terms
+                value_field = 'value_si'
+
         valid_meas_types = self._get_valid_meas_types(val_terms_raw, specified_measurement_type)
-        val_terms = self._get_meas_value_variations(valid_meas_types, val_terms_raw)
-        term = self._assemble_meas_result_terms(val_terms, isotope_terms, unit_term)
+        val_terms = self._get_meas_value_variations(valid_meas_types, val_terms_raw, value_field)
+        term = self._assemble_meas_result_terms(val_terms, isotope_term, unit_term)
         return term
 
+    def _plan_cache_key(self):
+        """Creates the key that this query is stored under in the query plan cache. The human-readable query string fully describes the terms and appends lists (their values have already been validated, so two different queries cannot share a string), so it is used as the key, along with whether the query is compiled against the normalized fields and the SI values.
+
+        returns:
+            * tuple of (bool, bool, str). The query plan cache key for this query.
+        """
+        return (self.use_normalized_fields, self.use_si_values, self.to_string())
     def to_query_language(self):
-        """This function converts the terms and appends lists into a valid pymongo query. It starts by consolidating the query terms that deal with measurement results dicts (for a description of why we do this, see the documentation for _consolidate_measurement_results). The order of the terms and appends lists matter when assembling the final query, since the Query class creates the query in the order in which the terms were added. For each query term (where some terms are now consolidated), the field, comparison, and value are converted into a valid pymongo query based on the type of the query ("all", measurement results, date comparison, string comparison, number comparison). Then the query created for the given term is added, using the corresponding append mode, to the main query.
+        """This function converts the terms and appends lists into a valid pymongo query. Compiling a query is fairly expensive, so compiled queries are kept in a least-recently-used cache (the "query plan cache") keyed by the human-readable query string, and a query that has been compiled before is copied out of the cache instead of being compiled again. See _assemble_query_language for how queries are compiled.
+
+        returns:
+            * dict. The query dict in pymongo query language.
+        """
+        key = self._plan_cache_key()
+        with _query_plan_cache_lock:
+            cached_query = _query_plan_cache.get(key)
+            if cached_query is not None:
+                _query_plan_cache.move_to_end(key)
+                _query_plan_cache_stats["hits"] += 1
+            else:
+                _query_plan_cache_stats["misses"] += 1
+        # the caller owns the returned dict, so it must never be the cached dict itself
+        if cached_query is not None:
+            return deepcopy(cached_query)
+
+        query = self._assemble_query_language()
+        with _query_plan_cache_lock:
+            _query_plan_cache[key] = deepcopy(query)
+            _query_plan_cache.move_to_end(key)
+            while len(_query_plan_cache) > QUERY_PLAN_CACHE_SIZE:
+                _query_plan_cache.popitem(last=False)
+        return query
+    def _assemble_query_language(self):
+        """This function compiles the terms and appends lists into a valid pymongo query. It starts by consolidating the query terms that deal with measurement results dicts (for a description of why we do this, see the documentation for _consolidate_measurement_results). The order of the terms and appends lists matter when assembling the final query, since the Query class creates the query in the order in which the terms were added. For each query term (where some terms are now consolidated), the field, comparison, and value are converted into a valid pymongo query based on the type of the query ("all", measurement results, date comparison, string comparison, number comparison). Then the query created for the given term is added, using the corresponding append mode, to the main query. Finally, the query is simplified with _optimize_query_language.
 
         returns:
             * dict. The query dict in pymongo query language.
@@ -694,6 +888,8 @@ This function assumes a user may specify multiple terms comparing a measurement
                 term = self._assemble_qterm_meas_results(value)
             elif field in self.date_fields:
                 term = self._assemble_qterm_date(field, comparison, value)
+            elif field in self.str_fields and self.use_normalized_fields and field in NORMALIZED_FIELDS:
+                term = self._assemble_qterm_normalized(field, comparison, value)
             elif field in self.str_fields:
                 term = self._assemble_qterm_str(field, comparison, value)
             else:
@@ -705,7 +901,68 @@ This function assumes a user may specify multiple terms comparing a measurement
             else:
                 query = {append_mode:[term, query]}
 
-        return query
+        return self._optimize_query_language(query)
+
+    def _optimize_query_language(self, query):
+        """Simplifies a compiled query without changing which documents it matches. _assemble_query_language nests every appended term in its own "$and" or "$or" with the rest of the query, so a chain of ten terms becomes ten levels of two-element lists. This flattens "$and" and "$or" lists that are nested in a list with the same operator, removes terms that match every document (the empty term of an empty "all" search) from "$and" lists, removes duplicate terms, and merges comparisons of the same field in an "$and" list into one term (e.g. {'$and':[{'measurement.date.0':{'$gte':a}}, {'measurement.date.0':{'$lt':b}}]} becomes {'measurement.date.0':{'$gte':a, '$lt':b}}, which also matches the same documents when the field is an array). A list that is left with one term is replaced by that term. Flatter queries are planned faster by MongoDB, and equivalent queries compile to the same dict, so they share MongoDB's plan cache entries and the toolkit's result cache entries.
+
+        args:
+            * query (dict): A valid pymongo query.
+
+        returns:
+            * dict. The simplified pymongo query.
+        """
+        comparison_operators = ['$eq', '$lt', '$lte', '$gt', '$gte']
+
+        def _is_comparison_term(term):
+            # a term that compares one field with only the operators in comparison_operators, e.g. {'measurement.date.0':{'$gte':<date>}}
+            if len(term) != 1:
+                return False
+            field, condition = next(iter(term.items()))
+            return not field.startswith('$') and type(condition) is dict and len(condition) > 0 and all([ operator in comparison_operators for operator in condition.keys() ])
+
+        def _merge_comparisons(terms):
+            merged_terms = []
+            for term in terms:
+                if _is_comparison_term(term):
+                    field, condition = next(iter(term.items()))
+                    target = next(( merged for merged in merged_terms if _is_comparison_term(merged) and field in merged ), None)
+                    # a field can only be compared once with each operator in one term
+                    if target is not None and not any([ operator in target[field] for operator in condition.keys() ]):
+                        target[field] = {**target[field], **condition}
+                        continue
+                    term = {field:dict(condition)}
+                merged_terms.append(term)
+            return merged_terms
+
+        def _optimize(term):
+            keys = list(term.keys())
+            if len(keys) != 1 or keys[0] not in ['$and', '$or']:
+                return term
+            operator = keys[0]
+
+            terms = []
+            for sub_term in term[operator]:
+                sub_term = _optimize(sub_term)
+                sub_terms = sub_term[operator] if list(sub_term.keys()) == [operator] else [sub_term]
+                for flat_term in sub_terms:
+                    if flat_term == {}:
+                        if operator == '$or':
+                            # one of the alternatives matches every document, so the whole "$or" does
+                            return {}
+                        continue
+                    if flat_term not in terms:
+                        terms.append(flat_term)
+
+            if operator == '$and':
+                terms = _merge_comparisons(terms)
+            if len(terms) == 0:
+                return {}
+            if len(terms) == 1:
+                return terms[0]
+            return {operator:terms}
+
+        return _optimize(query)
 
     def _comparison_to_human(self, comparison):
         """Converts the query term comparison operator from internal Query class format to human-readable format. This uses a dictionary as a lookup table, where the keys are comparison operators in internal Query class format, and the values are the corresponding comparison operators in human-readable format.
@@ -772,6 +1029,73 @@ This function assumes a user may specify multiple terms comparing a measurement
 
         return query 
 
+    def to_state(self):
+        """This function serializes the query terms and appends lists into a compact JSON string, tagged with QUERY_STATE_VERSION. Unlike the human-readable string from to_string, the state can be turned back into a Query object with from_state without parsing each line and looking up synonyms again, so a query that is being built up one term at a time (e.g. on the UI's search page) can be carried between requests and extended without re-loading the whole query each time.
+
+        returns:
+            * str. The query state, in the format {"v":<version>, "terms":[<term>, ...], "appends":[<append mode>, ...]}.
+        """
+        return json.dumps({"v":QUERY_STATE_VERSION, "terms":self.terms, "appends":self.appends}, separators=(',', ':'))
+
+    @classmethod
+    def from_state(cls, state, use_normalized_fields=None, use_si_values=None):
+        """This function creates a Query object from a query state made by to_state. The terms were already validated against each other and had their synonyms found when they were added to the Query object the state was made from, so their synonyms are not looked up again. Since the state may have passed through a client (e.g. in a form field), the format of the state and each term's field, comparison, value, and append mode are checked (every term after the first must have an append mode of "AND" or "OR"), and each term is checked against the terms before it the way add_query_term checks new terms.
+
+        args:
+            * state (str): The query state, as returned by to_state.
+            * use_normalized_fields (bool) (optional): Passed on to the new Query object (see __init__).
+            * use_si_values (bool) (optional): Passed on to the new Query object (see __init__).
+
+        returns:
+            * Query. The Query object with the terms and appends of the state. If the state is not valid, an error message is printed and None is returned.
+        """
+        query = cls(use_normalized_fields=use_normalized_fields, use_si_values=use_si_values)
+        try:
+            state = json.loads(state)
+        except (TypeError, ValueError):
+            print('Error: the query state is not valid JSON')
+            return None
+        if type(state) is not dict or state.get('v') != QUERY_STATE_VERSION:
+            print('Error: the query state is not a version '+str(QUERY_STATE_VERSION)+' query state')
+            return None
+        terms = state.get('terms')
+        appends = state.get('appends')
+        if type(terms) is not list or type(appends) is not list or len(appends) != max(len(terms)-1, 0):
+            print('Error: the query state must have a list of terms and one fewer appends')
+            return None
+
+        for i, term in enumerate(terms):
+            if type(term) is not dict or sorted(term.keys()) != ['comparison', 'field', 'value']:
+                print('Error: each term in the query state must have only a field, comparison, and value')
+                return None
+            append_type = appends[i-1] if i > 0 else ''
+            is_valid, error_msg = query._validate_append_mode(append_type)
+            if is_valid and i > 0 and append_type == '':
+                # an empty append mode only marks the first term; a later empty one would be compiled as $or without splitting the measurement results groups, dropping terms
+                is_valid = False
+                error_msg = 'Error: append mode '+str(append_type)+' not one of: '+str(query.valid_append_modes)
+            if is_valid:
+                is_valid, error_msg = query._validate_field_name(term['field'])
+            if is_valid:
+                is_valid, error_msg = query._validate_comparison(term['field'], term['comparison'])
+            if is_valid:
+                is_valid, error_msg = query._validate_value(term['field'], term['value'])
+            # the terms are checked against the terms before them, as add_query_term does
+            if is_valid:
+                is_valid, error_msg = query._validate_term_against_other_terms(term['field'], term['comparison'], term['value'])
+            if is_valid and term['field'] == 'all' and 'all' in query.all_fields:
+                # add_query_term combines every "all" term into one, since a query can only have one $text term
+                is_valid = False
+                error_msg = 'Error: a query state can only have one term searching all fields'
+            if not is_valid:
+                print(error_msg)
+                return None
+            query.terms.append(term)
+            query.all_fields.append(term['field'])
+
+        query.appends = appends
+        return query
+
     #'''
     def _validate_append_mode(self, append_type):
         msg = ''
@@ -815,6 +1139,7 @@ This function assumes a user may specify multiple terms comparing a measurement
                 for ele in value:
                     if type(ele) is not str:
                         msg = 'Error: when comparing against the '+field+' field, you must enter a string type value or list of strings. You entered a list which contains an element of type '+str(type(ele))
+                        is_valid = False
             elif type(value) is not str:
                 msg = 'Error: when comparing against the '+field+' field, you must enter a string type value or list of strings. You entered '+str(value)+' which is type '+str(type(value))
                 is_valid = False
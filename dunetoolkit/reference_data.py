@@ -0,0 +1,181 @@
+"""
+.. module:: reference_data
+   :synopsis: Loads the reference data files that ship with the toolkit (synonyms.txt, isotopes.csv, units.csv, unit_conversions.csv, and specific_activities.csv) once per process and shares the parsed, read-only contents with every Query object, DuneValidator, and toolkit function that needs them.
+
+.. moduleauthor:: Elise Saxon
+"""
+
+import os
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+# the directory that the reference data files are read from
+REFERENCE_DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# if True, every lookup checks the modification time of the reference data file and re-reads the file if it has changed. This is off by default, since the files only change when the toolkit is updated, but it can be turned on by setting the environment variable TOOLKIT_RELOAD_REFERENCE_DATA to "true" (or by setting this variable directly) while editing the files.
+RELOAD_ON_CHANGE = os.getenv('TOOLKIT_RELOAD_REFERENCE_DATA', '').strip().lower() == 'true'
+
+SynonymTable = namedtuple('SynonymTable', ['groups', 'index', 'words'])
+SynonymTable.__doc__ = """The parsed contents of synonyms.txt.
+
+    * groups (tuple of tuple of str): Each element is one group of words that are all synonyms of each other, in the order they appear in the file.
+    * index (mappingproxy): Maps each case-folded word to the index of its group in "groups". If a word appears in more than one group, it maps to the first one.
+    * words (tuple of str): The keys of "index" in sorted order, so that words starting with a given prefix can be found with a binary search.
+"""
+
+# parsed reference data files, keyed by file name. Each value is a tuple of (file modification time, parsed contents).
+_reference_data = {}
+_reference_data_lock = threading.Lock()
+_generation = 0
+
+
+def _parse_synonyms(read_file):
+    """Parses the synonyms file, where each line is a comma-separated list of strings where each string is a synonym for the others in the line.
+
+    args:
+        * read_file (file object): The open synonyms file.
+
+    returns:
+        * SynonymTable. The synonyms lookup tables.
+    """
+    groups = []
+    index = {}
+    for line in read_file:
+        line_elements = tuple([ ele.strip() for ele in line.strip().split(',') if ele.strip() != '' ])
+        if len(line_elements) == 0:
+            continue
+        for word in line_elements:
+            index.setdefault(word.casefold(), len(groups))
+        groups.append(line_elements)
+    return SynonymTable(tuple(groups), MappingProxyType(index), tuple(sorted(index.keys())))
+
+def _parse_csv_line(read_file):
+    """Parses a file that consists of one line of comma-separated strings, like isotopes.csv and units.csv.
+
+    args:
+        * read_file (file object): The open file.
+
+    returns:
+        * tuple of str. The strings in the file, in order.
+    """
+    return tuple(read_file.read().strip().split(','))
+
+def _parse_unit_conversions(read_file):
+    """Parses the unit conversions file, which has a header line and then one "<unit>,<SI unit>,<factor>" line for each unit in units.csv, where multiplying a value in the unit by the factor converts it into the SI unit.
+
+    args:
+        * read_file (file object): The open file.
+
+    returns:
+        * mappingproxy. Maps each unit to a tuple of (SI unit (str), conversion factor (float)).
+    """
+    conversions = {}
+    for line in list(read_file)[1:]:
+        line_elements = [ ele.strip() for ele in line.strip().split(',') ]
+        if len(line_elements) == 3:
+            conversions[line_elements[0]] = (line_elements[1], float(line_elements[2]))
+    return MappingProxyType(conversions)
+
+def _parse_specific_activities(read_file):
+    """Parses the specific activities file, which has a header line and then one "<isotope>,<specific activity>" line for each isotope whose mass can be converted into an activity, where the specific activity is in Bq per gram. For K-40, the specific activity is per gram of natural potassium, since K-40 concentrations are conventionally reported as concentrations of potassium.
+
+    args:
+        * read_file (file object): The open file.
+
+    returns:
+        * mappingproxy. Maps each isotope to its specific activity (float).
+    """
+    activities = {}
+    for line in list(read_file)[1:]:
+        line_elements = [ ele.strip() for ele in line.strip().split(',') ]
+        if len(line_elements) == 2:
+            activities[line_elements[0]] = float(line_elements[1])
+    return MappingProxyType(activities)
+
+def _get_reference_data(file_name, parse_func):
+    """Returns the parsed contents of one of the reference data files, reading and parsing the file only if it has not been loaded yet (or, if RELOAD_ON_CHANGE is True, if it has changed since it was loaded).
+
+    args:
+        * file_name (str): The name of the file in REFERENCE_DATA_DIR.
+        * parse_func (function): Parses the open file into its read-only contents.
+
+    returns:
+        * The parsed contents of the file, as returned by parse_func.
+    """
+    global _generation
+    cached = _reference_data.get(file_name)
+    if cached is not None and not RELOAD_ON_CHANGE:
+        return cached[1]
+
+    filepath = os.path.join(REFERENCE_DATA_DIR, file_name)
+    mtime = os.path.getmtime(filepath)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with _reference_data_lock:
+        cached = _reference_data.get(file_name)
+        if cached is None or cached[0] != mtime:
+            with open(filepath, 'r') as read_file:
+                contents = parse_func(read_file)
+            if cached is not None:
+                _generation += 1
+            cached = (mtime, contents)
+            _reference_data[file_name] = cached
+    return cached[1]
+
+def get_synonyms():
+    """Gets the contents of synonyms.txt.
+
+    returns:
+        * SynonymTable. The synonym groups and the lookup tables used to search them.
+    """
+    return _get_reference_data('synonyms.txt', _parse_synonyms)
+
+def get_isotopes():
+    """Gets the contents of isotopes.csv.
+
+    returns:
+        * tuple of str. The names of all valid isotopes (e.g. "K-40").
+    """
+    return _get_reference_data('isotopes.csv', _parse_csv_line)
+
+def get_units():
+    """Gets the contents of units.csv.
+
+    returns:
+        * tuple of str. The names of all valid units (e.g. "ppm").
+    """
+    return _get_reference_data('units.csv', _parse_csv_line)
+
+def get_unit_conversions():
+    """Gets the contents of unit_conversions.csv.
+
+    returns:
+        * mappingproxy. Maps each unit (e.g. "ppb") to a tuple of its SI unit (e.g. "g/g") and the factor that converts a value into the SI unit (e.g. 1e-9).
+    """
+    return _get_reference_data('unit_conversions.csv', _parse_unit_conversions)
+
+def get_specific_activities():
+    """Gets the contents of specific_activities.csv.
+
+    returns:
+        * mappingproxy. Maps each isotope (e.g. "U-238") to its specific activity in Bq per gram.
+    """
+    return _get_reference_data('specific_activities.csv', _parse_specific_activities)
+
+def reference_data_generation():
+    """Gets the number of times any reference data file has been re-read after changing. Anything that is built from the reference data (e.g. a compiled validator) can store this number and rebuild itself when it changes.
+
+    returns:
+        * int. The reference data generation.
+    """
+    return _generation
+
+def reload_reference_data():
+    """Forgets all of the loaded reference data, so that every file is read again the next time it is used, regardless of RELOAD_ON_CHANGE.
+    """
+    global _generation
+    with _reference_data_lock:
+        _reference_data.clear()
+        _generation += 1
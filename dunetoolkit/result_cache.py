@@ -0,0 +1,220 @@
+"""
+.. module:: result_cache
+   :synopsis: An optional cache of search results, so that repeated identical searches can be answered without querying MongoDB. Results are keyed by the collection, the compiled query, and the projection, and each collection has a generation number that the toolkit's write functions bump, which invalidates every cached result for that collection at once.
+
+.. moduleauthor:: Elise Saxon
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from copy import deepcopy
+from collections import OrderedDict
+
+# if True, search results are cached in a LocalResultCache the first time one is needed. This is off by default, since results can be up to RESULT_CACHE_TTL seconds out of date when the database is written to by anything other than the toolkit (or by another process, if a cache backend that is shared between processes is not set with set_result_cache), but it can be turned on by setting the environment variable TOOLKIT_RESULT_CACHE to "true".
+RESULT_CACHE_ENABLED = os.getenv('TOOLKIT_RESULT_CACHE', '').strip().lower() == 'true'
+
+# the maximum number of search results to keep in the default cache, which can be set with the environment variable TOOLKIT_RESULT_CACHE_SIZE
+RESULT_CACHE_SIZE = int(os.getenv('TOOLKIT_RESULT_CACHE_SIZE', '256'))
+
+# the number of seconds a search result stays in the default cache, which can be set with the environment variable TOOLKIT_RESULT_CACHE_TTL
+RESULT_CACHE_TTL = float(os.getenv('TOOLKIT_RESULT_CACHE_TTL', '60'))
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+_result_cache_stats = {"hits":0, "misses":0}
+
+
+class LocalResultCache():
+    """An in-process result cache that holds at most max_size results, evicting the least recently used result first, and forgets each result ttl seconds after it was stored. It is the default cache backend, and it is the stand-in for a backend that is shared between processes (e.g. one backed by Redis). Any object with the same get, set, get_generation, bump_generation, and clear methods can be used as a cache backend with set_result_cache.
+    """
+    def __init__(self, max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        """Creates an empty cache.
+
+        args:
+            * max_size (int) (optional): The maximum number of results to hold.
+            * ttl (float) (optional): The number of seconds each result is held for.
+
+        :ivar max_size (int): The maximum number of results to hold.
+        :ivar ttl (float): The number of seconds each result is held for.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key):
+        """Gets a cached result.
+
+        args:
+            * key (str): The key the result was stored under.
+
+        returns:
+            * The cached result, or None if there is no result for the key or it has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        """Stores a result, evicting the least recently used result if the cache is full.
+
+        args:
+            * key (str): The key to store the result under.
+            * value: The result.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic()+self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_generation(self, name):
+        """Gets the generation number of a collection.
+
+        args:
+            * name (str): The full name of the collection (e.g. "radiopurity_data.assays").
+
+        returns:
+            * int. The generation number, which is 0 until the collection is first written to.
+        """
+        with self._lock:
+            return self._generations.get(name, 0)
+
+    def bump_generation(self, name):
+        """Increments the generation number of a collection, so that none of the results that were cached for it are used again. The results themselves are left to be evicted as the cache fills up or they expire.
+
+        args:
+            * name (str): The full name of the collection.
+        """
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+    def clear(self):
+        """Removes every cached result.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+def get_result_cache():
+    """Gets the cache backend that search results are stored in, creating a LocalResultCache the first time it is needed if RESULT_CACHE_ENABLED is True.
+
+    returns:
+        * LocalResultCache (or another cache backend). The cache, or None if results are not being cached.
+    """
+    global _result_cache
+    if _result_cache is None and RESULT_CACHE_ENABLED:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = LocalResultCache()
+    return _result_cache
+
+def set_result_cache(cache):
+    """Sets the cache backend that search results are stored in, and resets the hit and miss counters. This turns result caching on (or, if cache is None, off) regardless of RESULT_CACHE_ENABLED.
+
+    args:
+        * cache (LocalResultCache or another cache backend): The cache, or None to stop caching results.
+    """
+    global _result_cache
+    with _result_cache_lock:
+        _result_cache = cache
+        _result_cache_stats["hits"] = 0
+        _result_cache_stats["misses"] = 0
+
+def _encode_key_part(obj):
+    """Encodes the values in a result cache key that JSON cannot, for result_cache_key. Compiled regexes (e.g. from "contains" terms) are encoded as their whole pattern and flags, since their repr is cut short for long patterns. Any other value (e.g. a datetime or an ObjectId) is encoded as its type and its string.
+    """
+    if isinstance(obj, re.Pattern):
+        return {"$regex":obj.pattern, "$flags":obj.flags}
+    return {"$type":type(obj).__name__, "$value":str(obj)}
+
+def result_cache_key(cache, collection, key_parts):
+    """Creates the key that a search result is stored under. It includes the collection's current generation number, so that a result that was cached before the collection was last written to is never found again. The key parts are serialized as JSON with sorted dict keys (see _encode_key_part for values that are not JSON), so the same query always makes the same key and different queries never do.
+
+    args:
+        * cache (LocalResultCache or another cache backend): The cache.
+        * collection (pymongo.collection.Collection): The collection that was searched.
+        * key_parts (tuple): Everything else that determines the result, e.g. the compiled query and the projection.
+
+    returns:
+        * str. The key.
+    """
+    generation = cache.get_generation(collection.full_name)
+    serialized = json.dumps([collection.full_name, generation, key_parts], sort_keys=True, separators=(',', ':'), default=_encode_key_part)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def get_cached_result(cache, key):
+    """Gets a copy of a cached search result, and counts it as a hit or a miss. A copy is returned so that callers can modify the documents (e.g. to format their dates) without changing the cached result.
+
+    args:
+        * cache (LocalResultCache or another cache backend): The cache.
+        * key (str): The key made by result_cache_key.
+
+    returns:
+        * The cached result, or None if it is not cached.
+    """
+    value = cache.get(key)
+    with _result_cache_lock:
+        _result_cache_stats["hits" if value is not None else "misses"] += 1
+    return deepcopy(value) if value is not None else None
+
+def cache_result(cache, key, value):
+    """Stores a copy of a search result in the cache.
+
+    args:
+        * cache (LocalResultCache or another cache backend): The cache.
+        * key (str): The key made by result_cache_key.
+        * value: The search result.
+    """
+    cache.set(key, deepcopy(value))
+
+def bump_collection_generation(collection):
+    """Invalidates every cached search result for a collection. The toolkit's functions that write to the database call this after every write.
+
+    args:
+        * collection (pymongo.collection.Collection): The collection that was written to.
+    """
+    cache = get_result_cache()
+    if cache is not None:
+        cache.bump_generation(collection.full_name)
+
+def result_cache_info():
+    """Reports how well the result cache is working.
+
+    returns:
+        * dict. Whether results are being cached ("enabled"), the number of cache hits ("hits") and misses ("misses") so far, and the hit rate ("hit_rate", the fraction of lookups that were hits, or 0 if there have not been any).
+    """
+    with _result_cache_lock:
+        hits = _result_cache_stats["hits"]
+        misses = _result_cache_stats["misses"]
+    return {
+        "enabled": get_result_cache() is not None,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits+misses) if hits+misses > 0 else 0
+    }
+
+def clear_result_cache():
+    """Removes every cached search result and resets the hit and miss counters.
+    """
+    cache = get_result_cache()
+    if cache is not None:
+        cache.clear()
+    with _result_cache_lock:
+        _result_cache_stats["hits"] = 0
+        _result_cache_stats["misses"] = 0
@@ -0,0 +1,79 @@
+"""
+.. module:: search_fields
+   :synopsis: Builds the normalized "_search" sub-document that is stored in every assay document alongside its string fields, so that string comparisons can be done with plain, indexed equality matches instead of case-insensitive regex scans.
+
+.. moduleauthor:: Elise Saxon
+"""
+
+import os
+import re
+import unicodedata
+
+# the name of the sub-document where the normalized copies of the string fields are stored
+SEARCH_FIELD = '_search'
+
+# the string fields that have a normalized copy in the "_search" sub-document. The measurement results fields are not included, since they are inside a list of objects and are searched with $elemMatch, and neither are the date fields.
+NORMALIZED_FIELDS = ["grouping", "sample.name", "sample.description", "sample.source", "sample.id", "sample.owner.name", "sample.owner.contact", "measurement.practitioner.name", "measurement.practitioner.contact", "measurement.technique", "measurement.institution", "measurement.description", "measurement.requestor.name", "measurement.requestor.contact", "data_source.reference", "data_source.input.name", "data_source.input.contact", "data_source.input.notes"]
+
+# if True, Query objects compile string terms on the fields in NORMALIZED_FIELDS into matches against the "_search" sub-document instead of the original fields. This is off by default, since every document in the collection must have its "_search" sub-document before it is turned on (see the backfill_search_fields command), but it can be turned on by setting the environment variable TOOLKIT_USE_NORMALIZED_FIELDS to "true".
+USE_NORMALIZED_FIELDS = os.getenv('TOOLKIT_USE_NORMALIZED_FIELDS', '').strip().lower() == 'true'
+
+_token_regex = re.compile(r'\w+')
+
+
+def normalize_str(value):
+    """Normalizes a string so that strings that differ only in case, accents, or spacing are equal: accents are stripped, the string is case-folded, and runs of whitespace are collapsed into one space.
+
+    args:
+        * value (str): The string to normalize.
+
+    returns:
+        * str. The normalized string.
+    """
+    decomposed = unicodedata.normalize('NFKD', value)
+    stripped = ''.join([ char for char in decomposed if not unicodedata.combining(char) ])
+    return ' '.join(stripped.casefold().split())
+
+def tokenize_str(value):
+    """Splits a string into its normalized words (runs of letters, digits, and underscores). Each word is only included once, in the order it first appears.
+
+    args:
+        * value (str): The string to tokenize.
+
+    returns:
+        * list of str. The normalized words in the string.
+    """
+    return list(dict.fromkeys(_token_regex.findall(normalize_str(value))))
+
+def normalized_field_path(field, kind):
+    """Gets the path in a document of one of the normalized copies of a string field.
+
+    args:
+        * field (str): The original field, e.g. "sample.name". Must be one of NORMALIZED_FIELDS.
+        * kind (str): Which normalized copy to get the path of. Must be "exact" (the whole normalized string) or "tokens" (the list of its normalized words).
+
+    returns:
+        * str. The path of the normalized copy, e.g. "_search.sample_name.exact".
+    """
+    return SEARCH_FIELD+'.'+field.replace('.', '_')+'.'+kind
+
+def build_search_fields(doc):
+    """Builds the "_search" sub-document for an assay document. For each field in NORMALIZED_FIELDS that has a string value in the document, it has an entry (named after the field, with "." replaced by "_") holding the normalized string under "exact" and its normalized words under "tokens".
+
+    args:
+        * doc (dict): The assay document.
+
+    returns:
+        * dict. The "_search" sub-document.
+    """
+    search_fields = {}
+    for field in NORMALIZED_FIELDS:
+        value = doc
+        for field_part in field.split('.'):
+            if not isinstance(value, dict):
+                value = None
+                break
+            value = value.get(field_part)
+        if isinstance(value, str):
+            search_fields[field.replace('.', '_')] = {"exact":normalize_str(value), "tokens":tokenize_str(value)}
+    return search_fields
@@ -0,0 +1,85 @@
+"""
+.. module:: unit_conversion
+   :synopsis: Converts measurement result values into SI units, so that the "value_si" and "unit_si" fields stored in every measurement result object can be compared directly no matter which unit the result was recorded in.
+
+.. moduleauthor:: Elise Saxon
+"""
+
+import os
+from dunetoolkit.reference_data import get_unit_conversions, get_specific_activities
+
+# the SI units of masses (or mass fractions, or masses per length, area, or volume) that can be converted into activities when the isotope's specific activity is known, mapped to the activity SI unit they are converted into and the factor that accounts for the different denominators (a mass fraction in g/g becomes an activity per kg)
+MASS_TO_ACTIVITY_UNITS = {
+    "g/g": ("Bq/kg", 1000.0),
+    "g": ("Bq", 1.0),
+    "g/m": ("Bq/m", 1.0),
+    "g/m2": ("Bq/m2", 1.0),
+    "g/m3": ("Bq/m3", 1.0)
+}
+
+# the number of values at the start of a measurement result's value list that are in the result's unit and get converted, for each measurement type. The other values are confidence levels, which are copied as-is.
+CONVERTED_VALUE_COUNTS = {
+    "measurement": 3,
+    "range": 2,
+    "limit": 1
+}
+
+# if True, Query objects compile measurement results terms that specify a unit into comparisons against the "value_si" and "unit_si" fields of the measurement results instead of the raw "value" and "unit" fields, so that results recorded in other units are found too. This is off by default, since every measurement result in the collection must have its SI values before it is turned on (see the backfill_si_values command), but it can be turned on by setting the environment variable TOOLKIT_USE_SI_VALUES to "true".
+USE_SI_VALUES = os.getenv('TOOLKIT_USE_SI_VALUES', '').strip().lower() == 'true'
+
+
+def get_si_conversion(unit, isotope=None):
+    """Gets the SI unit that values in the given unit are converted into, and the factor to multiply them by. Masses are converted into activities if the isotope's specific activity is known, so that, for example, U-238 results in ppb and in mBq/kg both end up in Bq/kg.
+
+    args:
+        * unit (str): The unit to convert from. Must be one of the units in units.csv.
+        * isotope (str) (optional): The isotope that was measured. If not provided, the isotope is unknown, so the SI unit of a mass cannot be determined (it depends on whether the isotope has a known specific activity).
+
+    returns:
+        * tuple of (str, float). The SI unit and the conversion factor. If the unit is not known, or it is a mass and the isotope is not provided, None is returned.
+    """
+    conversion = get_unit_conversions().get(unit)
+    if conversion is None:
+        return None
+    si_unit, factor = conversion
+    if si_unit in MASS_TO_ACTIVITY_UNITS:
+        if isotope is None:
+            return None
+        specific_activity = get_specific_activities().get(isotope)
+        if specific_activity is not None:
+            activity_unit, denominator_factor = MASS_TO_ACTIVITY_UNITS[si_unit]
+            return activity_unit, factor * specific_activity * denominator_factor
+    return si_unit, factor
+
+def build_si_values(meas_result):
+    """Builds the SI fields of a measurement result object: "value_si", a copy of its value list where the values that are in the result's unit are converted into the SI unit, and "unit_si", the SI unit.
+
+    args:
+        * meas_result (dict): The measurement result object, with "isotope", "type", "unit", and "value" fields.
+
+    returns:
+        * dict. A dict with the "value_si" and "unit_si" fields, or an empty dict if the result's unit cannot be converted.
+    """
+    conversion = get_si_conversion(meas_result.get('unit'), meas_result.get('isotope', ''))
+    if conversion is None:
+        return {}
+    si_unit, factor = conversion
+    num_converted = CONVERTED_VALUE_COUNTS.get(meas_result.get('type'), 0)
+    value_si = [ value * factor if i < num_converted else value for i, value in enumerate(meas_result.get('value', [])) ]
+    return {"value_si":value_si, "unit_si":si_unit}
+
+def add_si_values(meas_results):
+    """Adds (or replaces) the SI fields of every measurement result object in a list of measurement results.
+
+    args:
+        * meas_results (list of dict): The measurement result objects. They are not modified.
+
+    returns:
+        * list of dict. Copies of the measurement result objects, with their SI fields.
+    """
+    new_meas_results = []
+    for meas_result in meas_results:
+        new_meas_result = { key:val for key, val in meas_result.items() if key not in ['value_si', 'unit_si'] }
+        new_meas_result.update(build_si_values(new_meas_result))
+        new_meas_results.append(new_meas_result)
+    return new_meas_results
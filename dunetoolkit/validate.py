@@ -5,11 +5,15 @@
 .. moduleauthor:: Elise Saxon
 """
 
-import os
+import threading
 from datetime import datetime
-import json
 import jsonschema
 from jsonschema import validate, ValidationError
+from dunetoolkit.reference_data import get_isotopes, get_units, reference_data_generation
+
+# ready-to-use DuneValidator objects, keyed by (schema_type, datetime_str, reference data generation)
+_validator_cache = {}
+_validator_cache_lock = threading.Lock()
 
 class DuneValidator:
     """This class performs the validation of dictionary "documents" and partial documents according to the Material Assay Data Format (MADF) (https://www.sciencedirect.com/science/article/pii/S0168900216309639). All documents that are stored in the radiopurity database must adhere to this format, and this validator class facilitates that.
@@ -33,6 +37,9 @@ class DuneValidator:
         else:
             self.validator = self._init_validator_datetime_obj()
 
+        # create the jsonschema validator for the schema once, so that validating a document does not have to set it up again
+        self.compiled_validator = self.validator(schema=self.schema)
+
     def _init_validator_datetime_str(self):
         BaseVal = jsonschema.Draft7Validator 
         def _is_datetime_str(checker, val):
@@ -59,8 +66,8 @@ class DuneValidator:
         return Validator
 
     def _load_meas_result_schema(self):
-        valid_isotopes = open(os.path.dirname(os.path.abspath(__file__))+'/isotopes.csv', 'r').read().strip().split(',')
-        valid_units = open(os.path.dirname(os.path.abspath(__file__))+'/units.csv', 'r').read().strip().split(',')
+        valid_isotopes = list(get_isotopes())
+        valid_units = list(get_units())
         measurement_result_schema = {
             "type": "object",
             "additionalProperties": False,
@@ -69,7 +76,9 @@ class DuneValidator:
                 "isotope": {"type":"string", "enum":valid_isotopes},
                 "type": {"type":"string", "enum":["measurement", "limit", "range"]},
                 "unit": {"type":"string", "enum":valid_units},
-                "value": {"type":"array", "maxItems": 3, "items":{"type":"number"}}
+                "value": {"type":"array", "maxItems": 3, "items":{"type":"number"}},
+                "value_si": {"type":"array", "maxItems": 3, "items":{"type":"number"}},
+                "unit_si": {"type":"string"}
             }
         }
         return measurement_result_schema
@@ -168,6 +177,7 @@ class DuneValidator:
                 "_parent_id":{"type":"string"}, 
                 "specification":{"type":"string"}, 
                 "_version":{"type":"integer"},
+                "_search":{"type":"object"},
                 "type": {"type":"string", "default":"assay"},
                 "grouping": {"type":"string", "default":""},
                 "sample": sample_schema,
@@ -212,13 +222,47 @@ class DuneValidator:
     def validate(self, data):
         error_msg = ''
         try:
-            resp = self.validator(schema=self.schema).validate(data)
+            resp = self.compiled_validator.validate(data)
             success = True
         except ValidationError as e:
             success = False
             error_msg = e.message + ' in field: ' + '.'.join([ str(ele) for ele in list(e.absolute_path) ])
         return success, error_msg
 
+    def validate_many(self, docs):
+        """Validates each of the given documents with this validator's schema. The jsonschema validator is only set up once, no matter how many documents are validated, so this should be used when validating documents in bulk.
+
+        args:
+            * docs (list of dict): The documents (or partial documents) to validate.
+
+        returns:
+            * list of tuple. For each document, in the same order as docs, a tuple of whether the document is valid (bool) and the error message (str), which is an empty string if the document is valid.
+        """
+        return [ self.validate(doc) for doc in docs ]
+
+def get_validator(schema_type, datetime_str=False):
+    """Gets a DuneValidator for the given schema type. Setting up a DuneValidator (assembling its schema and the jsonschema validator for it) is much slower than validating a document with it, so each one is only created once per process and then shared. If the reference data that the schemas are built from (e.g. isotopes.csv) is reloaded, new validators are created.
+
+    args:
+        * schema_type (str): The type of document the validator validates (see DuneValidator).
+        * datetime_str (bool) (optional): Whether date fields are expected to be date strings instead of datetime objects (see DuneValidator).
+
+    returns:
+        * DuneValidator. The validator for the given schema type.
+    """
+    cache_key = (schema_type, datetime_str, reference_data_generation())
+    validator = _validator_cache.get(cache_key)
+    if validator is None:
+        with _validator_cache_lock:
+            validator = _validator_cache.get(cache_key)
+            if validator is None:
+                # validators for older reference data will never be used again
+                for old_key in [ key for key in _validator_cache.keys() if key[2] != cache_key[2] ]:
+                    del _validator_cache[old_key]
+                validator = DuneValidator(schema_type, datetime_str)
+                _validator_cache[cache_key] = validator
+    return validator
+
 def validate_meas_remove_indices(existing_doc, remove_indices):
     valid_str_comparisons = ["contains", "notcontains", "eq"]
     valid_num_comparisons = ["eq", "lt", "lte", "gt", "gte"]
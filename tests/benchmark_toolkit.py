@@ -0,0 +1,188 @@
+"""
+A standalone benchmark runner for the query compiler and the toolkit's hot paths. It is not collected by pytest (its name does not start with "test_"), since it takes much longer than the tests and its results depend on the machine it runs on. Run it from the tests directory, e.g.
+
+    python benchmark_toolkit.py --sizes 1000 100000 --output bench_v0.0.2.json
+    python benchmark_toolkit.py --sizes 1000 100000 --baseline bench_v0.0.1.json
+
+The database benchmarks load a synthetic corpus of each size (see dunetoolkit.generate) into the "dune_benchmark" database (which is dropped first) on a local mongod, or into mongomock with --mongomock. With --baseline, the median time of every benchmark is compared against a previous run, and the runner exits with status 1 if any of them got slower by more than the tolerance.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dunetoolkit import Query, clear_query_plan_cache, get_validator, search, insert, update, ensure_indexes
+from dunetoolkit.generate import generate_records, generate_docs, load_records
+
+BENCHMARK_DB_NAME = 'dune_benchmark'
+
+QUERY_STRS = {
+    "simple": 'grouping equals DUNE',
+    "meas_results": 'measurement.results.isotope equals U-238\nAND\nmeasurement.results.value is less than 10\nAND\nmeasurement.results.unit equals ppb',
+    "contains": 'sample.name contains copper\nOR\nsample.description contains steel'
+}
+
+SYNONYM_VALUES = ['copper', 'Cu', 'U-238', 'steel', 'not a synonym']
+
+MATERIALS = ['copper', 'steel', 'titanium', 'PTFE', 'acrylic', 'kapton', 'resin', 'solder', 'cable', 'salt']
+
+
+def _chain_query_str(num_terms, append_mode):
+    """Builds a query string with num_terms string terms joined by append_mode, for timing the compilation of deep AND/OR chains.
+    """
+    lines = []
+    for i in range(num_terms):
+        if i > 0:
+            lines.append(append_mode)
+        lines.append('sample.name contains '+MATERIALS[i%len(MATERIALS)]+str(i))
+    return '\n'.join(lines)
+
+def _time_it(func, repeat, number=1):
+    """Times func, after one warm-up call, and summarizes the time per call in seconds.
+    """
+    func()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        times.append((time.perf_counter()-start) / number)
+    return {"min":min(times), "median":statistics.median(times), "mean":statistics.mean(times), "repeat":repeat, "number":number}
+
+def bench_query_compiler(repeat):
+    """Times parsing query strings, looking up synonyms, and compiling queries (with and without the query plan cache).
+    """
+    results = {}
+    for name, q_str in QUERY_STRS.items():
+        results['query_init.'+name] = _time_it(lambda: Query(q_str), repeat, number=100)
+
+    q_obj = Query()
+    for name, q_str in QUERY_STRS.items():
+        results['load_from_str.'+name] = _time_it(lambda: Query()._load_from_str(q_str), repeat, number=100)
+    for synonym_mode in ['exact', 'prefix', 'regex']:
+        results['find_synonyms.'+synonym_mode] = _time_it(lambda: [ q_obj._find_synonyms(value, synonym_mode) for value in SYNONYM_VALUES ], repeat, number=100)
+
+    for num_terms in [2, 10, 50]:
+        for append_mode in ['AND', 'OR']:
+            q_chain = Query(_chain_query_str(num_terms, append_mode))
+            def _compile_uncached():
+                clear_query_plan_cache()
+                q_chain.to_query_language()
+            results['to_query_language.'+append_mode.lower()+str(num_terms)] = _time_it(_compile_uncached, repeat, number=20)
+            results['to_query_language.'+append_mode.lower()+str(num_terms)+'.cached'] = _time_it(q_chain.to_query_language, repeat, number=100)
+    return results
+
+def bench_validator(repeat):
+    """Times validating whole assay documents.
+    """
+    validator = get_validator('whole_record')
+    docs = list(generate_docs(100, seed=0))
+    return {"validate.whole_record": _time_it(lambda: [ validator.validate(doc) for doc in docs ], repeat)}
+
+def bench_database(db_obj, size, repeat, seed):
+    """Loads a synthetic corpus of the given size and times searching, inserting, and updating it.
+    """
+    results = {}
+    prefix = 'db'+str(size)+'.'
+    db_obj.client.drop_database(db_obj.name)
+    ensure_indexes(db_obj=db_obj)
+
+    start = time.perf_counter()
+    load_records(size, seed=seed, db_obj=db_obj, batch_size=1000)
+    results[prefix+'load'] = {"seconds":time.perf_counter()-start, "docs":size}
+
+    for name, q_str in QUERY_STRS.items():
+        q_dict = Query(q_str).to_query_language()
+        results[prefix+'search.'+name] = _time_it(lambda: search(q_dict, db_obj=db_obj, use_cache=False), repeat)
+        results[prefix+'search.'+name+'.summary'] = _time_it(lambda: search(q_dict, db_obj=db_obj, projection='summary', use_cache=False), repeat)
+
+    records = generate_records(repeat+1, seed=seed+1)
+    results[prefix+'insert'] = _time_it(lambda: insert(db_obj=db_obj, **next(records)), repeat)
+
+    # each update replaces the current version of the doc, so the newest ID is updated next
+    doc_ids = [ str(doc['_id']) for doc in db_obj.assays.find({}, {'_id':1}).limit(1) ]
+    def _update():
+        new_doc_id, error_msg = update(doc_ids[-1], db_obj=db_obj, update_pairs={'sample.description':'updated at '+str(time.time())})
+        if new_doc_id is not None:
+            doc_ids.append(str(new_doc_id))
+    results[prefix+'update'] = _time_it(_update, repeat)
+
+    db_obj.client.drop_database(db_obj.name)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Prints the ratio of each benchmark's median time to its median time in the baseline run.
+
+    returns:
+        * list of str. The names of the benchmarks that got slower by more than the tolerance.
+    """
+    regressions = []
+    for name in sorted(results.keys()):
+        if 'median' not in results[name] or 'median' not in baseline.get(name, {}):
+            continue
+        ratio = results[name]['median'] / baseline[name]['median']
+        flag = ''
+        if ratio > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(name.ljust(45)+('%.2fx' % ratio).rjust(10)+flag)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the query compiler, the validator, and the search, insert, and update functions.')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1000], help='the numbers of synthetic docs to benchmark the database functions with (e.g. 1000 1000000)')
+    parser.add_argument('--repeat', type=int, default=5, help='the number of timed runs of each benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed of the synthetic corpus')
+    parser.add_argument('--host', type=str, default='localhost', help='the host of the mongod to benchmark against')
+    parser.add_argument('--port', type=int, default=27017, help='the port of the mongod to benchmark against')
+    parser.add_argument('--mongomock', action='store_true', help='benchmark against mongomock instead of a mongod')
+    parser.add_argument('--skip_db', action='store_true', help='only run the benchmarks that do not need a database')
+    parser.add_argument('--output', type=str, default='', help='the JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default='', help='a JSON file written by a previous run to compare the results against')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='the ratio to the baseline median above which a benchmark counts as a regression')
+    args = parser.parse_args()
+
+    results = {}
+    results.update(bench_query_compiler(args.repeat))
+    results.update(bench_validator(args.repeat))
+
+    if not args.skip_db:
+        if args.mongomock:
+            try:
+                import mongomock
+            except ImportError:
+                print('Error: mongomock is not installed.')
+                sys.exit(2)
+            client = mongomock.MongoClient()
+        else:
+            from pymongo import MongoClient
+            client = MongoClient(args.host, args.port)
+        for size in args.sizes:
+            results.update(bench_database(client[BENCHMARK_DB_NAME], size, args.repeat, args.seed))
+
+    for name in sorted(results.keys()):
+        if 'median' in results[name]:
+            print(name.ljust(45)+('%.3f ms' % (results[name]['median']*1000)).rjust(14))
+        else:
+            print(name.ljust(45)+('%.3f s' % results[name]['seconds']).rjust(14))
+
+    if args.output != '':
+        meta = {"date":datetime.now().isoformat(), "python":platform.python_version(), "platform":platform.platform(), "mongomock":args.mongomock, "seed":args.seed}
+        with open(args.output, 'w') as output_file:
+            json.dump({"meta":meta, "results":results}, output_file, indent=2)
+
+    if args.baseline != '':
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        print('\nCOMPARED TO '+args.baseline+':')
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            sys.exit(1)
@@ -0,0 +1,29 @@
+import json
+
+from dunetoolkit import get_validator
+from dunetoolkit.generate import generate_records, generate_docs, write_records_jsonl
+
+
+def test_generate_records_deterministic():
+    records = list(generate_records(50, seed=7))
+    assert len(records) == 50
+    assert records == list(generate_records(50, seed=7))
+    assert records[:10] == list(generate_records(10, seed=7))
+    assert records != list(generate_records(50, seed=8))
+
+
+def test_generate_docs_valid():
+    validator = get_validator('whole_record')
+    meas_types = set()
+    for doc in generate_docs(500, seed=0):
+        is_valid, error_msg = validator.validate(doc)
+        assert is_valid, error_msg
+        meas_types.update([ meas_result['type'] for meas_result in doc['measurement']['results'] ])
+    assert meas_types == {'measurement', 'limit', 'range'}
+
+
+def test_write_records_jsonl(tmp_path):
+    file_path = str(tmp_path / 'records.jsonl')
+    assert write_records_jsonl(file_path, 20, seed=3) == 20
+    with open(file_path, 'r') as records_file:
+        assert [ json.loads(line) for line in records_file ] == list(generate_records(20, seed=3))
@@ -4,7 +4,8 @@ import datetime
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 
-from dunetoolkit import search_by_id, convert_str_to_date, convert_date_to_str
+from dunetoolkit import search_by_id, ensure_indexes, convert_str_to_date, convert_date_to_str
+from dunetoolkit import python_mongo_toolkit
 
 '''
 testing set_ui_db
@@ -84,6 +85,52 @@ def test_convert_date_to_str(date_obj, expected_date_str):
     assert date_str == expected_date_str
 
 
+'''
+testing _create_db_obj
+'''
+def test_create_db_obj():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # the same database object (and MongoClient) should be reused until the registry is reset, e.g. after a fork
+    db_obj = python_mongo_toolkit._create_db_obj()
+    assert python_mongo_toolkit._create_db_obj() is db_obj
+    assert search_by_id('000000000000000000000000') is None
+    assert python_mongo_toolkit._create_db_obj() is db_obj
+
+    python_mongo_toolkit._reset_db_obj_registry()
+    new_db_obj = python_mongo_toolkit._create_db_obj()
+    assert new_db_obj is not db_obj
+    assert new_db_obj.name == db_obj.name
+
+
+'''
+testing ensure_indexes
+'''
+def test_ensure_indexes():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+    index_names = [ index_spec['name'] for index_spec in python_mongo_toolkit.ASSAY_INDEXES ]
+
+    report = ensure_indexes(db_obj)
+    assert sorted(report['created']+report['existing']) == sorted(index_names)
+    assert report['missing'] == []
+    assert report['errors'] == {}
+
+    # running it again should not create anything
+    report = ensure_indexes(db_obj)
+    assert report['created'] == []
+    assert sorted(report['existing']) == sorted(index_names)
+
+    # only checking should report the indexes that are missing without creating them
+    db_obj.assays.drop_index('measurement_date')
+    report = ensure_indexes(db_obj, create=False)
+    assert report['missing'] == ['measurement_date']
+    assert 'measurement_date' not in db_obj.assays.index_information()
+    ensure_indexes(db_obj)
+    assert 'measurement_date' in db_obj.assays.index_information()
+
+
 def set_up_db_for_test():
     client = MongoClient('localhost', 27017)
     db_obj = client.dune_pytest_data
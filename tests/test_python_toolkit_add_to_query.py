@@ -29,28 +29,28 @@ def test_add_to_query_with_search_a():
     comp = 'contains'
     val = 'testing'
     q_string, q_dict = add_to_query(field=field, comparison=comp, value=val, query_string='')
-    assert q_dict == {'grouping':{'$regex':re.compile('^.*testing.*$',re.IGNORECASE)}}
+    assert q_dict == {'grouping':{'$regex':re.compile('testing', re.IGNORECASE)}}
     
     field = 'measurement.results.isotope'
     comp = 'eq'
     val = 'U'
     append_mode = 'OR'
     q_string, q_dict = add_to_query(field=field, comparison=comp, value=val, query_string=q_string, append_mode=append_mode)
-    assert q_dict == {'$or': [{'grouping': {'$regex': re.compile('^.*testing.*$', re.IGNORECASE)}}, {'$or': [{'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^Uranium$', re.IGNORECASE)}}}}, {'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^U$', re.IGNORECASE)}}}}]}]}
+    assert q_dict == {'$or': [{'grouping': {'$regex': re.compile('testing', re.IGNORECASE)}}, {'measurement.results': {'$elemMatch': {'isotope': {'$in': ['Uranium', 'U']}}}}]}
 
     field = 'measurement.results.value'
     comp = 'gte'
     val = 100.0
     append_mode = 'AND'
     q_string, q_dict = add_to_query(field=field, comparison=comp, value=val, query_string=q_string, append_mode=append_mode)
-    assert q_dict == {'$or': [{'grouping': {'$regex': re.compile('^.*testing.*$', re.IGNORECASE)}}, {'$or': [{'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^measurement$', re.IGNORECASE)}, 'value.0': {'$gte': 100.0}, 'isotope': {'$regex': re.compile('^Uranium$', re.IGNORECASE)}}}}, {'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^measurement$', re.IGNORECASE)}, 'value.0': {'$gte': 100.0}, 'isotope': {'$regex': re.compile('^U$', re.IGNORECASE)}}}}, {'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^range$', re.IGNORECASE)}, 'value.0': {'$gte': 100.0}, 'isotope': {'$regex': re.compile('^Uranium$', re.IGNORECASE)}}}}, {'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^range$', re.IGNORECASE)}, 'value.0': {'$gte': 100.0}, 'isotope': {'$regex': re.compile('^U$', re.IGNORECASE)}}}}]}]}
+    assert q_dict == {'$or': [{'grouping': {'$regex': re.compile('testing', re.IGNORECASE)}}, {'measurement.results': {'$elemMatch': {'isotope': {'$in': ['Uranium', 'U']}, '$or': [{'type': 'measurement', 'value.0': {'$gte': 100.0}}, {'type': 'range', 'value.0': {'$gte': 100.0}}]}}}]}
 
     field = 'measurement.results.unit'
     comp = 'eq'
     val = 'ppt'
     append_mode = 'AND'
     q_string, q_dict = add_to_query(field=field, comparison=comp, value=val, query_string=q_string, append_mode=append_mode)
-    assert q_dict == {'$or': [{'grouping': {'$regex': re.compile('^.*testing.*$', re.IGNORECASE)}}, {'$or': [{'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^measurement$', re.IGNORECASE)}, 'value.0': {'$gte': 100.0}, 'isotope': {'$regex': re.compile('^Uranium$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppt$', re.IGNORECASE)}}}}, {'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^measurement$', re.IGNORECASE)}, 'value.0': {'$gte': 100.0}, 'isotope': {'$regex': re.compile('^U$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppt$', re.IGNORECASE)}}}}, {'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^range$', re.IGNORECASE)}, 'value.0': {'$gte': 100.0}, 'isotope': {'$regex': re.compile('^Uranium$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppt$', re.IGNORECASE)}}}}, {'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^range$', re.IGNORECASE)}, 'value.0': {'$gte': 100.0}, 'isotope': {'$regex': re.compile('^U$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppt$', re.IGNORECASE)}}}}]}]}
+    assert q_dict == {'$or': [{'grouping': {'$regex': re.compile('testing', re.IGNORECASE)}}, {'measurement.results': {'$elemMatch': {'isotope': {'$in': ['Uranium', 'U']}, 'unit': 'ppt', '$or': [{'type': 'measurement', 'value.0': {'$gte': 100.0}}, {'type': 'range', 'value.0': {'$gte': 100.0}}]}}}]}
 
     search_resp = search(q_dict) #, db_obj)
     # NOTE: no docs match this at the moment
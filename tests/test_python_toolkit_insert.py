@@ -4,7 +4,8 @@ from pymongo import MongoClient
 from bson.objectid import ObjectId
 import datetime
 
-from dunetoolkit import search_by_id, insert
+from dunetoolkit import search_by_id, insert, insert_many, backfill_search_fields, backfill_si_values, Query
+from dunetoolkit.unit_conversion import build_si_values
 
 def test_insert_partial_doc():
     os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
@@ -100,7 +101,7 @@ def test_insert_complete_doc():
     assert new_doc['sample']['id'] == sample_id
     assert new_doc['sample']['owner']['name'] == sample_owner_name
     assert new_doc['sample']['owner']['contact'] == sample_owner_contact
-    assert new_doc['measurement']['results'] == measurement_results
+    assert new_doc['measurement']['results'] == [ dict(meas_result, **build_si_values(meas_result)) for meas_result in measurement_results ]
     assert new_doc['measurement']['practitioner']['name'] == measurement_practitioner_name
     assert new_doc['measurement']['practitioner']['contact'] == measurement_practitioner_contact
     assert new_doc['measurement']['technique'] == measurement_technique
@@ -140,7 +141,9 @@ def test_insert_meas_values_strings_a():
     assert new_doc['data_source']['input']['name'] == data_input_name
     assert new_doc['data_source']['input']['contact'] == data_input_contact
     assert [ date_obj.strftime('%Y-%m-%d') for date_obj in new_doc['data_source']['input']['date'] ] == data_input_date
+    si_values = { key:new_doc['measurement']['results'][0].pop(key) for key in ['value_si', 'unit_si'] }
     assert new_doc['measurement']['results'] == measurement_results
+    assert si_values == {'value_si':pytest.approx([0.0403, 0.0961]), 'unit_si':'Bq/kg'}
 
 
 def test_insert_meas_values_strings_b():
@@ -245,6 +248,87 @@ def test_insert_bad_date_d():
 
 
 
+def test_insert_many():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+    
+    # set up database
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    # perform insert
+    base_record = {'sample_name':'testing sample name', 'sample_description':'testing sample description', 'data_reference':'testing data reference', \
+        'data_input_name':'testing data input name', 'data_input_contact':'testing data input contact', 'data_input_date':['2020-02-20']}
+    records = [
+        dict(base_record, grouping='testing bulk 0', measurement_results=[{'isotope':'K-40', 'type':'measurement', 'unit':'ppm', 'value':[1.3,3.1]}]),
+        dict(base_record, grouping='testing bulk 1', measurement_results=[{'isotope':'K-40', 'type':'measurement', 'unit':'ppm', 'value':['a','b']}]), # invalid values
+        dict(base_record, grouping='testing bulk 2', data_input_date=['2020-02-30']), # invalid date
+        dict(base_record, grouping='testing bulk 3', bad_field='testing'), # invalid argument
+        dict(base_record, grouping='testing bulk 4')
+    ]
+
+    new_doc_ids, errors = insert_many(records, batch_size=2)
+    assert len(new_doc_ids) == len(records)
+    assert sorted(errors.keys()) == [1, 2, 3]
+    assert new_doc_ids[1] == None and new_doc_ids[2] == None and new_doc_ids[3] == None
+    for i in [0, 4]:
+        new_doc = search_by_id(new_doc_ids[i])
+        assert new_doc['grouping'] == 'testing bulk '+str(i)
+        assert new_doc['_version'] == 1
+    assert search_by_id(new_doc_ids[0])['measurement']['results'] == [ dict(meas_result, **build_si_values(meas_result)) for meas_result in records[0]['measurement_results'] ]
+    assert search_by_id(new_doc_ids[0])['_search']['grouping'] == {'exact':'testing bulk 0', 'tokens':['testing', 'bulk', '0']}
+
+    # ordered inserts stop at the first record that fails
+    new_doc_ids, errors = insert_many(records, ordered=True)
+    assert new_doc_ids[0] != None
+    assert new_doc_ids[1:] == [None, None, None, None]
+    assert sorted(errors.keys()) == [1, 2, 3, 4]
+
+
+def test_backfill_search_fields():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database; none of these docs have normalized search fields yet
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+    q = Query('grouping equals ilias ukdm\nAND\nsample.name contains SILICA', use_normalized_fields=True).to_query_language()
+    assert q == {'$and': [{'_search.grouping.exact': 'ilias ukdm'}, {'_search.sample_name.tokens': 'silica'}]}
+    assert db_obj.assays.count_documents(q) == 0
+
+    assert backfill_search_fields(db_obj) == 6
+    docs = list(db_obj.assays.find(q))
+    assert [ str(doc['_id']) for doc in docs ] == ['000000000000000000000006']
+
+    # only docs without the fields are updated, unless they are all rebuilt
+    assert backfill_search_fields(db_obj) == 0
+    db_obj.assays.update_many({}, {'$set':{'_search.grouping.exact':'outdated'}})
+    assert backfill_search_fields(db_obj, only_missing=False, batch_size=4) == 6
+    assert db_obj.assays.count_documents(q) == 1
+
+
+def test_backfill_si_values():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database; none of these docs have SI values yet
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+    q = Query('measurement.results.isotope equals U-238\nAND\nmeasurement.results.value is less than 20\nAND\nmeasurement.results.unit equals mBq/kg', use_si_values=True).to_query_language()
+    assert db_obj.assays.count_documents(q) == 0
+
+    assert backfill_si_values(db_obj) == 5
+    # U-238 limits of 3 ppb and 1 ppb are about 37 and 12 mBq/kg
+    docs = list(db_obj.assays.find(q))
+    assert [ str(doc['_id']) for doc in docs ] == ['000000000000000000000005']
+    doc = db_obj.assays.find_one({'_id':ObjectId('000000000000000000000003')})
+    assert doc['measurement']['results'][2]['unit_si'] == 'Bq/kg'
+    assert doc['measurement']['results'][2]['value_si'] == pytest.approx([0.2759, 0.0062])
+
+    # only docs with a result without SI values are updated, unless they are all rebuilt
+    assert backfill_si_values(db_obj) == 0
+    assert backfill_si_values(db_obj, only_missing=False, batch_size=2) == 0
+    db_obj.assays.update_one({'_id':ObjectId('000000000000000000000002')}, {'$set':{'measurement.results.0.unit_si':'outdated'}})
+    assert backfill_si_values(db_obj, only_missing=False, batch_size=2) == 1
+
+
 def set_up_db_for_test():
     client = MongoClient('localhost', 27017)
     db_obj = client.dune_pytest_data
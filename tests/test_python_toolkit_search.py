@@ -5,7 +5,7 @@ from bson.objectid import ObjectId
 import datetime
 import re
 
-from dunetoolkit import search
+from dunetoolkit import search, iter_search, search_page, search_by_id, count, facet_counts, search_results_table, insert, LocalResultCache, set_result_cache, result_cache_info
 
 def test_search():
     os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
@@ -69,6 +69,169 @@ def test_search_all():
         assert copper_found
 
 
+def test_iter_search():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    q = {'measurement.technique': re.compile('^NAA$', re.IGNORECASE)}
+    docs = list(iter_search(q))
+
+    assert len(docs) == 2
+    assert docs == search(q)
+
+
+def test_search_page():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    q = {'grouping': re.compile('^ILIAS UKDM$', re.IGNORECASE)}
+    found_ids = []
+    after_id = None
+    while True:
+        docs, after_id = search_page(q, page_size=2, after_id=after_id)
+        assert len(docs) <= 2
+        found_ids.extend([ doc['_id'] for doc in docs ])
+        if after_id is None:
+            break
+
+    assert found_ids == ['000000000000000000000002', '000000000000000000000003', '000000000000000000000004', '000000000000000000000005', '000000000000000000000006']
+
+
+def test_search_projection():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    q = {'grouping': re.compile('^ILIAS UKDM$', re.IGNORECASE)}
+    results = search(q, projection='summary')
+    assert len(results) == 5
+    for doc in results:
+        assert sorted(doc.keys()) == ['_id', 'grouping', 'measurement', 'sample']
+        assert list(doc['sample'].keys()) == ['name']
+        assert list(doc['measurement'].keys()) == ['results']
+
+    full_doc = search_by_id(results[0]['_id'])
+    assert 'data_source' in full_doc.keys()
+    summary_doc = search_by_id(results[0]['_id'], projection={'sample.name':1})
+    assert sorted(summary_doc.keys()) == ['_id', 'sample']
+
+
+def test_count():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    assert count({}) == 6
+    assert count('grouping equals ilias ukdm') == 5
+    assert count('measurement.technique equals NAA') == len(search('measurement.technique equals NAA'))
+    assert count('grouping equals nothing') == 0
+
+
+def test_facet_counts():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    counts = facet_counts('grouping equals ILIAS UKDM')
+    assert counts['total'] == 5
+    assert counts['facets']['grouping'] == [{'value':'ILIAS UKDM', 'count':5}]
+    # documents are only counted once per isotope, even if they have several results for it
+    assert counts['facets']['measurement.results.isotope'] == [{'value':'K-40', 'count':5}, {'value':'Th-232', 'count':3}, {'value':'U-238', 'count':3}]
+    assert counts['facets']['measurement.technique'][0] == {'value':'NAA', 'count':2}
+    assert sum([ facet['count'] for facet in counts['facets']['measurement.technique'] ]) == 5
+
+    counts = facet_counts('measurement.technique equals naa', facet_fields=['sample.name'], limit=1)
+    assert counts['total'] == 2
+    assert list(counts['facets'].keys()) == ['sample.name']
+    assert len(counts['facets']['sample.name']) == 1
+
+    assert facet_counts('grouping equals nothing') == {'total':0, 'facets':{'grouping':[], 'measurement.results.isotope':[], 'measurement.institution':[], 'measurement.technique':[]}}
+
+
+def test_search_results_table():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    table = search_results_table('measurement.technique equals NAA')
+    assert sorted(table.keys()) == ['doc_id', 'isotope', 'type', 'unit', 'value_0', 'value_1', 'value_2']
+    assert table['doc_id'] == ['000000000000000000000002']*3 + ['000000000000000000000003']*3
+    assert table['isotope'] == ['U-238', 'Th-232', 'K-40', 'U-238', 'Th-232', 'K-40']
+    assert table['type'] == ['measurement', 'measurement', 'measurement', 'limit', 'limit', 'measurement']
+    assert table['unit'] == ['ppb', 'ppb', 'ppm', 'ppb', 'ppb', 'ppm']
+    assert table['value_0'] == [18, 59, 0.78, 3, 1, 8.9]
+    assert table['value_1'] == [2, 2, 0.02, None, None, 0.2]
+    assert table['value_2'] == [None]*6
+
+    assert search_results_table('grouping equals nothing')['doc_id'] == []
+    assert search_results_table('measurement.technique equals NAA', output='csv') is None
+
+    np = pytest.importorskip('numpy')
+    table = search_results_table('measurement.technique equals NAA', output='numpy')
+    assert table['value_0'].dtype == float
+    assert np.isnan(table['value_1']).sum() == 2
+    assert table['value_0'][table['isotope'] == 'K-40'].tolist() == [0.78, 8.9]
+
+
+
+def test_search_result_cache():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    set_result_cache(LocalResultCache(max_size=10, ttl=60))
+    try:
+        q = 'grouping equals ILIAS UKDM'
+        docs = search(q)
+        assert len(docs) == 5
+        docs[0]['grouping'] = 'changed by the caller'
+        assert search(q)[0]['grouping'] == 'ILIAS UKDM'
+        assert search_page(q, page_size=2) == search_page(q, page_size=2)
+        assert result_cache_info() == {'enabled':True, 'hits':2, 'misses':2, 'hit_rate':0.5}
+
+        # writing to the collection invalidates the cached results
+        new_doc_id, error_msg = insert('cached sample', 'testing sample description', 'testing data reference', 'testing data input name', 'testing data input contact', ['2020-02-20'], grouping='ILIAS UKDM')
+        assert new_doc_id != None, error_msg
+        assert len(search(q)) == 6
+        assert len(search(q, use_cache=False)) == 6
+        assert result_cache_info()['misses'] == 3
+    finally:
+        set_result_cache(None)
+
+
+
+def test_search_explain():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    summary = search('measurement.technique equals NAA', explain=True)
+    assert summary['filter'] == {'measurement.technique': 'NAA'}
+    assert summary['docs_returned'] == 2
+    assert summary['docs_examined'] >= 2
+    assert summary['stages'][-1] in ['FETCH', 'COLLSCAN', 'PROJECTION_SIMPLE', 'PROJECTION_DEFAULT']
+    assert type(summary['indexes_used']) is list
+    assert type(summary['execution_time_ms']) is int
+
+
 def set_up_db_for_test():
     client = MongoClient('localhost', 27017)
     db_obj = client.dune_pytest_data
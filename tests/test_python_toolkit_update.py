@@ -5,6 +5,9 @@ from bson.objectid import ObjectId
 import datetime
 
 from dunetoolkit import search_by_id, update, convert_str_to_date
+from dunetoolkit import python_mongo_toolkit
+from dunetoolkit.search_fields import build_search_fields
+from dunetoolkit.unit_conversion import build_si_values
 
 
 # OTHER POSSIBLE TESTS:
@@ -70,6 +73,17 @@ def test_update_nochange():
     new_version_doc_id = str(currversion_doc.pop('_id'))
     assert new_doc_id == new_version_doc_id
 
+    # test normalized search fields, which are added to every updated doc
+    search_fields = currversion_doc.pop('_search')
+    assert search_fields == build_search_fields(doc)
+    assert search_fields['sample_name'] == {'exact':'resin, magnex, 2:1 thiokol 308', 'tokens':['resin', 'magnex', '2', '1', 'thiokol', '308']}
+
+    # test SI values, which are added to every measurement result of every updated doc
+    si_values = pop_si_values(currversion_doc)
+    assert si_values == [ build_si_values(meas_result) for meas_result in doc['measurement']['results'] ]
+    assert si_values[0]['unit_si'] == 'Bq/kg'
+    assert si_values[0]['value_si'] == pytest.approx([0.22392, 0.02488])
+
     # test orig doc and curr version doc equality
     assert doc == currversion_doc
 
@@ -234,6 +248,8 @@ def test_update_update_pairs_update_twice():
 
     # test id once more
     u1_new_version_doc_id = str(u1_new_doc.pop('_id'))
+    u1_new_doc.pop('_search') # the normalized search fields are checked in test_update_nochange
+    pop_si_values(u1_new_doc) # the SI values are checked in test_update_nochange
     assert u1_new_doc_id == u1_new_version_doc_id
 
     # test orig doc and curr version doc equality
@@ -333,6 +349,8 @@ def test_update_new_meas_objects():
 
     # test id once more
     new_version_doc_id = str(new_doc.pop('_id'))
+    new_doc.pop('_search') # the normalized search fields are checked in test_update_nochange
+    pop_si_values(new_doc) # the SI values are checked in test_update_nochange
     assert new_doc_id == new_version_doc_id
 
     # test orig doc and curr version doc equality
@@ -379,6 +397,8 @@ def test_update_new_meas_objects_str_for_val_a():
 
     # test id once more
     new_version_doc_id = str(new_doc.pop('_id'))
+    new_doc.pop('_search') # the normalized search fields are checked in test_update_nochange
+    pop_si_values(new_doc) # the SI values are checked in test_update_nochange
     assert new_doc_id == new_version_doc_id
 
     # test orig doc and curr version doc equality
@@ -468,6 +488,8 @@ def test_update_meas_remove_indices():
 
     # test id once more
     new_version_doc_id = str(new_doc.pop('_id'))
+    new_doc.pop('_search') # the normalized search fields are checked in test_update_nochange
+    pop_si_values(new_doc) # the SI values are checked in test_update_nochange
     assert new_doc_id == new_version_doc_id
 
     # test orig doc and curr version doc equality
@@ -516,6 +538,8 @@ def test_update_all():
 
     # test id once more
     new_version_doc_id = str(new_doc.pop('_id'))
+    new_doc.pop('_search') # the normalized search fields are checked in test_update_nochange
+    pop_si_values(new_doc) # the SI values are checked in test_update_nochange
     assert new_doc_id == new_version_doc_id
 
     # correct the date values to be datetime objects now, not strings
@@ -557,6 +581,121 @@ def test_update_all():
     assert orig_doc == new_doc
 
 
+def test_update_missing_doc():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    new_doc_id, error_msg = update('000000000000000000000000', update_pairs={'grouping':'testing grouping'})
+    assert new_doc_id == None
+    assert error_msg != ''
+
+def test_update_concurrent():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    # two updates of the same doc; the second one starts from the same (now outdated) version as the first
+    doc_id = '000000000000000000000002'
+    u1_new_doc_id, u1_error_msg = update(doc_id, update_pairs={'grouping':'testing grouping 1'})
+    assert u1_new_doc_id != None, u1_error_msg
+
+    u2_new_doc_id, u2_error_msg = update(doc_id, update_pairs={'grouping':'testing grouping 2'})
+    assert u2_new_doc_id == None
+    assert u2_error_msg != ''
+
+    # only the first update's version is current, and the original is archived exactly once
+    assert search_by_id(u1_new_doc_id)['grouping'] == 'testing grouping 1'
+    client = MongoClient('localhost', 27017)
+    assert client.dune_pytest_data.assays.count_documents({'_parent_id':doc_id}) == 1
+    assert client.dune_pytest_data.assays_old_versions.count_documents({'_id':ObjectId(doc_id)}) == 1
+
+
+def test_update_concurrent_change_after_read(monkeypatch):
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+
+    # someone else changes the doc after this update reads it and before this update writes its new version
+    doc_id = '000000000000000000000002'
+    client = MongoClient('localhost', 27017)
+    orig_get_existing_doc = python_mongo_toolkit._get_existing_doc
+    def get_existing_doc_then_change_it(*args, **kwargs):
+        doc = orig_get_existing_doc(*args, **kwargs)
+        client.dune_pytest_data.assays.update_one({'_id':ObjectId(doc_id)}, {'$set':{'grouping':'other grouping', '_version':2}})
+        return doc
+    monkeypatch.setattr(python_mongo_toolkit, '_get_existing_doc', get_existing_doc_then_change_it)
+
+    new_doc_id, error_msg = update(doc_id, update_pairs={'grouping':'testing grouping'})
+    assert new_doc_id == None
+    assert error_msg != ''
+
+    # the other change is kept, and nothing from the rejected update is written
+    stored_doc = client.dune_pytest_data.assays.find_one({'_id':ObjectId(doc_id)})
+    assert stored_doc['grouping'] == 'other grouping'
+    assert stored_doc['_version'] == 2
+    assert client.dune_pytest_data.assays.count_documents({'_parent_id':doc_id}) == 0
+    assert client.dune_pytest_data.assays_old_versions.count_documents({}) == 0
+
+
+def test_update_assay_request_update():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated, with an assay request
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+    doc_id = '000000000000000000000002'
+    client = MongoClient('localhost', 27017)
+    request_doc = client.dune_pytest_data.assays.find_one({'_id':ObjectId(doc_id)})
+    client.dune_pytest_data.assays.delete_one({'_id':ObjectId(doc_id)})
+    client.dune_pytest_data.assays_assay_requests.insert_one(request_doc)
+
+    new_doc_id, error_msg = update(doc_id, update_pairs={'grouping':'testing grouping'}, is_assay_request_update=True)
+    assert new_doc_id != None, error_msg
+    assert error_msg == ''
+
+    # the updated request replaces the original in the assay requests collection, and the original is archived in the assay requests old versions collection
+    new_doc = search_by_id(new_doc_id, coll_type='assay_requests')
+    assert new_doc['grouping'] == 'testing grouping'
+    assert new_doc['_version'] == 2
+    assert search_by_id(doc_id, coll_type='assay_requests') == None
+    assert search_by_id(doc_id, coll_type='assay_requests_old_versions')['grouping'] == 'ILIAS UKDM'
+    assert client.dune_pytest_data.assays.count_documents({}) == 5
+    assert client.dune_pytest_data.assays_old_versions.count_documents({}) == 0
+
+def test_update_assay_request_verify():
+    os.environ['TOOLKIT_CONFIG_NAME'] = '../dunetoolkit/toolkit_config_test.json'
+
+    # set up database to be updated, with an assay request
+    teardown_db_for_test()
+    db_obj = set_up_db_for_test()
+    doc_id = '000000000000000000000002'
+    client = MongoClient('localhost', 27017)
+    request_doc = client.dune_pytest_data.assays.find_one({'_id':ObjectId(doc_id)})
+    client.dune_pytest_data.assays.delete_one({'_id':ObjectId(doc_id)})
+    client.dune_pytest_data.assays_assay_requests.insert_one(request_doc)
+
+    new_doc_id, error_msg = update(doc_id, is_assay_request_verify=True)
+    assert new_doc_id != None, error_msg
+    assert error_msg == ''
+
+    # the verified request is moved to the main collection, and the original is archived in the assay requests old versions collection
+    assert search_by_id(new_doc_id)['grouping'] == 'ILIAS UKDM'
+    assert client.dune_pytest_data.assays.count_documents({}) == 6
+    assert client.dune_pytest_data.assays_assay_requests.count_documents({}) == 0
+    assert search_by_id(doc_id, coll_type='assay_requests_old_versions') != None
+    assert client.dune_pytest_data.assays_old_versions.count_documents({}) == 0
+
+
+def pop_si_values(doc):
+    return [ { key:meas_result.pop(key) for key in ['value_si', 'unit_si'] if key in meas_result } for meas_result in doc['measurement']['results'] ]
+
 def set_up_db_for_test():
     client = MongoClient('localhost', 27017)
     db_obj = client.dune_pytest_data
@@ -575,6 +714,8 @@ def teardown_db_for_test():
     old_versions_coll = client.dune_pytest_data.assays_old_versions
     remove_resp = coll.delete_many({})
     resmove_oldversions_resp = old_versions_coll.delete_many({})
+    client.dune_pytest_data.assays_assay_requests.delete_many({})
+    client.dune_pytest_data.assays_assay_requests_old_versions.delete_many({})
 
 def query_for_all_docs():
     client = MongoClient('localhost', 27017)
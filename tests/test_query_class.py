@@ -1,26 +1,28 @@
 import re
+import json
 import pytest
 
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 import datetime
 
-from dunetoolkit import Query, search
+from dunetoolkit import Query, search, add_to_query, query_complexity, query_plan_cache_info, clear_query_plan_cache
 
 #'''
 data_load_from_str = [
     ("all contains ", {}),
     ("all contains testing", {'$text': {'$search': 'testing'}}),
-    ("grouping equals ", {"grouping": {"$regex": re.compile('^$', re.IGNORECASE)}}),
-    ("grouping contains one\nOR\nsample.name does not contain two\nAND\nsample.description equals three", {"$or": [{'grouping': {"$regex": re.compile('^.*one.*$', re.IGNORECASE)}}, {"$and":[{'sample.name': {'$not': re.compile('^two$', re.IGNORECASE)}}, {'sample.description': {"$regex": re.compile('^three$', re.IGNORECASE)}}]}]}),
-    ("measurement.results.value is less than 10\nAND\nmeasurement.results.value is greater than or equal to 5", {'$or': [{'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^measurement$', re.IGNORECASE)}, 'value.0': {'$lt': 10, '$gte': 5}}}}, {'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^range$', re.IGNORECASE)}, 'value.1': {'$lt': 10}, 'value.0': {'$gte': 5}}}}]}),
-    ("measurement.results.unit equals ppm\nAND\nmeasurement.results.value equals 37.2\nOR\nmeasurement.results.value is greater than 20.4\nAND\nmeasurement.results.value is less than or equal to 40.6\nAND\ngrouping contains majorana", {'$or': [{'measurement.results': {'$elemMatch': {'unit': {'$regex': re.compile('^ppm$', re.IGNORECASE)}, 'type': {'$regex': re.compile('^measurement$', re.IGNORECASE)}, 'value.0': {'$eq': 37.2}}}}, {'$and': [{'$or': [{'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^measurement$', re.IGNORECASE)}, 'value.0': {'$gt': 20.4, '$lte': 40.6}}}}, {'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^range$', re.IGNORECASE)}, 'value.0': {'$gt': 20.4}, 'value.1': {'$lte': 40.6}}}}]}, {'grouping': {'$regex': re.compile('^.*majorana.*$', re.IGNORECASE)}}]}]}),
-    ('grouping contains ["copper", "Cu"]', {'$or': [{'grouping': {'$regex': re.compile('^.*copper.*$', re.IGNORECASE)}}, {'grouping': {'$regex': re.compile('^.*Cu.*$', re.IGNORECASE)}}]}),
-    ('measurement.results.isotope equals K-40\nAND\nmeasurement.results.unit equals ppm\nAND\nmeasurement.results.value is greater than 0.1\nAND\nmeasurement.results.value is less than or equal to 1', {'$or': [{'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^K-40$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppm$', re.IGNORECASE)}, 'type': {'$regex': re.compile('^measurement$', re.IGNORECASE)}, 'value.0': {'$gt': 0.1, '$lte': 1}}}}, {'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^K-40$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppm$', re.IGNORECASE)}, 'type': {'$regex': re.compile('^range$', re.IGNORECASE)}, 'value.0': {'$gt': 0.1}, 'value.1': {'$lte': 1}}}}]}),
-    ('measurement.results.type equals range\nAND\nmeasurement.results.value is greater than 200\nAND\nmeasurement.results.value is less than 1', {'measurement.results': {'$elemMatch': {'type': {'$regex': re.compile('^range$', re.IGNORECASE)}, 'value.0': {'$gt': 200}, 'value.1': {'$lt': 1}}}}),
-    ("grouping contains majorana\nAND\nmeasurement.results.isotope equals U-238\nAND\nmeasurement.results.value is less than or equal to 1.0\nAND\nmeasurement.results.unit equals ppt", {'$and': [{'grouping': {'$regex': re.compile('^.*majorana.*$', re.IGNORECASE)}}, {'$or': [{'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^U-238$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppt$', re.IGNORECASE)}, 'type': {'$regex': re.compile('^measurement$', re.IGNORECASE)}, 'value.0': {'$lte': 1.0}}}}, {'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^U-238$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppt$', re.IGNORECASE)}, 'type': {'$regex': re.compile('^range$', re.IGNORECASE)}, 'value.1': {'$lte': 1.0}}}}, {'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^U-238$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppt$', re.IGNORECASE)}, 'type': {'$regex': re.compile('^limit$', re.IGNORECASE)}, 'value.0': {'$lte': 1.0}}}}]}]}),
-    ('grouping contains testing\nOR\nmeasurement.results.isotope equals ["Actinium", "Ac"]', {'$or': [{'grouping': {'$regex': re.compile('^.*testing.*$', re.IGNORECASE)}}, {'$or': [{'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^Actinium$', re.IGNORECASE)}}}}, {'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^Ac$', re.IGNORECASE)}}}}]}]}),
-    ('grouping contains testing\nOR\nmeasurement.results.isotope equals ["Actinium", "Ac"]\nAND\nmeasurement.results.unit equals ppm\nOR\nmeasurement.results.unit equals ppb', {'$or': [{'grouping': {'$regex': re.compile('^.*testing.*$', re.IGNORECASE)}}, {'$or': [{'$or': [{'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^Actinium$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppm$', re.IGNORECASE)}}}}, {'measurement.results': {'$elemMatch': {'isotope': {'$regex': re.compile('^Ac$', re.IGNORECASE)}, 'unit': {'$regex': re.compile('^ppm$', re.IGNORECASE)}}}}]}, {'measurement.results': {'$elemMatch': {'unit': {'$regex': re.compile('^ppb$', re.IGNORECASE)}}}}]}]})
+    ("grouping equals ", {"grouping": ''}),
+    ("grouping contains one\nOR\nsample.name does not contain two\nAND\nsample.description equals three", {"$or": [{'grouping': {"$regex": re.compile('one', re.IGNORECASE)}}, {"$and":[{'sample.name': {'$not': re.compile('^two$', re.IGNORECASE)}}, {'sample.description': 'three'}]}]}),
+    ("measurement.results.value is less than 10\nAND\nmeasurement.results.value is greater than or equal to 5", {'measurement.results': {'$elemMatch': {'$or': [{'type': 'measurement', 'value.0': {'$lt': 10, '$gte': 5}}, {'type': 'range', 'value.1': {'$lt': 10}, 'value.0': {'$gte': 5}}]}}}),
+    ("measurement.results.unit equals ppm\nAND\nmeasurement.results.value equals 37.2\nOR\nmeasurement.results.value is greater than 20.4\nAND\nmeasurement.results.value is less than or equal to 40.6\nAND\ngrouping contains majorana", {'$or': [{'measurement.results': {'$elemMatch': {'unit': 'ppm', 'type': 'measurement', 'value.0': {'$eq': 37.2}}}}, {'$and': [{'measurement.results': {'$elemMatch': {'$or': [{'type': 'measurement', 'value.0': {'$gt': 20.4, '$lte': 40.6}}, {'type': 'range', 'value.0': {'$gt': 20.4}, 'value.1': {'$lte': 40.6}}]}}}, {'grouping': {'$regex': re.compile('majorana', re.IGNORECASE)}}]}]}),
+    ('grouping contains ["copper", "Cu"]', {'$or': [{'grouping': {'$regex': re.compile('copper', re.IGNORECASE)}}, {'grouping': {'$regex': re.compile('Cu', re.IGNORECASE)}}]}),
+    ('measurement.results.isotope equals K-40\nAND\nmeasurement.results.unit equals ppm\nAND\nmeasurement.results.value is greater than 0.1\nAND\nmeasurement.results.value is less than or equal to 1', {'measurement.results': {'$elemMatch': {'isotope': 'K-40', 'unit': 'ppm', '$or': [{'type': 'measurement', 'value.0': {'$gt': 0.1, '$lte': 1}}, {'type': 'range', 'value.0': {'$gt': 0.1}, 'value.1': {'$lte': 1}}]}}}),
+    ('measurement.results.type equals range\nAND\nmeasurement.results.value is greater than 200\nAND\nmeasurement.results.value is less than 1', {'measurement.results': {'$elemMatch': {'type': 'range', 'value.0': {'$gt': 200}, 'value.1': {'$lt': 1}}}}),
+    ("grouping contains majorana\nAND\nmeasurement.results.isotope equals U-238\nAND\nmeasurement.results.value is less than or equal to 1.0\nAND\nmeasurement.results.unit equals ppt", {'$and': [{'grouping': {'$regex': re.compile('majorana', re.IGNORECASE)}}, {'measurement.results': {'$elemMatch': {'isotope': 'U-238', 'unit': 'ppt', '$or': [{'type': 'measurement', 'value.0': {'$lte': 1.0}}, {'type': 'range', 'value.1': {'$lte': 1.0}}, {'type': 'limit', 'value.0': {'$lte': 1.0}}]}}}]}),
+    ('grouping contains testing\nOR\nmeasurement.results.isotope equals ["Actinium", "Ac"]', {'$or': [{'grouping': {'$regex': re.compile('testing', re.IGNORECASE)}}, {'measurement.results': {'$elemMatch': {'isotope': {'$in': ['Actinium', 'Ac']}}}}]}),
+    ('grouping contains testing\nOR\nmeasurement.results.isotope equals ["Actinium", "Ac"]\nAND\nmeasurement.results.unit equals ppm\nOR\nmeasurement.results.unit equals ppb', {'$or': [{'grouping': {'$regex': re.compile('testing', re.IGNORECASE)}}, {'measurement.results': {'$elemMatch': {'isotope': {'$in': ['Actinium', 'Ac']}, 'unit': 'ppm'}}}, {'measurement.results': {'$elemMatch': {'unit': 'ppb'}}}]}),
+    ('sample.name contains Cu (99.9%)\nOR\ngrouping equals ILIAS UKDM', {'$or': [{'sample.name': {'$regex': re.compile(re.escape('Cu (99.9%)'), re.IGNORECASE)}}, {'grouping': 'ILIAS UKDM'}]}), # special characters are matched literally
 ]
 @pytest.mark.parametrize("base_str,correct_q_dict", data_load_from_str)
 def test_load_from_str(base_str, correct_q_dict):
@@ -32,6 +34,112 @@ def test_load_from_str(base_str, correct_q_dict):
     assert q_str == base_str
     assert q_dict == correct_q_dict
 
+@pytest.mark.parametrize("base_str,correct_q_dict", data_load_from_str)
+def test_query_plan_cache(base_str, correct_q_dict):
+    clear_query_plan_cache()
+    q_dict = Query(query_str=base_str).to_query_language()
+    assert query_plan_cache_info()['misses'] == 1
+    assert query_plan_cache_info()['hits'] == 0
+
+    # a new Query object with the same query should get its query dict from the cache
+    cached_q_dict = Query(query_str=base_str).to_query_language()
+    assert query_plan_cache_info()['hits'] == 1
+    assert cached_q_dict == correct_q_dict
+
+    # changing the returned query dict must not change the cached one
+    cached_q_dict['testing_field'] = 'testing_value'
+    assert Query(query_str=base_str).to_query_language() == correct_q_dict
+    assert query_plan_cache_info()['size'] == 1
+
+@pytest.mark.parametrize("value,synonym_mode,expected_synonyms", [
+    ('U', 'exact', ['Uranium', 'U']),
+    ('uranium', 'exact', ['Uranium', 'U']), # case does not matter
+    ('PMT', 'exact', ['PMT', 'photomultiplier tube', 'photo multiplier tube']),
+    ('Ura', 'exact', None), # exact mode does not match partial words
+    ('Ura', 'prefix', ['Uranium', 'U']),
+    ('U.*', 'exact', None), # values are not regexes unless regex mode is used
+    ('^Uran.*m$', 'regex', ['Uranium', 'U']),
+    ('Uranium(', 'regex', None), # invalid regex
+    ('notasynonym', 'exact', None)
+])
+def test_find_synonyms(value, synonym_mode, expected_synonyms):
+    q_obj = Query()
+    assert q_obj._find_synonyms(value, synonym_mode) == expected_synonyms
+
+def test_add_query_term_synonym_mode():
+    q_obj = Query()
+    q_obj.add_query_term('measurement.results.isotope', 'eq', 'copper')
+    assert q_obj.terms == [{'field':'measurement.results.isotope', 'comparison':'eq', 'value':['Copper', 'Cu']}]
+
+    q_obj.add_query_term('grouping', 'contains', 'Copp', 'AND', synonym_mode='prefix')
+    assert q_obj.terms[1] == {'field':'grouping', 'comparison':'contains', 'value':['Copper', 'Cu']}
+
+    # invalid synonym modes are rejected without adding the term
+    q_obj.add_query_term('grouping', 'contains', 'Cu', 'AND', synonym_mode='bad')
+    assert len(q_obj.terms) == 2
+
+def test_meas_results_one_elem_match():
+    # every isotope synonym and measurement type is matched inside one $elemMatch, rather than one $elemMatch per combination
+    q_dict = Query('measurement.results.isotope contains ["Uranium", "U"]\nAND\nmeasurement.results.value is less than 1').to_query_language()
+    assert q_dict == {'measurement.results': {'$elemMatch': {'isotope': {'$in': [re.compile('Uranium', re.IGNORECASE), re.compile('U', re.IGNORECASE)]}, '$or': [{'type': 'measurement', 'value.0': {'$lt': 1}}, {'type': 'range', 'value.1': {'$lt': 1}}, {'type': 'limit', 'value.0': {'$lt': 1}}]}}}
+    assert query_complexity(q_dict) == {'terms': 7, 'or_branches': 3, 'elem_matches': 1, 'depth': 2}
+
+    q_dict = Query('measurement.results.isotope does not contain ["Uranium", "U"]\nAND\nmeasurement.results.unit equals ppb').to_query_language()
+    assert q_dict == {'measurement.results': {'$elemMatch': {'isotope': {'$nin': [re.compile('^Uranium$', re.IGNORECASE), re.compile('^U$', re.IGNORECASE)]}, 'unit': 'ppb'}}}
+
+def test_optimize_query_language():
+    # appended terms are flattened into one list per operator, and duplicate terms are removed
+    q_dict = Query('grouping contains a\nAND\ngrouping contains b\nAND\ngrouping contains a\nAND\ngrouping contains c').to_query_language()
+    assert q_dict == {'$and': [{'grouping': {'$regex': re.compile('a', re.IGNORECASE)}}, {'grouping': {'$regex': re.compile('b', re.IGNORECASE)}}, {'grouping': {'$regex': re.compile('c', re.IGNORECASE)}}]}
+    assert Query('grouping equals DUNE\nOR\nsample.name equals Cu\nAND\nsample.name equals Cu').to_query_language() == {'$or': [{'grouping': 'DUNE'}, {'sample.name': 'Cu'}]}
+
+    q_obj = Query()
+    start = datetime.datetime(2018, 1, 1)
+    end = datetime.datetime(2019, 1, 1)
+    # comparisons of the same field are merged, but not when they use the same operator
+    assert q_obj._optimize_query_language({'$and': [{'measurement.date.0': {'$gte': start}}, {'$and': [{'grouping': 'DUNE'}, {'measurement.date.0': {'$lt': end}}]}]}) == {'$and': [{'measurement.date.0': {'$gte': start, '$lt': end}}, {'grouping': 'DUNE'}]}
+    assert q_obj._optimize_query_language({'$and': [{'measurement.date.0': {'$gte': start}}, {'measurement.date.0': {'$gte': end}}]}) == {'$and': [{'measurement.date.0': {'$gte': start}}, {'measurement.date.0': {'$gte': end}}]}
+    assert q_obj._optimize_query_language({'$or': [{'measurement.date.0': {'$gte': start}}, {'measurement.date.0': {'$lt': end}}]}) == {'$or': [{'measurement.date.0': {'$gte': start}}, {'measurement.date.0': {'$lt': end}}]}
+
+    # empty terms match every document
+    assert q_obj._optimize_query_language({'$and': [{}, {'grouping': 'DUNE'}]}) == {'grouping': 'DUNE'}
+    assert q_obj._optimize_query_language({'$or': [{}, {'grouping': 'DUNE'}]}) == {}
+    assert q_obj._optimize_query_language({'$and': [{}, {'$or': [{}]}]}) == {}
+
+def test_query_state():
+    q_str = 'grouping contains ["Copper", "Cu"]\nAND\nmeasurement.results.value is less than 3\nOR\nsample.description does not contain salt'
+    q_obj = Query(q_str)
+    state = q_obj.to_state()
+    assert json.loads(state) == {'v':1, 'terms':q_obj.terms, 'appends':['AND', 'OR']}
+
+    restored_q_obj = Query.from_state(state)
+    assert restored_q_obj.to_string() == q_str
+    assert restored_q_obj.to_query_language() == q_obj.to_query_language()
+
+    # a restored query can be added to like any other
+    restored_q_obj.add_query_term('sample.name', 'eq', 'steel', 'AND')
+    assert restored_q_obj.to_string() == q_str+'\nAND\nsample.name equals steel'
+    assert Query.from_state(restored_q_obj.to_state()).terms == restored_q_obj.terms
+    assert add_to_query('sample.name', 'eq', 'steel', query_state=state, append_mode='AND')[0] == q_str+'\nAND\nsample.name equals steel'
+
+@pytest.mark.parametrize("state", [
+    'not json',
+    '{"terms":[], "appends":[]}', # no version
+    '{"v":2, "terms":[], "appends":[]}',
+    '{"v":1, "terms":[{"field":"grouping", "comparison":"eq", "value":"a"}], "appends":["AND"]}', # too many appends
+    '{"v":1, "terms":[{"field":"$where", "comparison":"eq", "value":"a"}], "appends":[]}',
+    '{"v":1, "terms":[{"field":"grouping", "comparison":"lt", "value":"a"}], "appends":[]}',
+    '{"v":1, "terms":[{"field":"grouping", "comparison":"eq", "value":[{"$ne":""}]}], "appends":[]}',
+    '{"v":1, "terms":[{"field":"grouping", "comparison":"eq", "value":"a", "extra":1}], "appends":[]}',
+    '{"v":1, "terms":[{"field":"grouping", "comparison":"eq", "value":"a"}, {"field":"grouping", "comparison":"eq", "value":"b"}], "appends":["XOR"]}',
+    '{"v":1, "terms":[{"field":"measurement.results.isotope", "comparison":"eq", "value":"K-40"}, {"field":"measurement.results.isotope", "comparison":"eq", "value":"U-238"}], "appends":[""]}', # only the first term can have an empty append mode
+    '{"v":1, "terms":[{"field":"all", "comparison":"contains", "value":"a"}, {"field":"all", "comparison":"contains", "value":"b"}], "appends":["AND"]}', # only one $text term is allowed
+    '{"v":1, "terms":[{"field":"all", "comparison":"contains", "value":""}, {"field":"grouping", "comparison":"eq", "value":"a"}], "appends":["AND"]}',
+    '{"v":1, "terms":[{"field":"grouping", "comparison":"eq", "value":"a"}, {"field":"all", "comparison":"contains", "value":""}], "appends":["OR"]}'
+])
+def test_query_state_invalid(state):
+    assert Query.from_state(state) is None
+
 """
 def test_query_results_1():
     # set up database to be updated
@@ -0,0 +1,50 @@
+import os
+import pytest
+
+from dunetoolkit import reference_data, Query, DuneValidator
+
+
+def test_reference_data_loaded_once():
+    reference_data.reload_reference_data()
+    synonyms = reference_data.get_synonyms()
+    isotopes = reference_data.get_isotopes()
+    units = reference_data.get_units()
+
+    # the files should only be parsed once, and the same read-only objects shared from then on
+    assert reference_data.get_synonyms() is synonyms
+    assert reference_data.get_isotopes() is isotopes
+    assert reference_data.get_units() is units
+    assert Query().synonyms is synonyms.groups
+
+    assert type(isotopes) is tuple
+    assert 'K-40' in isotopes
+    assert 'ppm' in units
+    assert synonyms.groups[synonyms.index['cu']] == ('Copper', 'Cu')
+    with pytest.raises(TypeError):
+        synonyms.index['cu'] = 0
+
+
+def test_reference_data_reload():
+    reference_data.reload_reference_data()
+    generation = reference_data.reference_data_generation()
+    isotopes = reference_data.get_isotopes()
+
+    reference_data.reload_reference_data()
+    assert reference_data.reference_data_generation() == generation + 1
+    new_isotopes = reference_data.get_isotopes()
+    assert new_isotopes is not isotopes
+    assert new_isotopes == isotopes
+
+    # with reloading on change turned on, an unchanged file should not be read again
+    reference_data.RELOAD_ON_CHANGE = True
+    try:
+        assert reference_data.get_isotopes() is new_isotopes
+        assert reference_data.reference_data_generation() == generation + 1
+    finally:
+        reference_data.RELOAD_ON_CHANGE = False
+
+
+def test_validator_uses_reference_data():
+    validator = DuneValidator('measurement_result')
+    assert validator.schema['properties']['isotope']['enum'] == list(reference_data.get_isotopes())
+    assert validator.schema['properties']['unit']['enum'] == list(reference_data.get_units())
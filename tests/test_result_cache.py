@@ -0,0 +1,52 @@
+import re
+import time
+from pymongo import MongoClient
+
+from dunetoolkit.result_cache import LocalResultCache, result_cache_key
+
+
+def test_local_result_cache_lru():
+    cache = LocalResultCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # "b" was the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_local_result_cache_ttl():
+    cache = LocalResultCache(max_size=2, ttl=0.01)
+    cache.set('a', 1)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_result_cache_key():
+    cache = LocalResultCache()
+    # no connection is made until the collection is queried
+    collection = MongoClient('localhost', 27017, connect=False).dune_pytest_data.assays
+    key = result_cache_key(cache, collection, ('search', {'grouping':'ILIAS UKDM'}, None))
+    assert key == result_cache_key(cache, collection, ('search', {'grouping':'ILIAS UKDM'}, None))
+    assert key != result_cache_key(cache, collection, ('search', {'grouping':'ILIAS UKDM'}, {'grouping':1}))
+    assert key != result_cache_key(cache, collection.database.assays_old_versions, ('search', {'grouping':'ILIAS UKDM'}, None))
+
+    cache.bump_generation(collection.full_name)
+    assert cache.get_generation(collection.full_name) == 1
+    assert key != result_cache_key(cache, collection, ('search', {'grouping':'ILIAS UKDM'}, None))
+
+    # long regexes that share a prefix make different keys, even though their reprs are cut short to the same string
+    long_pattern_a = re.compile('x'*250+'a', re.IGNORECASE)
+    long_pattern_b = re.compile('x'*250+'b', re.IGNORECASE)
+    assert repr(long_pattern_a) == repr(long_pattern_b)
+    assert result_cache_key(cache, collection, ('search', {'grouping':{'$regex':long_pattern_a}}, None)) != result_cache_key(cache, collection, ('search', {'grouping':{'$regex':long_pattern_b}}, None))
+    assert result_cache_key(cache, collection, ('search', {'grouping':{'$regex':long_pattern_a}}, None)) != result_cache_key(cache, collection, ('search', {'grouping':{'$regex':re.compile(long_pattern_a.pattern)}}, None))
+
+    # the order of the keys of the query does not change the key
+    assert result_cache_key(cache, collection, ('search', {'grouping':'DUNE', 'type':'measurement'}, None)) == result_cache_key(cache, collection, ('search', {'type':'measurement', 'grouping':'DUNE'}, None))
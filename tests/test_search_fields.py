@@ -0,0 +1,42 @@
+import pytest
+
+from dunetoolkit import Query
+from dunetoolkit.search_fields import normalize_str, tokenize_str, normalized_field_path, build_search_fields
+
+
+@pytest.mark.parametrize('value,expected_exact,expected_tokens', [
+    ('Copper', 'copper', ['copper']),
+    ('  Résine   Époxy ', 'resine epoxy', ['resine', 'epoxy']),
+    ('Cu (99.9%) cu', 'cu (99.9%) cu', ['cu', '99', '9']),
+    ('STRASSE Straße', 'strasse strasse', ['strasse']),
+    ('', '', [])
+])
+def test_normalize(value, expected_exact, expected_tokens):
+    assert normalize_str(value) == expected_exact
+    assert tokenize_str(value) == expected_tokens
+
+
+def test_build_search_fields():
+    doc = {'grouping':'ILIAS UKDM', 'sample':{'name':'Rexalite, copper removed', 'owner':{'name':'', 'contact':''}}, 'measurement':{'results':[]}}
+    search_fields = build_search_fields(doc)
+    assert search_fields == {
+        'grouping': {'exact':'ilias ukdm', 'tokens':['ilias', 'ukdm']},
+        'sample_name': {'exact':'rexalite, copper removed', 'tokens':['rexalite', 'copper', 'removed']},
+        'sample_owner_name': {'exact':'', 'tokens':[]},
+        'sample_owner_contact': {'exact':'', 'tokens':[]}
+    }
+    assert normalized_field_path('sample.name', 'exact') == '_search.sample_name.exact'
+
+
+def test_query_normalized_fields():
+    q_str = 'grouping equals ILIAS  Ukdm\nAND\nsample.name contains Copper Removed\nOR\nsample.description does not contain Salt'
+    q_dict = Query(q_str, use_normalized_fields=True).to_query_language()
+    assert q_dict == {'$and': [{'_search.grouping.exact': 'ilias ukdm'}, {'$or': [{'_search.sample_name.tokens': {'$all': ['copper', 'removed']}}, {'_search.sample_description.exact': {'$ne': 'salt'}}]}]}
+
+    # the same query compiled against the original fields is cached separately
+    assert Query(q_str, use_normalized_fields=False).to_query_language()['$and'][0] == {'grouping': 'ILIAS  Ukdm'}
+
+    # synonyms match any of the words, and the fields that are not normalized are compiled as usual
+    q_dict = Query('sample.name contains ["Copper", "Cu"]\nAND\nmeasurement.results.isotope equals K-40', use_normalized_fields=True).to_query_language()
+    assert q_dict['$and'][0] == {'_search.sample_name.tokens': {'$in': ['copper', 'cu']}}
+    assert q_dict['$and'][1] == {'measurement.results': {'$elemMatch': {'isotope': 'K-40'}}}
@@ -0,0 +1,60 @@
+import pytest
+
+from dunetoolkit import Query, get_units, get_unit_conversions
+from dunetoolkit.unit_conversion import get_si_conversion, build_si_values, add_si_values
+
+
+def test_every_unit_has_a_conversion():
+    assert sorted(get_unit_conversions().keys()) == sorted(set(get_units()))
+
+
+@pytest.mark.parametrize('unit,isotope,expected_si_unit,expected_factor', [
+    ('mBq/kg', None, 'Bq/kg', 1e-3),
+    ('mBq/kg', 'U-238', 'Bq/kg', 1e-3),
+    ('ppb', 'U-238', 'Bq/kg', 12.44e-3),
+    ('ppm', 'K-40', 'Bq/kg', 31e-3),
+    ('ug/kg', 'Th-232', 'Bq/kg', 4.06e-3),
+    ('ppb', 'Be-7', 'g/g', 1e-9),
+    ('ng/cm2', 'Be-7', 'g/m2', 1e-5),
+    ('pg', 'U-238', 'Bq', 12440e-12),
+    ('ppb', None, None, None),
+    ('furlongs', 'U-238', None, None)
+])
+def test_get_si_conversion(unit, isotope, expected_si_unit, expected_factor):
+    conversion = get_si_conversion(unit, isotope)
+    if expected_si_unit is None:
+        assert conversion is None
+    else:
+        assert conversion[0] == expected_si_unit
+        assert conversion[1] == pytest.approx(expected_factor)
+
+
+def test_build_si_values():
+    # confidence levels are not converted
+    assert build_si_values({'isotope':'U-238', 'type':'limit', 'unit':'ppb', 'value':[2, 90]}) == {'value_si':[pytest.approx(0.02488), 90], 'unit_si':'Bq/kg'}
+    assert build_si_values({'isotope':'U-238', 'type':'range', 'unit':'mBq/kg', 'value':[1, 2, 95]}) == {'value_si':[pytest.approx(0.001), pytest.approx(0.002), 95], 'unit_si':'Bq/kg'}
+    assert build_si_values({'isotope':'U-238', 'type':'measurement', 'unit':'mBq/kg', 'value':[]}) == {'value_si':[], 'unit_si':'Bq/kg'}
+
+    meas_results = [{'isotope':'K-40', 'type':'measurement', 'unit':'Bq/kg', 'value':[1.5, 0.1], 'value_si':[0], 'unit_si':'outdated'}]
+    assert add_si_values(meas_results) == [{'isotope':'K-40', 'type':'measurement', 'unit':'Bq/kg', 'value':[1.5, 0.1], 'value_si':[1.5, 0.1], 'unit_si':'Bq/kg'}]
+    assert meas_results[0]['unit_si'] == 'outdated'
+
+
+def test_query_si_values():
+    q_str = 'measurement.results.isotope equals U-238\nAND\nmeasurement.results.value is less than 1\nAND\nmeasurement.results.unit equals ppb'
+    q_dict = Query(q_str, use_si_values=True).to_query_language()
+    assert q_dict == {'measurement.results': {'$elemMatch': {'isotope': 'U-238', 'unit_si': 'Bq/kg', '$or': [
+        {'type': 'measurement', 'value_si.0': {'$lt': pytest.approx(0.01244)}},
+        {'type': 'range', 'value_si.1': {'$lt': pytest.approx(0.01244)}},
+        {'type': 'limit', 'value_si.0': {'$lt': pytest.approx(0.01244)}}
+    ]}}}
+
+    # the same query compiled against the raw values is cached separately
+    assert Query(q_str, use_si_values=False).to_query_language()['measurement.results']['$elemMatch']['$or'][0] == {'type': 'measurement', 'value.0': {'$lt': 1}}
+
+    # without an isotope, masses cannot be converted, so the raw values are compared
+    q_dict = Query('measurement.results.value is greater than 2\nAND\nmeasurement.results.unit equals ppb', use_si_values=True).to_query_language()
+    assert q_dict == {'measurement.results': {'$elemMatch': {'unit': 'ppb', '$or': [{'type': 'measurement', 'value.0': {'$gt': 2}}, {'type': 'range', 'value.0': {'$gt': 2}}]}}}
+    q_dict = Query('measurement.results.value is greater than 2\nAND\nmeasurement.results.unit equals mBq/kg', use_si_values=True).to_query_language()
+    assert q_dict['measurement.results']['$elemMatch']['unit_si'] == 'Bq/kg'
+    assert q_dict['measurement.results']['$elemMatch']['$or'][0] == {'type': 'measurement', 'value_si.0': {'$gt': pytest.approx(0.002)}}
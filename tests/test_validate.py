@@ -0,0 +1,33 @@
+import pytest
+import datetime
+
+from dunetoolkit import DuneValidator, get_validator, reload_reference_data
+
+
+def test_get_validator_cached():
+    validator = get_validator('whole_record')
+    assert get_validator('whole_record') is validator
+    assert get_validator('whole_record', datetime_str=True) is not validator
+    assert get_validator('measurement_result') is not validator
+
+    # validators are rebuilt once the reference data they were built from is reloaded
+    reload_reference_data()
+    assert get_validator('whole_record') is not validator
+
+
+def test_validate_many():
+    validator = get_validator('measurement_result')
+    docs = [
+        {'isotope':'K-40', 'type':'measurement', 'unit':'ppm', 'value':[0.78, 0.02]},
+        {'isotope':'K-40', 'type':'bad type', 'unit':'ppm', 'value':[0.78, 0.02]},
+        {'isotope':'U-238', 'type':'limit', 'unit':'ppb', 'value':[1]},
+        {'isotope':'U-238', 'type':'limit', 'unit':'ppb'}
+    ]
+    results = validator.validate_many(docs)
+    assert [ is_valid for is_valid, error_msg in results ] == [True, False, True, False]
+    assert results[0][1] == ''
+    assert results[1][1] != ''
+
+    # the same results as validating each document on its own
+    assert results == [ DuneValidator('measurement_result').validate(doc) for doc in docs ]
+    assert validator.validate_many([]) == []
@@ -12,12 +12,14 @@ import time
 import logging
 import argparse
 import datetime
+import hmac
 from functools import wraps
-import scrypt
-from flask import Flask, request, session, url_for, redirect, render_template
+from flask import Flask, Response, request, session, url_for, redirect, jsonify, stream_with_context
+from flask import render_template as flask_render_template
 from dunetoolkit import search_by_id, convert_date_to_str
-from frontend_helpers import _add_user, _get_user, do_q_append, parse_update, perform_search, perform_insert, perform_update
+from frontend_helpers import SEARCH_PAGE_SIZE, _add_user, _get_user, _update_user_password, ensure_user_indexes, new_password_hash, check_password, needs_rehash, do_q_append, restore_existing_q, parse_update, perform_search_page, perform_count, perform_search_by_id, perform_facet_counts, perform_explain, parse_api_search_params, stream_search_ndjson, perform_insert, perform_update
 from pymongo import MongoClient
+import metrics
 
 app = Flask(__name__)
 
@@ -30,6 +32,8 @@ with open(config_name, 'r') as config:
     config_dict = json.load(config)
 app.config['SECRET_KEY'] = config_dict['secret_key']
 salt = config_dict['salt']
+# new password hashes are made with these scrypt parameters (see frontend_helpers.calibrate_scrypt_params to choose them)
+scrypt_params = {'N':config_dict.get('scrypt_n', 16), 'r':config_dict.get('scrypt_r', 8), 'p':config_dict.get('scrypt_p', 1)}
 db_obj = MongoClient(config_dict['mongodb_host'], config_dict['mongodb_port'])[config_dict['database']]
 
 app.permanent_session_lifetime = datetime.timedelta(hours=24)
@@ -43,6 +47,29 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s\t - %(pathname)s - %(
 fh.setFormatter(formatter)
 logger.addHandler(fh)
 
+# with "json_log":true in the config (or DUNE_JSON_LOG=true in the environment), every request is also logged as one line of JSON with its timings
+if config_dict.get('json_log', False):
+    metrics.JSON_LOG_ENABLED = True
+if metrics.JSON_LOG_ENABLED:
+    json_fh = logging.FileHandler('dune_ui_requests_'+str(int(time.time()))+'.log')
+    json_fh.setFormatter(logging.Formatter('%(message)s'))
+    metrics.json_logger.setLevel(logging.INFO)
+    metrics.json_logger.addHandler(json_fh)
+
+# if set, the /metrics endpoint can be scraped with the header "Authorization: Bearer <metrics_token>". Otherwise, only administrators can access it.
+metrics_token = config_dict.get('metrics_token', '')
+
+ensure_user_indexes(db_obj)
+
+
+app.before_request(metrics.start_request)
+app.after_request(metrics.finish_request)
+
+def render_template(template_name, **context):
+    """Renders a template with flask's render_template, timing it as the "render_template" stage of the request (see metrics.timed).
+    """
+    with metrics.timed('render_template'):
+        return flask_render_template(template_name, **context)
 
 def requires_permissions(permissions_levels):
     """This defines a custom decorator for other endpoints which specifies which users can access a given endpoint. This decorator checks if the user that is currently logged in has permissions in the group of permissions_levels that are permitted to access the given endpoint. If permission is granted, the user is taken to the requested endpoint. Otherwise, they are taken to the "login" page if the user mode was None, or to the "restricted" page if their user mode does not have access.
@@ -92,9 +119,9 @@ def register():
             return render_template('register.html', msg='Your email already exists in the database.')
 
         password = request.form.get('password')
-        encrypted_pw = scrypt.hash(password, salt, N=16) #password, salt, N=(num_iterations), r=(block_size), p=(num_threads), bufflen=(num_output_bytes)
+        encrypted_pw, user_salt = new_password_hash(password, scrypt_params)
 
-        insert_resp = _add_user(user, encrypted_pw, db_obj)
+        insert_resp = _add_user(user, encrypted_pw, db_obj, salt=user_salt, scrypt_params=scrypt_params)
         return redirect(url_for('login'))
 
     else:
@@ -107,7 +134,7 @@ def login():
     GET request:
         Render the login page.
     POST request:
-        Attempt to initiate a session for the user by checking that their username and password correspond to a user in the database.
+        Attempt to initiate a session for the user by checking that their username and password correspond to a user in the database. Users whose password hash was made with the global salt or with old scrypt parameters get a new hash with their own salt and the current parameters.
         form data:
             * user (str): username to check against the database.
             * password (str): corresponding plaintext password to encrypt and check.
@@ -120,10 +147,13 @@ def login():
         if user_obj is None:
             return render_template('login.html', msg='User was not found in the database')
         else:
-            user_db_pw_hash = user_obj['password_hashed']
-            is_correct_pw = (scrypt.hash(plaintext_password, salt, N=16) == user_db_pw_hash)
+            is_correct_pw = check_password(plaintext_password, user_obj, salt)
 
             if is_correct_pw:
+                if needs_rehash(user_obj, scrypt_params):
+                    # move users onto their own salt and the current scrypt parameters
+                    encrypted_pw, user_salt = new_password_hash(plaintext_password, scrypt_params)
+                    _update_user_password(user_obj, encrypted_pw, user_salt, scrypt_params, db_obj)
                 session['permanent'] = True
                 session['user_mode'] = user_obj['user_mode']
                 return redirect(url_for('reference_endpoint'))
@@ -161,42 +191,61 @@ def search_endpoint():
         form data:
             * append_button (str): if the value for this field is "do_and" or "do_or", the rest of the form data is parsed into the elements of a new query term and added to whatever query terms already exist. If the value is "do_and", the query term is added to the existing query with an "and" operation. If the value is "do_or", it is added with an "or" operation.
             * existing_query (str): the human-readable version of whatever existing query is already present and is currently being added to.
+            * existing_query_state (str): the serialized state of the existing query (see Query.to_state). If present, the existing query is restored from it instead of being parsed from existing_query.
             * query_field (str): the field that is being queried against.
             * comparison_operator (str): the type of comparison being made in the query term.
             * query_value (str): the value to compare.
             * include_synonyms (str): if "true", the query searches not only for the specified value, but also for all synonyms of the value, if the value is present in the synonyms list.
             * append_mode (str): whether to add the new query term to the existing query with an "and" or "or"  operation.
+            * page_button (str): if the value for this field is "next", the query given by existing_query_state (or existing_query) is not added to, and the page of its results after the one ending with the record after_id is shown.
+            * after_id (str): the resume token of the page of results being shown (see dunetoolkit.search_page).
+            * page_start (str): the number of results that were shown before the page being shown.
     """
     final_q_lines_list = []
     append_mode = ''
     results = []
-    results_str = []
+    final_q_state = ''
+    next_after_id = None
+    total_count = None
+    page_start = 0
 
     if request.form.get("append_button") == "do_and":
-        q_dict, q_str, num_q_lines, error_msg = do_q_append(request.form)
+        q_dict, q_str, q_state, num_q_lines, error_msg = do_q_append(request.form)
         append_mode = "AND"
 
     elif request.form.get("append_button") == "do_or":
-        q_dict, q_str, num_q_lines, error_msg = do_q_append(request.form)
+        q_dict, q_str, q_state, num_q_lines, error_msg = do_q_append(request.form)
         append_mode = "OR"
  
     elif request.method == "POST":
-        final_q, final_q_str, num_q_lines, error_msg = do_q_append(request.form)
-
-        results, error_msg = perform_search(final_q, db_obj)
+        if request.form.get("page_button") == "next":
+            final_q, final_q_str, final_q_state, error_msg = restore_existing_q(request.form)
+            after_id = request.form.get('after_id', '').strip() or None
+            page_start = int(request.form.get('page_start', '0')) if request.form.get('page_start', '0').isdigit() else 0
+        else:
+            final_q, final_q_str, final_q_state, num_q_lines, error_msg = do_q_append(request.form)
+            after_id = None
+
+        if error_msg == '':
+            # results are shown one page at a time, and the result list only renders a summary of each record; the full record is fetched from search_record_endpoint when expanded
+            results, next_after_id, error_msg = perform_search_page(final_q, db_obj, page_size=SEARCH_PAGE_SIZE, after_id=after_id, projection='summary')
+            total_count, count_error_msg = perform_count(final_q, db_obj)
+            if count_error_msg != '':
+                logger.error(count_error_msg)
         
         final_q_lines_list = []
         if final_q_str != '':
             final_q_lines_list = final_q_str.split('\n')
         
-        results_str = [ str(r) for r in results ]
         q_dict = {}
         q_str = ''
+        q_state = ''
         num_q_lines = 0
 
     else:
         q_dict = {}
         q_str = ''
+        q_state = ''
         num_q_lines = 0
         error_msg = ''
 
@@ -204,7 +253,112 @@ def search_endpoint():
         logger.error(error_msg)
 
     logger.debug('Q STR: '+str(q_str)+'   \tAPPEND MODE: '+str(append_mode))
-    return render_template('search.html', existing_query=q_str, append_mode=append_mode, error_msg=error_msg, num_q_lines=num_q_lines, final_q=final_q_lines_list, results_str=results_str, results_dict=results)
+    return render_template('search.html', existing_query=q_str, existing_query_state=q_state, append_mode=append_mode, error_msg=error_msg, num_q_lines=num_q_lines, final_q=final_q_lines_list, final_q_state=final_q_state, results_dict=results, next_after_id=next_after_id, total_count=total_count, page_start=page_start, page_size=SEARCH_PAGE_SIZE)
+
+@app.route('/search/record', methods=['GET'])
+@requires_permissions(['DUNEreader', 'DUNEwriter', 'Admin'])
+def search_record_endpoint():
+    """Finds the full document with the given ID and renders its details. The search page's result list only contains a summary of each record, so this endpoint is called when the user expands one of the results.
+
+    GET request:
+        Render the details of the record.
+        query string:
+            * doc_id (str): the database ID of the record to render.
+    """
+    doc_id = request.args.get('doc_id', '')
+    result, error_msg = perform_search_by_id(doc_id, db_obj)
+    if result is None:
+        logger.error(error_msg)
+        return error_msg, 404
+    return render_template('search_result.html', result_dict=result)
+
+@app.route('/search/facets', methods=['GET'])
+@requires_permissions(['DUNEreader', 'DUNEwriter', 'Admin'])
+def search_facets_endpoint():
+    """Counts the records that match a query, in total and by grouping, isotope, institution, and technique, without fetching the records. The search page calls this to show how the results break down, so that refining a query does not require transferring all of its results.
+
+    GET request:
+        Return the counts as JSON: {"total":<int>, "facets":{<field>:[{"value":<field value>, "count":<int>}, ...], ...}}
+        query string:
+            * q (str): the human-readable query to count the results of. If not present, all records are counted.
+    """
+    q_str = request.args.get('q', '')
+    counts, error_msg = perform_facet_counts(q_str, db_obj)
+    if counts is None:
+        logger.error(error_msg)
+        return jsonify({'error':error_msg}), 400
+    return jsonify(counts)
+
+@app.route('/search/explain', methods=['GET'])
+@requires_permissions(['Admin'])
+def search_explain_endpoint():
+    """Shows how the database runs a query, for finding out why a search is slow (e.g. which index, if any, the measurement results terms use). Only administrators can access it.
+
+    GET request:
+        Return the explanation as JSON: {"filter":<the compiled pymongo query>, "winning_plan":<the plan the database chose>, "stages":[<stage names, first to last>], "indexes_used":[<index names>], "rejected_plans":<int>, "keys_examined":<int>, "docs_examined":<int>, "docs_returned":<int>, "execution_time_ms":<int>}
+        query string:
+            * q (str): the human-readable query to explain. If not present, a search of all records is explained.
+    """
+    q_str = request.args.get('q', '')
+    summary, error_msg = perform_explain(q_str, db_obj)
+    if summary is None:
+        logger.error(error_msg)
+        return jsonify({'error':error_msg}), 400
+    return jsonify(summary)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Serves the latency histograms of every endpoint and of the stages of handling requests (parsing queries, searching, inserting, and updating in MongoDB, and rendering templates), in the Prometheus text format. If metrics_token is set in the config, a request with the header "Authorization: Bearer <metrics_token>" can access it, so that Prometheus can scrape it; otherwise, only administrators can access it.
+
+    GET request:
+        Return the metrics as text: the dune_request_duration_seconds histogram, labelled by endpoint, method, and status, and the dune_stage_duration_seconds histogram, labelled by endpoint and stage.
+    """
+    if metrics_token != '':
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer '+metrics_token):
+            return Response('unauthorized\n', status=401, mimetype='text/plain')
+    elif session.get('user_mode') != 'Admin':
+        return redirect(url_for('login')) if session.get('user_mode') is None else redirect(url_for('restricted_page'))
+    return Response(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/v1/search', methods=['GET','POST'])
+@requires_permissions(['DUNEreader', 'DUNEwriter', 'Admin'])
+def api_search_endpoint():
+    """Searches for records and streams them back as newline-delimited JSON (one record per line, with dates in ISO 8601 format), straight from the database cursor. Results are paged with resume tokens: the last line of every response is {"next_after_id": <resume token>}, and passing the resume token back as "after_id" returns the next page (it is null on the last page).
+
+    GET request:
+        query string:
+            * q (str): the human-readable query to search with. If not present, all records are returned.
+            * page_size (int): the maximum number of records to return (defaults to 100; 0 returns every matching record).
+            * after_id (str): the resume token of the previous page.
+            * projection (str): the name of a projection profile (e.g. "summary") to only return some fields of each record.
+    POST request:
+        JSON body:
+            the same keys as the GET query string, or, instead of "q", "terms" (list of dict): structured query terms, each with the keys "field", "comparison", "value", and optionally "append_mode", "include_synonyms", and "synonym_mode".
+    """
+    if request.method == 'POST':
+        params = request.get_json(silent=True)
+        if type(params) is not dict:
+            return jsonify({'error':'the request body must be a JSON object'}), 400
+    else:
+        params = request.args
+    q_str, page_size, after_id, projection, error_msg = parse_api_search_params(params)
+    if error_msg != '':
+        logger.error(error_msg)
+        return jsonify({'error':error_msg}), 400
+
+    # start the search before the response is sent, so that a query the database rejects can still get an error status
+    lines = stream_search_ndjson(q_str, db_obj, page_size=page_size, after_id=after_id, projection=projection)
+    try:
+        first_line = next(lines)
+    except Exception as e:
+        logger.error('api search failed: '+str(e))
+        return jsonify({'error':'the search failed: '+str(e)}), 400
+
+    def generate():
+        yield first_line
+        for line in lines:
+            yield line
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 @app.route('/insert', methods=['GET','POST'])
 @requires_permissions(['DUNEwriter', 'Admin'])
@@ -5,14 +5,53 @@
 .. moduleauthor:: Elise Saxon
 """
 
+import os
 import re
+import hmac
+import json
+import time
 import logging
-from dunetoolkit import Query, add_to_query, search, insert, update, convert_date_to_str
+import datetime
+import threading
+from copy import deepcopy
+import scrypt
+from pymongo import ASCENDING
+from bson.objectid import ObjectId
+from metrics import timed_function
+from dunetoolkit import Query, add_to_query, search, iter_search, search_page, search_by_id, count, facet_counts, insert, update, convert_date_to_str
 
 logger = logging.getLogger('dune_ui')
 
+# the number of seconds a user document read by _get_user is reused for before it is read from the database again
+USER_CACHE_TTL = 30
+
+# the scrypt parameters that passwords were hashed with before each user had their own salt and parameters. Users that were added then are checked with these and the global salt from the app config, and are rehashed with their own salt the next time they log in.
+LEGACY_SCRYPT_PARAMS = {'N':16, 'r':8, 'p':1}
+
+# the number of records shown on each page of the search page's results
+SEARCH_PAGE_SIZE = 50
+
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+def ensure_user_indexes(db_obj):
+    """Creates the index on the "user_mode" field of the "users" collection that _get_user relies on, if it does not already exist.
+
+    args:
+        * db_obj (pymongo.database.Database): a pymongo database object that, once a collection has been selected, can be used to query.
+
+    returns:
+        * str. The error message that arose while trying to create the index (empty string if no errors happened).
+    """
+    try:
+        db_obj.users.create_index([('user_mode', ASCENDING)], name='user_mode')
+    except Exception as e:
+        logger.warning('could not create the users index: '+str(e))
+        return str(e)
+    return ''
+
 def _get_user(user, db_obj):
-    """This function searches the "users" collection of the mongodb database for the document whose "user_mode" value is the same as the user argument provided.
+    """This function searches the "users" collection of the mongodb database for the document whose "user_mode" value is the same as the user argument provided. Documents that are found are cached for USER_CACHE_TTL seconds, so that many logins at once do not each have to query the database.
 
     args:
         * user (str): the user_name to search for in the database.
@@ -21,23 +60,41 @@ def _get_user(user, db_obj):
     returns:
         * dict. A JSON object representing the entire user document from the database.
     """
+    cache_key = (db_obj.name, user)
+    with _user_cache_lock:
+        cached = _user_cache.get(cache_key)
+    if cached is not None and cached[0] > time.monotonic():
+        return deepcopy(cached[1])
+
     coll = db_obj.users
 
     find_user_q = {'user_mode':{'$eq':user}}
-    find_user_resp = coll.find(find_user_q)
-    find_user_resp = list(find_user_resp)
-    if len(find_user_resp) <= 0:
-        user_obj = None
-    else:
-        user_obj = find_user_resp[0]
+    user_obj = coll.find_one(find_user_q)
+    # users that are not found are not cached, so that failed logins with made-up names cannot fill up the cache
+    if user_obj is not None:
+        with _user_cache_lock:
+            _user_cache[cache_key] = (time.monotonic()+USER_CACHE_TTL, deepcopy(user_obj))
     return user_obj
 
-def _add_user(user, encrypted_pw, db_obj):
+def _invalidate_user(user, db_obj):
+    """Removes a user's document from the _get_user cache, so the next lookup reads it from the database.
+
+    args:
+        * user (str): the user_name of the user.
+        * db_obj (pymongo.database.Database): the pymongo database object the user document was read from.
+    """
+    with _user_cache_lock:
+        _user_cache.pop((db_obj.name, user), None)
+
+def _add_user(user, encrypted_pw, db_obj, salt=None, scrypt_params=None):
     """Creates a dict out of the provided username and password and adds it as a user document in the "users" collection of the mongodb.
 
     args:
         * user (str): the plaintext username to add.
         * encrypted_pw (bytes): the encrypted byte encoding of the password to add.
+        * db_obj (pymongo.database.Database): a pymongo database object that, once a collection has been selected, can be used to query.
+        * salt (bytes) (optional): the user's own salt that the password was hashed with (see hash_password). If not provided, the password must have been hashed with the global salt and LEGACY_SCRYPT_PARAMS.
+        * scrypt_params (dict) (optional): the scrypt parameters ("N", "r", and "p") that the password was hashed with.
 
     returns:
         * pymongo.results.InsertOneResult. The pymongo response object from the insertion (the inserted_id attribute of this object can be used to evaluate success).
@@ -45,12 +102,114 @@ def _add_user(user, encrypted_pw, db_obj):
     coll = db_obj.users
 
     db_new_user = {'user_mode':user, 'password_hashed':encrypted_pw}
+    if salt is not None:
+        db_new_user['salt'] = salt
+        db_new_user['scrypt_params'] = scrypt_params
     insert_resp = coll.insert_one(db_new_user)
+    _invalidate_user(user, db_obj)
     return insert_resp
 
+def _update_user_password(user_obj, encrypted_pw, salt, scrypt_params, db_obj):
+    """Replaces the password hash of an existing user document, along with the salt and scrypt parameters it was made with.
+
+    args:
+        * user_obj (dict): the user document, as returned by _get_user.
+        * encrypted_pw (bytes): the new password hash.
+        * salt (bytes): the salt that the password was hashed with.
+        * scrypt_params (dict): the scrypt parameters ("N", "r", and "p") that the password was hashed with.
+        * db_obj (pymongo.database.Database): a pymongo database object that, once a collection has been selected, can be used to query.
+
+    returns:
+        * pymongo.results.UpdateResult. The pymongo response object from the update.
+    """
+    update_resp = db_obj.users.update_one({'_id':user_obj['_id']}, {'$set':{'password_hashed':encrypted_pw, 'salt':salt, 'scrypt_params':scrypt_params}})
+    _invalidate_user(user_obj['user_mode'], db_obj)
+    return update_resp
+
+def hash_password(password, salt, scrypt_params):
+    """Hashes a password with scrypt.
+
+    args:
+        * password (str): the plaintext password.
+        * salt (bytes or str): the salt to hash the password with.
+        * scrypt_params (dict): the scrypt cost parameters "N" (the number of iterations, which must be a power of 2), "r" (the block size), and "p" (the number of parallel threads).
+
+    returns:
+        * bytes. The password hash.
+    """
+    return scrypt.hash(password, salt, N=scrypt_params['N'], r=scrypt_params['r'], p=scrypt_params['p'])
+
+def new_password_hash(password, scrypt_params):
+    """Hashes a password with a new random salt, for a new user (or a user whose password is being rehashed).
+
+    args:
+        * password (str): the plaintext password.
+        * scrypt_params (dict): the scrypt cost parameters (see hash_password).
+
+    returns:
+        * bytes. The password hash.
+        * bytes. The salt, which must be stored with the hash.
+    """
+    salt = os.urandom(16)
+    return hash_password(password, salt, scrypt_params), salt
+
+def check_password(password, user_obj, legacy_salt):
+    """Checks a password against a user document's password hash, using the user's own salt and scrypt parameters (or, for users that were added before users had their own salts, the global salt and LEGACY_SCRYPT_PARAMS). The hashes are compared in constant time.
 
+    args:
+        * password (str): the plaintext password to check.
+        * user_obj (dict): the user document, as returned by _get_user.
+        * legacy_salt (str): the global salt from the app config.
+
+    returns:
+        * bool. Whether the password is correct.
+    """
+    salt = user_obj.get('salt', legacy_salt)
+    scrypt_params = user_obj.get('scrypt_params', LEGACY_SCRYPT_PARAMS)
+    return hmac.compare_digest(hash_password(password, salt, scrypt_params), user_obj['password_hashed'])
+
+def needs_rehash(user_obj, scrypt_params):
+    """Checks whether a user's password hash should be replaced after they log in, because it was made with the global salt or with different scrypt parameters than the current ones.
+
+    args:
+        * user_obj (dict): the user document, as returned by _get_user.
+        * scrypt_params (dict): the current scrypt parameters.
+
+    returns:
+        * bool. Whether the password should be rehashed.
+    """
+    return 'salt' not in user_obj or user_obj.get('scrypt_params') != scrypt_params
+
+def calibrate_scrypt_params(target_seconds=0.05, r=8, p=1, max_n=2**20):
+    """Finds the largest scrypt iteration count N (a power of 2) for which hashing a password takes no more than target_seconds on this machine. Use this to choose the "scrypt_n" value of the app config: a larger N makes stolen password hashes harder to crack, but makes every login (and a burst of logins) take longer.
+
+    args:
+        * target_seconds (float) (optional): the longest a single password hash should take.
+        * r (int) (optional): the scrypt block size.
+        * p (int) (optional): the number of scrypt parallel threads.
+        * max_n (int) (optional): the largest N to try.
+
+    returns:
+        * dict. The scrypt parameters "N", "r", and "p", and "seconds", the time one hash took with them.
+    """
+    salt = os.urandom(16)
+    best = None
+    n = 16
+    while n <= max_n:
+        scrypt_params = {'N':n, 'r':r, 'p':p}
+        start = time.perf_counter()
+        hash_password('calibration password', salt, scrypt_params)
+        seconds = time.perf_counter() - start
+        if best is not None and seconds > target_seconds:
+            break
+        best = dict(scrypt_params, seconds=seconds)
+        n *= 2
+    return best
+
+
+@timed_function('parse_query')
 def do_q_append(form):
-    """Parses out the form input to get the new query term field, comparison, and value, then adds the new query term to whatever query already exists, if there is one. 
+    """Parses out the form input to get the new query term field, comparison, and value, then adds the new query term to whatever query already exists, if there is one. The existing query is restored from its serialized state (see Query.to_state), which the search page keeps in a hidden form field, so that it does not have to be re-parsed from its human-readable version every time a term is added. If there is no state (or it is not valid), the human-readable version is parsed instead.
 
     args:
         * form (werkzeug.datastructures.ImmutableMultiDict): an immutable dictionary containing the information passed by the user as key-value pairs.
@@ -58,19 +217,45 @@ def do_q_append(form):
     returns:
         * dict. The new valid pymongo query.
         * str. The human-readable version of the new query.
+        * str. The serialized state of the new query.
         * int. The number of lines in the human-readable query (for UI purposes).
         * str. An error message (empty string if no errors happened).
     """
     existing_q_text, field, comparison, value, append_mode, include_synonyms = parse_existing_q(form)
-    q_str, q_dict = add_to_query(field, comparison, value, append_mode=append_mode, include_synonyms=include_synonyms, query_string=existing_q_text)
-    q_obj = Query(q_str)
-    q_dict = q_obj.to_query_language()
-    q_str = q_obj.to_string()
+    existing_q_state = form.get('existing_query_state', '').strip()
+    query_object = None
+    if existing_q_state != '':
+        query_object = Query.from_state(existing_q_state)
+    if query_object is None:
+        query_object = Query(existing_q_text)
+    q_str, q_dict = add_to_query(field, comparison, value, query_object=query_object, append_mode=append_mode, include_synonyms=include_synonyms)
+    q_state = query_object.to_state()
     num_q_lines = q_str.count('\n') + 1
 
     error_msg = ''
 
-    return q_dict, q_str, num_q_lines, error_msg
+    return q_dict, q_str, q_state, num_q_lines, error_msg
+
+@timed_function('parse_query')
+def restore_existing_q(form):
+    """Restores the query that the search page is showing results for, without adding a new term to it, so that another page of its results can be shown. The query is restored from its serialized state (see Query.to_state) if the form has one, and is parsed from its human-readable version otherwise.
+
+    args:
+        * form (werkzeug.datastructures.ImmutableMultiDict): an immutable dictionary containing the information passed by the user as key-value pairs.
+
+    returns:
+        * dict. The valid pymongo query.
+        * str. The human-readable version of the query.
+        * str. The serialized state of the query.
+        * str. An error message (empty string if no errors happened).
+    """
+    q_state = form.get('existing_query_state', '').strip()
+    query_object = Query.from_state(q_state) if q_state != '' else None
+    if query_object is None:
+        query_object = Query(form.get('existing_query', '').strip())
+    if len(query_object.terms) == 0:
+        return {}, '', '', 'the query to show more results of is missing or not valid'
+    return query_object.to_query_language(), query_object.to_string(), query_object.to_state(), ''
 
 def convert_str_to_float(value):
     """Converts the given value to a float type object, if possible. If the object cannot be converted into a float, nothing happens.
@@ -110,31 +295,231 @@ def parse_existing_q(form_obj):
     append_mode = form_obj.get('append_mode', '').strip()
     return existing_q, field, comparison, value, append_mode, include_synonyms
 
-def perform_search(curr_q, db_obj, coll_type=''):
-    """Calls the dunetoolkit search function to retrieve documents from the database with the given query, then formats and returns the documents.
+def _format_result_dates(result):
+    """Converts the datetime objects of a found document into strings for UI display. Documents found with a projection may not contain the date fields, in which case they are left as-is.
+
+    args:
+        * result (dict): a document found in the database.
+
+    returns:
+        * dict. The same document with its measurement and data input dates converted into strings.
+    """
+    meas_dates = result.get('measurement', {}).get('date', [])
+    for j in range(len(meas_dates)):
+        meas_dates[j] = convert_date_to_str(meas_dates[j])
+    input_dates = result.get('data_source', {}).get('input', {}).get('date', [])
+    for j in range(len(input_dates)):
+        input_dates[j] = convert_date_to_str(input_dates[j])
+    return result
+
+@timed_function('mongodb_search')
+def perform_search(curr_q, db_obj, coll_type='', projection=None):
+    """Calls the dunetoolkit search function to retrieve documents from the database with the given query, then formats and returns the documents. If result caching is on (see dunetoolkit.result_cache), a repeated search is answered from the cache.
 
     args:
         * curr_q (dict): a valid pymongo query to use to search the database.
         * db_obj (pymongo.database.Database): a pymongo database object that, once a collection has been selected, can be used to query.
         * coll_type (str) (optional): if provided, this field specifies which column of the database to search (e.g. assays or assay_requests). If not provided, the dunetoolkit automatically searches the assays collection.
+        * projection (str or dict) (optional): if provided, only these fields of each document are returned (e.g. the "summary" projection profile for the search page's result list).
 
     returns:
         * list of dict. The list of found documents.
         * str. An error message (empty string if no errors happened).
     """
-    # query for results
-    results = search(curr_q, db_obj, coll_type)
+    # query for results, converting datetime objects to strings for UI display (the cache hands out copies, so the found documents can be changed)
+    results = [ _format_result_dates(result) for result in search(curr_q, db_obj, coll_type, projection=projection) ]
+    return results, ''
 
-    # convert datetime objects to strings for UI display
-    for i in range(len(results)):
-        for j in range(len(results[i]['measurement']['date'])):
-                results[i]['measurement']['date'][j] = convert_date_to_str(results[i]['measurement']['date'][j])
-        for j in range(len(results[i]['data_source']['input']['date'])):
-            results[i]['data_source']['input']['date'][j] = convert_date_to_str(results[i]['data_source']['input']['date'][j])
+@timed_function('mongodb_search')
+def perform_search_page(curr_q, db_obj, page_size=50, after_id=None, coll_type='', projection=None):
+    """Calls the dunetoolkit search_page function to retrieve one page of the documents from the database that match the given query, then formats and returns the documents. The search page shows its results one page at a time with this, so the memory used by each search is bounded by the page size. If result caching is on (see dunetoolkit.result_cache), a repeated search is answered from the cache.
 
-    return results, ''
+    args:
+        * curr_q (dict): a valid pymongo query to use to search the database.
+        * db_obj (pymongo.database.Database): a pymongo database object that, once a collection has been selected, can be used to query.
+        * page_size (int) (optional): the maximum number of documents to return.
+        * after_id (str) (optional): the resume token returned with the previous page. If not provided, the first page is returned.
+        * coll_type (str) (optional): if provided, this field specifies which column of the database to search (e.g. assays or assay_requests). If not provided, the dunetoolkit automatically searches the assays collection.
+        * projection (str or dict) (optional): if provided, only these fields of each document are returned.
+
+    returns:
+        * list of dict. The list of found documents in this page.
+        * str. The resume token for the next page (None if this is the last page).
+        * str. An error message (empty string if no errors happened).
+    """
+    results, next_after_id = search_page(curr_q, db_obj, coll_type, page_size=page_size, after_id=after_id, projection=projection)
+    results = [ _format_result_dates(result) for result in results ]
+    return results, next_after_id, ''
+
+@timed_function('mongodb_count')
+def perform_count(curr_q, db_obj, coll_type=''):
+    """Calls the dunetoolkit count function to count the documents in the database that match the given query, without fetching them. The search page shows this total alongside each page of results.
+
+    args:
+        * curr_q (str or dict): the human-readable query string or a valid pymongo query to count the matching documents of.
+        * db_obj (pymongo.database.Database): a pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): if provided, this field specifies which column of the database to search (e.g. assays or assay_requests). If not provided, the dunetoolkit automatically searches the assays collection.
+
+    returns:
+        * int. The number of matching documents (None if they could not be counted).
+        * str. An error message (empty string if no errors happened).
+    """
+    try:
+        num_docs = count(curr_q, db_obj, coll_type)
+    except Exception as e:
+        return None, 'could not count the results of the query: '+str(e)
+    return num_docs, ''
+
+@timed_function('mongodb_search')
+def perform_search_by_id(doc_id, db_obj, coll_type=''):
+    """Calls the dunetoolkit search_by_id function to retrieve the full document with the given ID, then formats it for display. The search page's result list only holds a summary of each document, so this is used to fetch a document's details when the user expands its row.
+
+    args:
+        * doc_id (str): the ID of the document to find.
+        * db_obj (pymongo.database.Database): a pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): if provided, this field specifies which column of the database to search (e.g. assays or assay_requests). If not provided, the dunetoolkit automatically searches the assays collection.
+
+    returns:
+        * dict. The found document (None if no document has the given ID).
+        * str. An error message (empty string if no errors happened).
+    """
+    result = search_by_id(doc_id, db_obj, coll_type)
+    if result is None:
+        return None, 'no document was found with the ID '+str(doc_id)
+    result['_id'] = str(result['_id'])
+    return _format_result_dates(result), ''
+
+@timed_function('mongodb_facet_counts')
+def perform_facet_counts(curr_q, db_obj, coll_type=''):
+    """Calls the dunetoolkit facet_counts function to count the documents in the database that match the given query, in total and by the values of the facet fields (grouping, isotope, institution, and technique), without fetching the documents themselves.
+
+    args:
+        * curr_q (str or dict): the human-readable query string or a valid pymongo query to count the matching documents of.
+        * db_obj (pymongo.database.Database): a pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): if provided, this field specifies which column of the database to search (e.g. assays or assay_requests). If not provided, the dunetoolkit automatically searches the assays collection.
+
+    returns:
+        * dict. The total count and the counts for each facet field (None if the counts could not be found).
+        * str. An error message (empty string if no errors happened).
+    """
+    try:
+        counts = facet_counts(curr_q, db_obj, coll_type)
+    except Exception as e:
+        return None, 'could not count the results of the query: '+str(e)
+    return counts, ''
+
+@timed_function('mongodb_explain')
+def perform_explain(curr_q, db_obj, coll_type=''):
+    """Calls the dunetoolkit search function in explain mode to find out how the database runs the given query: the winning query plan, the indexes it uses, the numbers of index keys and documents it examines and returns, and how long it takes.
+
+    args:
+        * curr_q (str or dict): the human-readable query string or a valid pymongo query to explain.
+        * db_obj (pymongo.database.Database): a pymongo database object that, once a collection has been selected, can be used to query.
+        * coll_type (str) (optional): if provided, this field specifies which column of the database to search (e.g. assays or assay_requests). If not provided, the dunetoolkit automatically searches the assays collection.
+
+    returns:
+        * dict. The summary of the query plan and execution statistics, with every value converted to JSON (None if the query could not be explained).
+        * str. An error message (empty string if no errors happened).
+    """
+    try:
+        summary = search(curr_q, db_obj, coll_type, explain=True)
+    except Exception as e:
+        return None, 'could not explain the query: '+str(e)
+    return json.loads(json.dumps(summary, default=_to_json_value)), ''
+
+
+def parse_api_search_params(params):
+    """Parses the parameters of a JSON search API request into a query and the pagination options. The query can be given either as a human-readable query string ("q") or as a list of structured query terms ("terms"), each of which is a dict with the keys "field", "comparison", and "value", and the optional keys "append_mode" (required for every term but the first), "include_synonyms" (defaults to True), and "synonym_mode" (defaults to "exact").
+
+    args:
+        * params (dict): the request parameters (the query string arguments of a GET request or the JSON body of a POST request). The optional keys are "q", "terms", "page_size" (defaults to 100; 0 returns every matching document), "after_id", and "projection" (the name of a projection profile, e.g. "summary").
+
+    returns:
+        * str. The human-readable query to search with (None if the parameters are invalid).
+        * int. The maximum number of documents to return.
+        * str. The resume token of the previous page (None for the first page).
+        * str. The name of the projection profile to use (None for the full documents).
+        * str. An error message (empty string if no errors happened).
+    """
+    terms = params.get('terms')
+    if terms is not None:
+        if type(terms) is not list:
+            return None, 0, None, None, '"terms" must be a list of query terms'
+        q_obj = Query()
+        for i, term in enumerate(terms):
+            if type(term) is not dict or 'field' not in term or 'comparison' not in term or 'value' not in term:
+                return None, 0, None, None, 'query term '+str(i)+' must have a "field", a "comparison", and a "value"'
+            prev_q_str = q_obj.to_string()
+            q_obj.add_query_term(term['field'], term['comparison'], term['value'], term.get('append_mode', ''), \
+                term.get('include_synonyms', True), term.get('synonym_mode', 'exact'))
+            # an invalid term is not added to the query
+            if q_obj.to_string() == prev_q_str:
+                return None, 0, None, None, 'query term '+str(i)+' is not valid'
+        q_str = q_obj.to_string()
+    else:
+        q_str = str(params.get('q', '')).strip()
+
+    try:
+        page_size = int(params.get('page_size', 100))
+    except (TypeError, ValueError):
+        return None, 0, None, None, '"page_size" must be an integer'
+    if page_size < 0:
+        return None, 0, None, None, '"page_size" must not be negative'
+
+    after_id = params.get('after_id')
+    if after_id is not None and not ObjectId.is_valid(after_id):
+        return None, 0, None, None, '"after_id" must be a valid document ID'
 
+    projection = params.get('projection')
+    return q_str, page_size, after_id, projection, ''
 
+def _to_json_value(obj):
+    """Converts the values of a found document (or a query) that are not JSON serializable (dates, database IDs, and regular expressions) into strings. This is used as the "default" argument of json.dumps.
+
+    args:
+        * obj (any type): a value that json.dumps could not serialize.
+
+    returns:
+        * str. The value as a string (ISO 8601 for dates, and the pattern for regular expressions).
+    """
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, re.Pattern):
+        return obj.pattern
+    raise TypeError('cannot convert '+str(type(obj))+' to JSON')
+
+def stream_search_ndjson(curr_q, db_obj, page_size=100, after_id=None, projection=None, coll_type=''):
+    """Calls the dunetoolkit iter_search function and yields the found documents as newline-delimited JSON as they are read from the database cursor, so that the response can be streamed without holding the results in memory. The last line is always a page trailer of the form {"next_after_id": <resume token>}, where the resume token can be passed back as "after_id" to get the next page, and is null if there are no more pages.
+
+    args:
+        * curr_q (str or dict): the human-readable query string or a valid pymongo query to search with.
+        * db_obj (pymongo.database.Database): a pymongo database object that, once a collection has been selected, can be used to query.
+        * page_size (int) (optional): the maximum number of documents to return. If 0, every matching document is returned.
+        * after_id (str) (optional): the resume token returned with the previous page. If not provided, the first page is returned.
+        * projection (str or dict) (optional): if provided, only these fields of each document are returned.
+        * coll_type (str) (optional): if provided, this field specifies which column of the database to search (e.g. assays or assay_requests). If not provided, the dunetoolkit automatically searches the assays collection.
+
+    yields:
+        * str. One line of JSON for each found document, followed by the page trailer line.
+    """
+    # fetch one extra document to find out whether there is another page
+    limit = page_size+1 if page_size > 0 else 0
+    num_docs = 0
+    last_id = None
+    next_after_id = None
+    for doc in iter_search(curr_q, db_obj, coll_type, after_id=after_id, limit=limit, projection=projection):
+        if page_size > 0 and num_docs == page_size:
+            next_after_id = last_id
+            break
+        num_docs += 1
+        last_id = doc['_id']
+        yield json.dumps(doc, default=_to_json_value)+'\n'
+    yield json.dumps({'next_after_id':next_after_id})+'\n'
+
+
+@timed_function('mongodb_insert')
 def perform_insert(form, db_obj, coll_type=''):
     """Parses the form data into a dict with the proper format of a radiopurity database document, then passes that dict to the dunetoolkit insert function to be inserted into the database.
 
@@ -359,6 +744,7 @@ def parse_update(form):
     return doc_id, remove_doc, update_pairs, remove_meas_indices, add_eles
 
 
+@timed_function('mongodb_update')
 def perform_update(doc_id, remove_doc, update_pairs, meas_remove_indices, meas_add_eles, db_obj, is_assay_request_update=False, is_assay_request_verify=False):
     """This function calls the dunetoolkit update function with the update fields and values parsed from the form data.
 
@@ -379,3 +765,15 @@ def perform_update(doc_id, remove_doc, update_pairs, meas_remove_indices, meas_a
     return new_doc_id, error_msg
 
 
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Finds the scrypt parameters to use for password hashes on this machine.')
+    parser.add_argument('--target_ms', type=float, default=50, help='the longest a single password hash should take, in milliseconds')
+    parser.add_argument('--r', type=int, default=8, help='the scrypt block size')
+    parser.add_argument('--p', type=int, default=1, help='the number of scrypt parallel threads')
+    args = parser.parse_args()
+
+    best = calibrate_scrypt_params(target_seconds=args.target_ms/1000, r=args.r, p=args.p)
+    print('"scrypt_n": '+str(best['N'])+', "scrypt_r": '+str(best['r'])+', "scrypt_p": '+str(best['p'])+'  (one hash takes '+str(round(best['seconds']*1000, 1))+' ms)')
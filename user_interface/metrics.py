@@ -0,0 +1,182 @@
+"""
+.. module:: metrics
+   :synopsis: Request-scoped timers for the stages of handling a request (parsing the query, talking to MongoDB, rendering the template), aggregated into latency histograms that are served in the Prometheus text format, and optionally logged as one JSON line per request.
+
+.. moduleauthor:: Elise Saxon
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+
+# the upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# if True, every request is logged to the "dune_ui.requests" logger as one JSON object with its endpoint, status, total time, and the time of each stage. This can be turned on with the "json_log" key of the app config or by setting the environment variable DUNE_JSON_LOG to "true".
+JSON_LOG_ENABLED = os.getenv('DUNE_JSON_LOG', '').strip().lower() == 'true'
+
+json_logger = logging.getLogger('dune_ui.requests')
+
+
+class Histogram():
+    """A thread-safe latency histogram with one set of bucket counts per combination of label values, like a Prometheus histogram.
+    """
+    def __init__(self, name, description, label_names, buckets=LATENCY_BUCKETS):
+        """Creates an empty histogram.
+
+        args:
+            * name (str): The metric name (e.g. "dune_stage_duration_seconds").
+            * description (str): The help text of the metric.
+            * label_names (tuple of str): The names of the labels that each observation has values for.
+            * buckets (tuple of float) (optional): The upper bounds of the buckets, in increasing order.
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        """Records one observation.
+
+        args:
+            * seconds (float): The observed duration.
+            * labels: The value of every one of the histogram's labels.
+        """
+        label_values = tuple([ str(labels[label_name]) for label_name in self.label_names ])
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = {"buckets":[0]*len(self.buckets), "sum":0.0, "count":0}
+                self._series[label_values] = series
+            for i, upper_bound in enumerate(self.buckets):
+                if seconds <= upper_bound:
+                    series["buckets"][i] += 1
+            series["sum"] += seconds
+            series["count"] += 1
+
+    def reset(self):
+        """Removes every observation.
+        """
+        with self._lock:
+            self._series = {}
+
+    def to_prometheus(self):
+        """Formats the histogram in the Prometheus text exposition format.
+
+        returns:
+            * str. The "# HELP" and "# TYPE" lines, then the cumulative bucket, sum, and count lines of every series.
+        """
+        def _format_labels(label_values, extra=''):
+            pairs = [ name+'="'+_escape_label_value(value)+'"' for name, value in zip(self.label_names, label_values) ]
+            if extra != '':
+                pairs.append(extra)
+            return '{'+','.join(pairs)+'}' if len(pairs) > 0 else ''
+
+        lines = ['# HELP '+self.name+' '+self.description, '# TYPE '+self.name+' histogram']
+        with self._lock:
+            series_items = sorted([ (label_values, dict(series, buckets=list(series["buckets"]))) for label_values, series in self._series.items() ])
+        for label_values, series in series_items:
+            for upper_bound, bucket_count in zip(self.buckets, series["buckets"]):
+                lines.append(self.name+'_bucket'+_format_labels(label_values, 'le="'+repr(upper_bound)+'"')+' '+str(bucket_count))
+            lines.append(self.name+'_bucket'+_format_labels(label_values, 'le="+Inf"')+' '+str(series["count"]))
+            lines.append(self.name+'_sum'+_format_labels(label_values)+' '+repr(series["sum"]))
+            lines.append(self.name+'_count'+_format_labels(label_values)+' '+str(series["count"]))
+        return '\n'.join(lines)+'\n'
+
+def _escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_DURATION = Histogram('dune_request_duration_seconds', 'Time taken to handle each request.', ('endpoint', 'method', 'status'))
+STAGE_DURATION = Histogram('dune_stage_duration_seconds', 'Time taken by each stage of handling a request.', ('endpoint', 'stage'))
+
+
+@contextmanager
+def timed(stage):
+    """Times the code in a "with" block as one stage of handling the current request. While handling a request, the time is added to the request's stage timings, which finish_request records in the stage histogram (and logs, if JSON logging is on); a stage that runs more than once in a request is counted once, with its total time. Outside of a request, the time is recorded in the stage histogram right away, with the endpoint "none".
+
+    args:
+        * stage (str): The name of the stage (e.g. "mongodb_search").
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if has_request_context():
+            stage_times = g.setdefault('stage_times', {})
+            stage_times[stage] = stage_times.get(stage, 0.0) + seconds
+        else:
+            STAGE_DURATION.observe(seconds, endpoint='none', stage=stage)
+
+def timed_function(stage):
+    """A decorator that times every call of the decorated function as one stage of handling the current request (see timed).
+
+    args:
+        * stage (str): The name of the stage.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with timed(stage):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+def start_request():
+    """Starts timing the current request. The app calls this before every request.
+    """
+    g.request_start = time.perf_counter()
+    g.stage_times = {}
+
+def finish_request(response):
+    """Records the time taken by the current request and its stages in the histograms, and logs it as JSON if JSON logging is on. The app calls this after every request.
+
+    args:
+        * response (flask.Response): The response to the request.
+
+    returns:
+        * flask.Response. The same response.
+    """
+    start = g.get('request_start')
+    if start is None:
+        return response
+    seconds = time.perf_counter() - start
+    endpoint = request.endpoint if request.endpoint is not None else 'none'
+    stage_times = g.get('stage_times', {})
+
+    REQUEST_DURATION.observe(seconds, endpoint=endpoint, method=request.method, status=response.status_code)
+    for stage, stage_seconds in stage_times.items():
+        STAGE_DURATION.observe(stage_seconds, endpoint=endpoint, stage=stage)
+
+    if JSON_LOG_ENABLED:
+        json_logger.info(json.dumps({
+            "endpoint": endpoint,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round(seconds*1000, 3),
+            "stages_ms": { stage:round(stage_seconds*1000, 3) for stage, stage_seconds in stage_times.items() }
+        }))
+    return response
+
+def render_metrics():
+    """Formats every histogram in the Prometheus text exposition format, for the /metrics endpoint.
+
+    returns:
+        * str. The metrics.
+    """
+    return REQUEST_DURATION.to_prometheus() + STAGE_DURATION.to_prometheus()
+
+def reset_metrics():
+    """Removes every observation from the histograms.
+    """
+    REQUEST_DURATION.reset()
+    STAGE_DURATION.reset()
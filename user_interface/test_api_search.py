@@ -59,6 +59,7 @@ def test_examine_results_1():
     q_elements = [{'field':'measurement.results.value', 'comparison':'lt', 'value':'10', 'append':'and'}, {'field':'measurement.results.value', 'comparison':'gte', 'value':'5', 'append':''}] 
 
     browser = do_query(browser, q_elements)
+    browser = expand_results(browser)
 
     results = browser.page_source
     soup = BeautifulSoup(results, features="html.parser")
@@ -92,6 +93,7 @@ def test_examine_results_2():
     # 'measurement.results.isotope equals K-40\nAND\nmeasurement.results.unit equals ppm\nAND\nmeasurement.results.value is greater than 0.1\nAND\nmeasurement.results.value is less than or equal to 1.0'
     q_elements = [{'field':'measurement.results.isotope', 'comparison':'eq', 'value':'K-40', 'append':'and'}, {'field':'measurement.results.unit', 'comparison':'eq', 'value':'ppm', 'append':'and'}, {'field':'measurement.results.value', 'comparison':'gt', 'value':'0.1', 'append':'and'}, {'field':'measurement.results.value', 'comparison':'lte', 'value':'1', 'append':''}]
     browser = do_query(browser, q_elements)
+    browser = expand_results(browser)
 
     results = browser.page_source
     soup = BeautifulSoup(results, features="html.parser")
@@ -147,6 +149,14 @@ def do_query(browser, query_elements):
 
     return browser
 
+def expand_results(browser):
+    # the full details of each result are only loaded once its collapsible button is clicked
+    for button in browser.find_elements_by_class_name('collapsible'):
+        button.click()
+    for content in browser.find_elements_by_class_name('collapsible-content'):
+        webdriver.support.ui.WebDriverWait(browser, 10).until(lambda b: len(content.find_elements_by_class_name('collapsible-line')) > 0)
+    return browser
+
 def parse_html(soup_results):
     all_doc_info = []
     for doc in soup_results:
@@ -1,5 +1,50 @@
 import pytest
-from frontend_helpers import do_q_append, parse_existing_q, perform_search, perform_insert, parse_update, perform_update
+import datetime
+from pymongo import MongoClient
+from bson.objectid import ObjectId
+from dunetoolkit import LocalResultCache, set_result_cache, result_cache_info
+from frontend_helpers import do_q_append, restore_existing_q, parse_existing_q, perform_search, perform_search_page, perform_insert, parse_update, perform_update, hash_password, new_password_hash, check_password, needs_rehash, LEGACY_SCRYPT_PARAMS
+from metrics import Histogram, timed, STAGE_DURATION, reset_metrics
+
+
+def test_password_hashing():
+    scrypt_params = {'N':1024, 'r':8, 'p':1}
+    encrypted_pw, salt = new_password_hash('testing password', scrypt_params)
+    user_obj = {'user_mode':'DUNEreader', 'password_hashed':encrypted_pw, 'salt':salt, 'scrypt_params':scrypt_params}
+    assert check_password('testing password', user_obj, 'global salt')
+    assert not check_password('wrong password', user_obj, 'global salt')
+    assert not needs_rehash(user_obj, scrypt_params)
+    assert needs_rehash(user_obj, {'N':2048, 'r':8, 'p':1})
+
+    # every user gets their own salt
+    assert new_password_hash('testing password', scrypt_params)[0] != encrypted_pw
+
+    # users added before per-user salts are checked with the global salt
+    legacy_user_obj = {'user_mode':'DUNEwriter', 'password_hashed':hash_password('testing password', 'global salt', LEGACY_SCRYPT_PARAMS)}
+    assert check_password('testing password', legacy_user_obj, 'global salt')
+    assert needs_rehash(legacy_user_obj, scrypt_params)
+
+def test_latency_histogram():
+    histogram = Histogram('test_duration_seconds', 'Test durations.', ('stage',), buckets=(0.1, 1.0))
+    histogram.observe(0.05, stage='a')
+    histogram.observe(0.5, stage='a')
+    histogram.observe(5, stage='b')
+    lines = histogram.to_prometheus().splitlines()
+    assert lines[:2] == ['# HELP test_duration_seconds Test durations.', '# TYPE test_duration_seconds histogram']
+    # bucket counts are cumulative
+    assert 'test_duration_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'test_duration_seconds_bucket{stage="a",le="1.0"} 2' in lines
+    assert 'test_duration_seconds_bucket{stage="a",le="+Inf"} 2' in lines
+    assert 'test_duration_seconds_sum{stage="a"} 0.55' in lines
+    assert 'test_duration_seconds_bucket{stage="b",le="1.0"} 0' in lines
+    assert 'test_duration_seconds_count{stage="b"} 1' in lines
+
+    # outside of a request, stages are recorded right away
+    reset_metrics()
+    with timed('parse_query'):
+        pass
+    assert 'dune_stage_duration_seconds_count{endpoint="none",stage="parse_query"} 1' in STAGE_DURATION.to_prometheus()
+    reset_metrics()
 
 
 
@@ -14,6 +59,7 @@ def set_up_db_for_test():
     coll.insert_one({ "_id" : ObjectId("000000000000000000000004"), "measurement" : { "description" : "", "practitioner" : { "name" : "RAL", "contact" : "" }, "requestor" : { "name" : "", "contact" : "" }, "date" : [ ], "institution" : "", "technique" : "AA", "results" : [ { "unit" : "ppm", "value" : [ 15 ], "isotope" : "K-40", "type" : "measurement" } ] }, "grouping" : "ILIAS UKDM", "specification" : "3.00", "data_source" : { "input" : { "date" : [ datetime.datetime(2016, 7, 14, 0, 0) ], "name" : "Ben Wise / James Loach", "contact" : "bwise@smu.edu / james.loach@gmail.com", "notes" : "" }, "reference" : "ILIAS Database http://radiopurity.in2p3.fr/" }, "sample" : { "description" : "Salt, ICI, pure dried vacuum", "id" : "ILIAS UKDM #273", "owner" : { "name" : "", "contact" : "" }, "name" : "Salt, ICI, pure dried vacuum", "source" : "" }, "type" : "measurement", "_version" : 1 })
     coll.insert_one({ "_id" : ObjectId("000000000000000000000005"), "measurement" : { "description" : "Lu < 1ppb, Rb < 10ppb", "practitioner" : { "name" : "Charles Evans/Cascade Scientific", "contact" : "" }, "requestor" : { "name" : "", "contact" : "" }, "date" : [ ], "institution" : "", "technique" : "GD-MS", "results" : [ { "unit" : "ppb", "value" : [ 1 ], "isotope" : "U-238", "type" : "limit" }, { "unit" : "ppb", "value" : [ 1 ], "isotope" : "Th-232", "type" : "limit" }, { "unit" : "ppm", "value" : [ 0.22 ], "isotope" : "K-40", "type" : "limit" } ] }, "grouping" : "ILIAS UKDM", "specification" : "3.00", "data_source" : { "input" : { "date" : [ datetime.datetime(2013, 7, 22, 0, 0) ], "name" : "Ben Wise / James Loach", "contact" : "bwise@smu.edu / james.loach@gmail.com", "notes" : "" }, "reference" : "ILIAS Database http://radiopurity.in2p3.fr/" }, "sample" : { "description" : "Si", "id" : "ILIAS UKDM #279", "owner" : { "name" : "", "contact" : "" }, "name" : "Si", "source" : "" }, "type" : "measurement", "_version" : 1 })
     coll.insert_one({ "_id" : ObjectId("000000000000000000000006"), "measurement" : { "description" : "", "practitioner" : { "name" : "Supplier's data", "contact" : "" }, "requestor" : { "name" : "", "contact" : "" }, "date" : [ ], "institution" : "", "technique" : "?", "results" : [ { "unit" : "ppm", "value" : [ 0.03 ], "isotope" : "K-40", "type" : "measurement" } ] }, "grouping" : "ILIAS UKDM", "specification" : "3.00", "data_source" : { "input" : { "date" : [ datetime.datetime(2013, 1, 30, 0, 0) ], "name" : "Ben Wise / James Loach", "contact" : "bwise@smu.edu / james.loach@gmail.com", "notes" : "" }, "reference" : "ILIAS Database http://radiopurity.in2p3.fr/" }, "sample" : { "description" : "Silica fibre, TSL, 'Spectrosil'", "id" : "ILIAS UKDM #289", "owner" : { "name" : "", "contact" : "" }, "name" : "Silica fibre, TSL, 'Spectrosil'", "source" : "" }, "type" : "measurement", "_version" : 1 })
+    return client.dune_pytest_data
 
 def teardown_db_for_test():
     client = MongoClient('localhost', 27017)
@@ -24,3 +70,42 @@ def teardown_db_for_test():
 
 
 
+def test_search_pages():
+    db_obj = set_up_db_for_test()
+    try:
+        form = {'existing_query':'', 'query_field':'grouping', 'comparison_operator':'eq', 'query_value':'ILIAS UKDM', 'append_mode':''}
+        q_dict, q_str, q_state, num_q_lines, error_msg = do_q_append(form)
+        results, next_after_id, error_msg = perform_search_page(q_dict, db_obj, page_size=3, projection='summary')
+        assert [ result['_id'] for result in results ] == ['000000000000000000000002', '000000000000000000000003', '000000000000000000000004']
+        assert next_after_id == '000000000000000000000004'
+
+        # the search page restores the same query from its state to show the next page
+        restored_q_dict, restored_q_str, restored_q_state, error_msg = restore_existing_q({'existing_query_state':q_state, 'existing_query':q_str})
+        assert error_msg == '' and restored_q_dict == q_dict and restored_q_str == q_str
+        results, next_after_id, error_msg = perform_search_page(restored_q_dict, db_obj, page_size=3, after_id=next_after_id, projection='summary')
+        assert [ result['_id'] for result in results ] == ['000000000000000000000005', '000000000000000000000006']
+        assert next_after_id is None
+
+        assert restore_existing_q({'existing_query_state':'', 'existing_query':''})[3] != ''
+    finally:
+        teardown_db_for_test()
+
+def test_search_result_cache():
+    db_obj = set_up_db_for_test()
+    set_result_cache(LocalResultCache())
+    try:
+        q_dict = do_q_append({'existing_query':'', 'query_field':'grouping', 'comparison_operator':'eq', 'query_value':'ILIAS UKDM', 'append_mode':''})[0]
+        results, next_after_id, error_msg = perform_search_page(q_dict, db_obj, page_size=3, projection='summary')
+        assert result_cache_info()['misses'] == 1
+
+        # repeating a search is answered from the result cache
+        results, next_after_id, error_msg = perform_search_page(q_dict, db_obj, page_size=3, projection='summary')
+        assert len(results) == 3
+        assert result_cache_info()['hits'] == 1
+        perform_search(q_dict, db_obj, projection='summary')
+        results, error_msg = perform_search(q_dict, db_obj, projection='summary')
+        assert len(results) == 5
+        assert result_cache_info()['hits'] == 2
+    finally:
+        set_result_cache(None)
+        teardown_db_for_test()